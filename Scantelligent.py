@@ -2,7 +2,7 @@ import os, sys, html, atexit, re, copy, time
 import numpy as np
 from PyQt6 import QtGui, QtCore, sip
 from lib import Spectelligent, SCTWidgets, ScantelligentGUI
-from lib import DataProcessing, FileFunctions, ParameterManager, UserData, AudioGenerator
+from lib import DataProcessing, FileFunctions, ParameterManager, UserData, AudioGenerator, ProcessingService, FileLoader, ItemCache, ParameterBroadcaster
 from lib import NanonisAPI, KeithleyAPI, CameraAPI, MLAAPI
 from datetime import datetime
 
@@ -57,10 +57,18 @@ class Scantelligent(QtCore.QObject):
         self.user = UserData()
         self.file_functions = FileFunctions()
         self.data = DataProcessing() # Class for data processing and analysis
+        self.processing = ProcessingService() # Worker pool that keeps image processing and file reading off the GUI thread
+        self.processing.message.connect(self.receive_message)
+        self.file_loader = FileLoader(self.file_functions, self.processing) # Background file loading with a small cache and prefetching of the neighbouring files
+        self.file_loader.preview.connect(lambda file_path, file_data: self.display_file(file_path, file_data, preview = True))
+        self.file_loader.loaded.connect(self.display_file)
         self.lines = [] # Lines for plotting in the graph
         self.parameters = ParameterManager(parent = self) # Intantiate the ParameterManger, which implements easy parameter getting, setting, loading and saving
+        self.broadcaster = ParameterBroadcaster(max_rate = 20) # Drops unchanged parameter dicts and coalesces bursts before they reach the ParameterManager
+        self.broadcaster.parameters.connect(self.parameters.receive)
         self.focus_group = "connections"
-        self.saved_items = []
+        self.item_cache = ItemCache(budget_mb = 2048) # Saved items beyond the memory budget spill their arrays to a temporary HDF5 file and show a thumbnail
+        self.saved_items = self.item_cache.items # Shared list, most recently used first
         self.timer = QtCore.QTimer()
                 
         # Dict to keep track of the hardware and experiment status
@@ -217,7 +225,7 @@ class Scantelligent(QtCore.QObject):
                 self.camera = CameraAPI(hw_config = self.hw_config)
                 
                 # Set up signal-slot connections
-                self.camera.parameters.connect(self.parameters.receive)
+                self.camera.parameters.connect(self.broadcaster.receive, QtCore.Qt.ConnectionType.DirectConnection)
                 self.camera.captured_frame.connect(self.receive_image)
                 
                 # Initialize
@@ -253,7 +261,7 @@ class Scantelligent(QtCore.QObject):
                 
                 # Set up signal-slot connections
                 # Keithley -> Scantelligent
-                self.keithley.parameters.connect(self.parameters.receive)
+                self.keithley.parameters.connect(self.broadcaster.receive, QtCore.Qt.ConnectionType.DirectConnection)
                 
                 # Get parameters from Keithley
                 self.keithley.initialize()
@@ -273,7 +281,7 @@ class Scantelligent(QtCore.QObject):
                 # Set up signal-slot connections                
                 # MLA -> Scantelligent
                 self.mla.task_progress.connect(lambda val: self.gui.progress_bars["task"].setValue(val))
-                self.mla.parameters.connect(self.parameters.receive) # Parameter dictionaries are received in the ParameterManager class, instantiated as self.parameters
+                self.mla.parameters.connect(self.broadcaster.receive, QtCore.Qt.ConnectionType.DirectConnection) # Parameter dictionaries are received in the ParameterManager class, instantiated as self.parameters, through the ParameterBroadcaster
                 self.mla.message.connect(self.logprint)
 
                 self.logprint("MLA: Found the MLA", "success")
@@ -303,7 +311,7 @@ class Scantelligent(QtCore.QObject):
                 # Set up signal-slot connections
                 # Nanonis -> Scantelligent
                 self.nanonis.task_progress.connect(lambda val: self.gui.progress_bars["task"].setValue(val))
-                self.nanonis.parameters.connect(self.parameters.receive) # Parameter dictionaries are received in the ParameterManager class, instantiated as self.parameters
+                self.nanonis.parameters.connect(self.broadcaster.receive, QtCore.Qt.ConnectionType.DirectConnection) # Parameter dictionaries are received in the ParameterManager class, instantiated as self.parameters, through the ParameterBroadcaster
                 self.nanonis.message.connect(self.logprint)
                 self.nanonis.image.connect(self.receive_image)
                 self.nanonis.data_array.connect(self.receive_data)
@@ -319,7 +327,7 @@ class Scantelligent(QtCore.QObject):
                 # Set up signal-slot connections
                 # Nanonis -> Scantelligent
                 self.nanonis1.task_progress.connect(lambda val: self.gui.progress_bars["task"].setValue(val))
-                self.nanonis1.parameters.connect(self.parameters.receive) # Parameter dictionaries are received in the ParameterManager class, instantiated as self.parameters
+                self.nanonis1.parameters.connect(self.broadcaster.receive, QtCore.Qt.ConnectionType.DirectConnection) # Parameter dictionaries are received in the ParameterManager class, instantiated as self.parameters, through the ParameterBroadcaster
                 self.nanonis1.message.connect(self.logprint)
                 self.nanonis1.image.connect(self.receive_image)
                 self.nanonis1.data_array.connect(self.receive_data)
@@ -428,12 +436,41 @@ class Scantelligent(QtCore.QObject):
             image = self.active_item.getSlice()
             if np.isnan(image).all(): return
             
-            (processed_scan, statistics, limits, error) = self.data.process_scan(image)
+            # Process off the GUI thread. If lines arrive faster than they can be processed, intermediate frames are skipped because only the newest job's result is delivered
+            self.processing.submit("image", self.data.process_scan, np.array(image, copy = True), statistics = False, out = self.color_buffer(self.active_item), callback = lambda output, item = self.active_item: self.show_live_image(item, output))
+        except Exception as e:
+            print(f"{e}")
+        return
+
+    def color_buffer(self, item: SCTWidgets.ArrayItem) -> np.ndarray | None:
+        """
+        Persistent RGBA output buffer of an item for the colourized projections. The buffer that is on screen is never handed out, so the next frame cannot overwrite it
+        """
+        buffers = getattr(item, "color_buffers", None)
+        return buffers.get("spare") if isinstance(buffers, dict) else None
+
+    def keep_color_buffer(self, item: SCTWidgets.ArrayItem, image: np.ndarray) -> None:
+        """
+        Records the RGBA buffer behind a colourized image that is about to be shown; the buffer shown before becomes the spare
+        """
+        buffer = image.base if isinstance(image, np.ndarray) and image.ndim == 3 else None
+        if not isinstance(buffer, np.ndarray) or buffer.ndim != 3 or buffer.shape[2] != 4: return
+        buffers = getattr(item, "color_buffers", None)
+        if not isinstance(buffers, dict): buffers = item.color_buffers = {"shown": None, "spare": None}
+        if buffer is not buffers["shown"]: (buffers["shown"], buffers["spare"]) = (buffer, buffers["shown"])
+        return
+
+    def show_live_image(self, item: SCTWidgets.ArrayItem, output: tuple) -> None:
+        (processed_scan, statistics, limits, error) = output # Statistics are only computed if the limit methods need them
+        if not hasattr(self, "active_item") or item is not self.active_item or len(limits) < 2: return
+        self.keep_color_buffer(item, processed_scan)
+        
+        try:
             [self.gui.limits_widget.setValue("full", side, float(limits[index])) for index, side in enumerate(["min", "max"])]
             
             if np.isnan(processed_scan).all(): return
-            self.active_item.setImage(processed_scan)
-            self.gui.hist_item.setLevels(limits[0], limits[1])
+            self.active_item.updateRows(processed_scan) # Only the rows that changed are re-rendered
+            if not np.allclose(self.gui.hist_item.getLevels(), limits[:2]): self.gui.hist_item.setLevels(limits[0], limits[1]) # New levels force a full re-render, so only set them when they change
         except Exception as e:
             print(f"{e}")
         return
@@ -453,6 +490,8 @@ class Scantelligent(QtCore.QObject):
                 self.gui.grapher.clearBuffer()
                 [self.gui.checkboxes[f"channel_{channel_index}"].setToolTip(f"channel {channel_index}") for channel_index in range(self.gui.grapher.n_channels)]
                 [self.gui.checkboxes[f"channel_{channel_index}"].setChecked(False) for channel_index in range(self.gui.grapher.n_channels)]
+            elif isinstance(data_array[0, 0], str) and data_array[0, 0] == "clear data": # Clear the buffer, but keep the channels. Used to redraw data that were re-sorted
+                self.gui.grapher.clearBuffer()
             self.update_pdi_visibility()
             self.gui.grapher.plotData()
             return
@@ -475,9 +514,8 @@ class Scantelligent(QtCore.QObject):
 
         
         
-        # Numeric data is added to the buffer
+        # Numeric data is added to the buffer. The grapher repaints itself on its render timer
         self.gui.grapher.addData(data_array)
-        self.gui.grapher.plotData()
         return
 
     @QtCore.pyqtSlot(str)
@@ -525,6 +563,8 @@ class Scantelligent(QtCore.QObject):
                 match (event.key(), self.focus_group):
                     case (QKey.Key_Plus | QKey.Key_Equal, _): self.gui.groupboxes[self.focus_group].maximize()
                     case (QKey.Key_Minus, _): self.gui.groupboxes[self.focus_group].minimize()
+                    case (QKey.Key_BracketLeft, _): self.open_neighbour_file(-1) # Step through the files in the folder of the last opened file
+                    case (QKey.Key_BracketRight, _): self.open_neighbour_file(1)
                     
                     case (QKey.Key_Escape, "connections"): self.exit()
                     case (QKey.Key_PageUp, "tip"):
@@ -729,12 +769,22 @@ class Scantelligent(QtCore.QObject):
             self.logprint(f"Cannot open non-existing file {file_path}", message_type = "error")
             return
         
+        # The file is read in the worker pool (or taken from the cache); display_file is called in the GUI thread with a preview and/or the full data
+        self.file_loader.request(file_path)
+        return
+
+    def open_neighbour_file(self, offset: int = 1) -> None:
+        if not isinstance(self.file_loader.current, str): return
+        file_path = self.file_loader.neighbour(self.file_loader.current, offset)
+        if isinstance(file_path, str): self.receive_fileopen_request(file_path)
+        return
+
+    def display_file(self, file_path: str, file_data: dict, preview: bool = False) -> None:
         self.toggle_view("nanonis")
         dataset = None
         frame = None
 
         try:
-            file_data = self.file_functions.read_file(file_path)
             [dataset, frame, axes, axes_data] = [file_data.get(key, None) for key in ["dataset", "frame", "axes", "axes_data"]]
         except Exception as e:
             self.logprint(f"Could not open this file: {e}", message_type = "error")
@@ -744,7 +794,8 @@ class Scantelligent(QtCore.QObject):
             return
         
         try:
-            array_item = SCTWidgets.ArrayItem(name = os.path.basename(file_path), array = dataset, frame = frame) # Create the ArrayItem object
+            item_name = os.path.basename(file_path) + (" (preview)" if preview else "")
+            array_item = SCTWidgets.ArrayItem(name = item_name, array = dataset, frame = frame) # Create the ArrayItem object
             
             previous_rank = self.gui.comboboxes["x_axis"].count() # Record the initial state of the comboboxes. The previous rank is equal to the number of axis labels currently present in the combobox
             previous_x_index = self.gui.comboboxes["x_axis"].currentIndex()
@@ -780,7 +831,7 @@ class Scantelligent(QtCore.QObject):
             self.set_view_range("frame")
             self.data.scan_processing_flags.update({"frame": frame})
             
-            self.logprint(f"Successfully loaded scan file {file_path}", message_type = "success")
+            if not preview: self.logprint(f"Successfully loaded scan file {file_path}", message_type = "success")
         except Exception as e:
             self.logprint(f"Error trying to open this file: {e}", message_type = "error")
         return
@@ -812,6 +863,10 @@ class Scantelligent(QtCore.QObject):
 
     def cleanup(self) -> None:
         #self.user.save_parameter_sets()
+        try: self.processing.shutdown()
+        except: pass
+        try: self.item_cache.close()
+        except: pass
         try: self.experiment_thread.requestInterruption()
         except: pass
         try: self.camera_thread.requestInterruption()
@@ -858,9 +913,8 @@ class Scantelligent(QtCore.QObject):
         return
 
     def save_active_item(self) -> None:
-        if hasattr(self, "active_item"):
-            self.saved_items.insert(0, self.active_item) # Save the active item to the saved_items
-        if len(self.saved_items) > 18: self.saved_items = self.saved_items[:18] # Clip the length of saved_items to a maximum number of 18
+        if hasattr(self, "active_item"): self.item_cache.add(self.active_item) # Save the active item to the saved_items. The cache spills the least recently used items if the memory budget is exceeded
+        if len(self.saved_items) < 1: return
         
         saved_item_names = []
         for index, item in enumerate(self.saved_items):
@@ -1040,6 +1094,7 @@ class Scantelligent(QtCore.QObject):
         try:
             index = self.gui.comboboxes["items"].currentIndex()
             selected_item = self.saved_items[index]
+            self.item_cache.touch(selected_item) # Reload the arrays if the item was spilled to disk
             self.gui.image_view.setItem(selected_item)
             self.active_item = selected_item
             self.active_item.showLabels(True)
@@ -1057,6 +1112,7 @@ class Scantelligent(QtCore.QObject):
         for index in range(self.gui.grapher.n_channels):
             checked = bool(self.gui.checkboxes[f"channel_{index}"].state_index)
             self.gui.grapher.pdis[index].setVisible(checked)
+        self.gui.grapher.plotData() # Newly shown channels need fresh data
         return
 
     def histogram_levels_changed(self) -> None:
@@ -1234,19 +1290,30 @@ class Scantelligent(QtCore.QObject):
                 if self.data.scan_processing_flags.get("reciprocal"): self.active_item.setReciprocalFrame()
                 else: self.active_item.setFrame()
                 image = self.active_item.getSlice()
-                (image, statistics, limits, error) = self.data.process_scan(image)
-                self.active_item.setImage(image)
+                self.processing.submit("image", self.data.process_scan, np.array(image, copy = True), out = self.color_buffer(self.active_item), callback = lambda output, item = self.active_item: self.show_processed_image(item, output))
+            except Exception as e:
+                self.logprint(f"{e}")
+        return
+
+    def show_processed_image(self, item: SCTWidgets.ArrayItem, output: tuple) -> None:
+        (image, statistics, limits, error) = output
+        if not hasattr(self, "active_item") or item is not self.active_item: return # The user switched items while the job was running
+        self.keep_color_buffer(item, image)
+        
+        try:
+            self.active_item.setImage(image)
+            if isinstance(statistics, dict):
                 img_min = statistics.get("min")
                 img_max = statistics.get("max")
                 if isinstance(img_min, float | int) and isinstance(img_max, float | int):
                     self.gui.limits_widget.setValue("full", "min", img_min)
                     self.gui.limits_widget.setValue("full", "max", img_max)
-                
-                hist_item = self.gui.image_view.getHistogramWidget().item
-                #hist_item.setLevels(limits[0], limits[1])
-                hist_item.autoHistogramRange()
-            except Exception as e:
-                self.logprint(f"{e}")
+            
+            hist_item = self.gui.image_view.getHistogramWidget().item
+            #hist_item.setLevels(limits[0], limits[1])
+            hist_item.autoHistogramRange()
+        except Exception as e:
+            self.logprint(f"{e}")
         return
 
 
@@ -1511,8 +1578,9 @@ class Scantelligent(QtCore.QObject):
                 try:
                     mla_pointer = None
                     if hasattr(self, "mla"): mla_pointer = self.mla                    
+                    keithley_pointer = self.keithley if hasattr(self, "keithley") else None
                     self.experiment = self.file_functions.load_experiment_from_file(experiment_path, hw_config = self.hw_config, experiment_file = experiment_filepath, scantelligent_folder = self.paths["parent_folder"],
-                                                                                    scan_processing_flags = self.data.scan_processing_flags, nanonis = self.nanonis1, mla = mla_pointer)
+                                                                                    scan_processing_flags = self.data.scan_processing_flags, nanonis = self.nanonis1, mla = mla_pointer, keithley = keithley_pointer)
                     self.experiment_thread = QtCore.QThread()
                     self.experiment.moveToThread(self.experiment_thread)
                     
@@ -1528,7 +1596,7 @@ class Scantelligent(QtCore.QObject):
 
                     # Other data
                     self.experiment.message.connect(lambda message, message_type: self.logprint(message = message, message_type = message_type))
-                    self.experiment.parameters.connect(self.parameters.receive)
+                    self.experiment.parameters.connect(self.broadcaster.receive, QtCore.Qt.ConnectionType.DirectConnection)
                     self.experiment.image.connect(self.receive_image)
                     self.experiment.data_array.connect(self.receive_data)
                     self.experiment.array_slice.connect(self.receive_array_slice)
@@ -1552,12 +1620,14 @@ class Scantelligent(QtCore.QObject):
                 # Pass the parameters from the gui to the experiment
                 spec_line_edits = {}
                 [spec_line_edits.update({f"{quantity}_{key}": self.spt.gui.line_edits[f"sts_{quantity}_{key}"].getValue() for key in ["start", "end", "points"]}) for quantity in ["x", "y", "V", "f", "z", "amp", "V_keithley"]]
-                spec_line_edits.update({f"t_{key}": self.spt.gui.line_edits[f"sts_t_{key}"].getValue() for key in ["settle", "int"]})
+                spec_line_edits.update({f"t_{key}": self.spt.gui.line_edits[f"sts_t_{key}"].getValue() for key in ["settle", "int", "max"]})
+                spec_line_edits.update({key: self.spt.gui.line_edits[f"sts_{key}"].getValue() for key in ["rel_error", "adaptive_points"]})
                 spec_line_edits.update({f"{key}_feedback": self.spt.gui.line_edits[f"sts_{key}_feedback"].getValue() for key in ["t", "V", "I", "p", "t_const", "z"]})
                 spec_buttons = {}
                 spec_buttons.update({f"{key}": self.spt.gui.buttons[f"sts_{key}"].state_name for key in ["x_axis", "y_axis"]}) # Names of the spectroscopic axes
                 spec_buttons.update({f"{quantity}_retrace": self.spt.gui.buttons[f"{quantity}_retrace"].isChecked() for quantity in ["V", "f", "z", "amp", "V_keithley"]}) # Bools desribing whether to retrace
                 spec_buttons.update({key: self.spt.gui.buttons[key].isChecked() for key in ["tia_correct", "intermediate_feedback", "blank_modulators"]}) # Spec settings: bools
+                spec_buttons.update({key: self.spt.gui.buttons[f"sts_{key}"].isChecked() for key in ["snake", "adaptive"]})
                 spec_buttons.update({key: self.spt.gui.buttons[key].state_name for key in ["nanonis_mla", "spectroscopy_feedback"]})
                 spec_buttons.update({key: self.gui.buttons[key].state_name for key in ["scan_direction"]})
                 modulators_bool_list = [self.spt.gui.checkboxes[f"modulator_{index}"].isChecked() for index in range(32)]
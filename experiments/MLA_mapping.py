@@ -4,7 +4,7 @@ from scipy.ndimage import gaussian_filter
 import h5py
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Add the lib folder to the path variable
-from lib import BaseExperiment
+from lib import BaseExperiment, SweepEngine
 
 
 
@@ -28,6 +28,8 @@ class Experiment(BaseExperiment):
         gui_parameters = self.start_parameters["gui"]
         [spec_button_states, spec_line_edits] = [gui_parameters.get(key) for key in ["spectroscopy_buttons", "spectroscopy_line_edits"]]
         [t_settle, t_int] = [int(spec_line_edits[f"t_{key}"]) for key in ["settle", "int"]]
+        [rel_error_percent, t_max] = [spec_line_edits.get(key) or 0 for key in ["rel_error", "t_max"]]
+        integration = {"relative error": rel_error_percent / 100, "max pixels": max(int(t_max), t_int), "tones": [1]} if rel_error_percent > 0 else None # Noise-targeted integration on the first harmonic
         [nanonis_or_mla, tia_correct] = [spec_button_states.get(key) for key in ["nanonis_mla", "tia_correct"]]
         nanonis_or_mla = spec_button_states.get("nanonis_mla")
         if nanonis_or_mla == "nanonis": self.logprint(f"Nanonis sweep not yet implemented. Try setting the spectroscopy to MLA")
@@ -35,7 +37,8 @@ class Experiment(BaseExperiment):
         
         # Read from Nanonis
         [scan_metadata, grid, tip_status, nn_bias, nn_hardware] = [self.start_parameters["nanonis"].get(parameter) for parameter in ["scan_metadata", "grid", "tip_status", "bias", "hardware"]]
-        [pixels, lines, x_grid, y_grid, scan_range_nm] = [grid.get(key) for key in ["pixels", "lines", "x_grid (nm)", "y_grid (nm)", "domain (nm)"]]
+        [pixels, lines, scan_range_nm] = [grid.get(key) for key in ["pixels", "lines", "domain (nm)"]]
+        (x_grid, y_grid) = nn.grid_coordinates(grid)
         [tia_gain, tia_gain_V_per_pA] = [nn_hardware.get(key) for key in ["current_gain", "gain (V/pA)"]]
         (list_data, error) = nn.grids_to_lists(grid, direction = direction)
         [x_list_nm, y_list_nm] = [list_data[f"{dim}_list (nm)"] for dim in ["x", "y"]]
@@ -53,11 +56,13 @@ class Experiment(BaseExperiment):
         tia_corrections = None
         if tia_correct and tia_gain in self.luts.keys():
             self.logprint(f"TIA corrections requested. I found them")
-            tia_corrections = self.luts.get(tia_gain)
+            tia_corrections = self.lut_service.tia_correction(tia_gain) # Shared correction with a precompiled interpolator
 
         # Prepare the output
         channel_names = ["t (s)", "V (V)", "x (nm)", "y (nm)", "z (nm)", "I (pA)"]
         [channel_names.extend([f"Re(G{demod_index + 1}) (nS)", f"Im(G{demod_index + 1}) (nS)"]) for demod_index in range(32)]
+        acquisition = SweepEngine(mla, settle_pixels = 0, pixels_per_datapoint = t_int, integration = integration) # Only used for the (noise-targeted) integration of the pixels; the settling happens after the tip move
+        if acquisition.integration: channel_names.append(acquisition.count_channel) # Number of pixels integrated for every map pixel
         n_channels = len(channel_names)
         self.data_array.emit(np.array(channel_names)) # This triggers the GUI to start graphing data
         self.parameters.emit({"dict_name": "scan_metadata", "channel_dict": {channel_name: index for index, channel_name in enumerate(channel_names)}}) # This triggers the GUI and scan_processing_flags to assign the correct scan channels to the slices of the data array
@@ -67,7 +72,7 @@ class Experiment(BaseExperiment):
         # Set up the HDF5 datasets and groups
         spectroscopy_group: h5py.Group = self.output_file.create_group("spectrocopy_settings")
         spectroscopy_group.attrs.update({"device": "MLA", "MLA time constant (ms)": time_constant_dict.get("tm (ms)", ""), "MLA df (Hz)": time_constant_dict.get("df (Hz)", ""), "V_port1 (V)": mla_bias.get("port_1 (V)", 0), "V_port2 (V)": mla_bias.get("port_2 (V)", 0),
-                                         "f / df": 1, "settling time (1 / df)": t_settle, "pixels per datapoint (1 / df)": t_int, "tia gain setting": tia_gain, "tia gain (V/pA)": tia_gain_V_per_pA})
+                                         "f / df": 1, "settling time (1 / df)": t_settle, "pixels per datapoint (1 / df)": t_int, "target relative error (%)": rel_error_percent, "max pixels per datapoint (1 / df)": max(int(t_max), t_int), "tia gain setting": tia_gain, "tia gain (V/pA)": tia_gain_V_per_pA})
         mla_settings_ds = spectroscopy_group.create_dataset("MLA settings", data = mla_setup_array)
 
         map_group: h5py.Group = self.output_file.create_group("map_group")
@@ -82,11 +87,11 @@ class Experiment(BaseExperiment):
         y_ds.make_scale("y values")
         
         map_array = np.empty((n_channels, lines, pixels), dtype = np.float32)
-        map_ds = map_group.create_dataset("map", shape = ((n_channels, lines, pixels)), dtype = np.float32)
+        map_ds = self.file_functions.create_hdf5_dataset(map_group, "map", shape = (n_channels, lines, pixels), dtype = np.float32, layout = "map")
         map_ds.dims[0].attach_scale(channel_indices_ds)
         map_ds.dims[1].attach_scale(y_ds)
         map_ds.dims[2].attach_scale(x_ds)
-        map_errors_ds = map_group.create_dataset("map_errors", shape = ((n_channels, lines, pixels)), dtype = np.float32)
+        map_errors_ds = self.file_functions.create_hdf5_dataset(map_group, "map_errors", shape = (n_channels, lines, pixels), dtype = np.float32, layout = "map")
         map_errors_ds.dims[0].attach_scale(channel_indices_ds)
         map_errors_ds.dims[1].attach_scale(y_ds)
         map_errors_ds.dims[2].attach_scale(x_ds)
@@ -94,6 +99,8 @@ class Experiment(BaseExperiment):
         map_group.attrs.update({"signal": "map"})
         map_group.attrs.update({"axes": ["channel index axis", "y axis", "x axis"]})
         map_group.attrs.update({"units": ["", "nm", "nm"]})
+        self.file_functions.create_hdf5_progress(map_group, steps = lines * pixels)
+        self.start_swmr() # The file structure is complete. From here on, the map can be read live
         
 
 
@@ -122,16 +129,11 @@ class Experiment(BaseExperiment):
                     raise Exception("Aborting")
 
                 data_chunk = np.array([t_elapsed, V_dc, x_nm, y_nm, z_nm, I_pA])
-                (pix_V, pix_V_var) = mla.get_pixels(t_int, average = True)
-                pix_V_std_dev = np.sqrt(pix_V_var)
+                pix = acquisition.acquire()
+                pix_V = np.average(pix, axis = 1)
+                pix_V_std_dev = np.std(pix, axis = 1, ddof = 1) if pix.shape[1] > 1 else np.zeros(len(pix_V))
                 
-                if isinstance(tia_corrections, list | np.ndarray): # Apply correction for tia response if desired
-                    for tone in range(len(pix_V)):
-                        freq_int = int(round(freqs[tone]))
-                        if freq_int < len(tia_corrections):
-                            tone_correction = tia_corrections[freq_int]
-                            pix_V[tone] *= tone_correction
-                            pix_V_std_dev *= np.abs(tone_correction)
+                (pix_V, pix_V_std_dev) = mla.correct_tia(pix_V, pix_V_std_dev, freqs, tia_corrections) # Apply correction for tia response if desired
                 
                 pix_nS = 2 * pix_V / (tia_gain_V_per_pA * V_ac_mV)
                 pix_nS_std_dev = 2 * pix_V_std_dev / (tia_gain_V_per_pA * V_ac_mV)
@@ -143,12 +145,15 @@ class Experiment(BaseExperiment):
                 ext_pix[1::2] = quadrature
                 
                 combined_pixel = np.concatenate((data_chunk, ext_pix))
+                if acquisition.integration: combined_pixel = np.append(combined_pixel, pix.shape[1])
                 self.data_array.emit(combined_pixel)
                 
                 error_pixel = np.zeros_like(combined_pixel)
                 error_pixel[6 : len(pix_nS_std_dev) + 6] = pix_nS_std_dev
                 
-                map_ds[:, line_index, pix_index] = combined_pixel
+                self.write(map_ds, (slice(None), line_index, pix_index), combined_pixel)
+                self.write(map_errors_ds, (slice(None), line_index, pix_index), error_pixel)
+                self.mark_valid(map_group, line_index * pixels + pix_index)
                 map_array[:, line_index, pix_index] = combined_pixel
                 
                 channel_index = self.scan_processing_flags.get("channel_index")                
@@ -55,6 +55,9 @@ class Experiment(BaseExperiment):
         self.set_view("nanonis")
         
         z_fwds = []
+        scan_datasets = []
+        frame_metadata = {"time (s)": [], "center (nm)": [], "angle (deg)": []} # Aligned with the frames of the scan stack
+        t_start = time.time()
         (frame, error) = nn.frame_update()
         for iteration in range(5):
             # Create the ArrayItem (for the GUI) and the hdf5 datasets to store the measurement data        
@@ -71,17 +74,22 @@ class Experiment(BaseExperiment):
             scan_group.create_dataset("x (nm)", data = x_values, dtype = np.float32)
             scan_group.create_dataset("y (nm)", data = y_values, dtype = np.float32)            
             
-            scan_ds = scan_group.create_dataset("scan", shape = (len(directions), len(sct_names), pixels, lines), dtype = np.float32)
+            scan_ds = self.file_functions.create_hdf5_dataset(scan_group, "scan", shape = (len(directions), len(sct_names), pixels, lines), dtype = np.float32, layout = "scan")
             scan_group.attrs.update({"NX_class": "NXdata",
                                         "signal": "scan",
                                         "axes": ["direction indices", "channel indices", "x (nm)", "y (nm)"]})
 
             # Start the scan. Passing the dataset will allow it to be updated during scanning            
+            [frame_metadata[key].append(value) for key, value in zip(["time (s)", "center (nm)", "angle (deg)"], [time.time() - t_start, frame.get("center (nm)"), frame.get("angle (deg)", 0)])]
             data_array = self.nanonis_scan(direction = direction, dataset = scan_ds, verbose = False)
             z_fwds.append(data_array[0, 0])
+            scan_datasets.append(scan_ds)
             
             step = 5 * rng.random(2, dtype = np.float32) - 2.5
             self.logprint(f"Done with scan {iteration}. Now moving the frame by delta_x = {float(step[0]):.4f} nm, delta_y = {float(step[1]):.4f} nm", message_type = "message")
             center = frame.get("center (nm)")
             (frame, error) = nn.frame_update({"center (nm)": np.array([center[0] + step[0], center[1] + step[1]])})
-
+        
+        # Present the scan series as one stacked (time, direction, channel, x, y) virtual dataset
+        stack_group: h5py.Group = self.output_file.create_group("stack")
+        self.file_functions.create_hdf5_stack(stack_group, "stack", scan_datasets, frame_metadata = frame_metadata)
@@ -78,10 +78,12 @@ class Experiment(BaseExperiment):
             scan_group.create_dataset("x (nm)", data = x_values, dtype = np.float32)
             scan_group.create_dataset("y (nm)", data = y_values, dtype = np.float32)
             
-            scan_ds = scan_group.create_dataset("scan", shape = (len(directions), len(sct_names), pixels, lines), dtype = np.float32)
+            scan_ds = self.file_functions.create_hdf5_dataset(scan_group, "scan", shape = (len(directions), len(sct_names), pixels, lines), dtype = np.float32, layout = "scan")
             scan_group.attrs.update({"NX_class": "NXdata",
                                      "signal": "scan",
                                      "axes": ["direction indices", "channel indices", "x (nm)", "y (nm)"]})
+            self.file_functions.create_hdf5_progress(scan_group, steps = lines)
+            self.start_swmr() # The file structure is complete. From here on, the scan can be read live
             
             # Start the scan. Passing the dataset will allow it to be updated during scanning
             self.set_view("nanonis")
@@ -99,7 +101,7 @@ class Experiment(BaseExperiment):
             measurement_array = np.zeros((n_points * n_iterations, len(output_channels)))
             
             # Start data            
-            [x_grid, y_grid] = [grid.get(key) for key in ["x_grid (nm)", "y_grid (nm)"]]
+            (x_grid, y_grid) = nn.grid_coordinates(grid)
             z_fit_nm = np.zeros_like(x_grid, dtype = np.float32)
             (lists, error) = nn.grids_to_lists(grid, direction = "down")
             tip_xy = [tip_status.get(key) for key in ["x (nm)", "y (nm)"]]
@@ -4,7 +4,7 @@ from scipy.ndimage import gaussian_filter
 from datetime import datetime
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Add the lib folder to the path variable
-from lib import BaseExperiment
+from lib import BaseExperiment, nd_sweep
 
 
 
@@ -26,6 +26,8 @@ class Experiment(BaseExperiment):
         [spec_button_states, spec_line_edits, modulators] = [gui_parameters.get(key) for key in ["spectroscopy_buttons", "spectroscopy_line_edits", "modulators"]]
                 
         [t_settle, t_int] = [int(spec_line_edits[f"t_{key}"]) for key in ["settle", "int"]]
+        [rel_error_percent, t_max] = [spec_line_edits.get(key) or 0 for key in ["rel_error", "t_max"]]
+        integration = {"relative error": rel_error_percent / 100, "max pixels": max(int(t_max), t_int), "tones": [1]} if rel_error_percent > 0 else None # Noise-targeted integration on the first harmonic
         [nanonis_or_mla, tia_correct] = [spec_button_states.get(key) for key in ["nanonis_mla", "tia_correct"]]
         [blank_modulators, intermediate_feedback, spectroscopy_feedback] = [spec_button_states.get(key) for key in ["blank_modulators", "intermediate_feedback", "spectroscopy_feedback"]]
         [V_fb, p_gain_fb, I_fb, t_fb, t_const_fb, z_fb] = [spec_line_edits[f"{key}_feedback"] for key in ["V", "p", "I", "t", "t_const", "z"]]
@@ -47,284 +49,146 @@ class Experiment(BaseExperiment):
         
         # Retrieve the tia corrections
         tia_corrections = None
-        if tia_correct and tia_gain in self.luts.keys(): tia_corrections = self.luts.get(tia_gain)
+        if tia_correct and tia_gain in self.luts.keys(): tia_corrections = self.lut_service.tia_correction(tia_gain) # Shared correction with a precompiled interpolator
+        
+        # Axes of the sweep. The y axis (if any) is the slow axis, the x axis the fast axis
+        numbers = np.round(np.asarray(mla_parameters.get("frequencies").get("frequencies (Hz)"), dtype = float) / time_constant_dict.get("df (Hz)")) # The lock-in state is taken from the start parameters instead of being read again
+        amplitudes_mV = np.asarray(mla_parameters.get("amplitudes").get("amplitudes (mV)"), dtype = float)
+        axis_kinds = {"V": ("V", "V"), "z": ("z", "nm"), "f": ("f", "Hz"), "amp": ("amp", "mV"), "V_keithley": ("V_Keithley", "V")}
+        settle_policies = {"V": {"pixels": t_settle}, "f": {"pixels": t_settle}, "amp": {"pixels": t_settle}, "z": {"pixels": t_settle, "s": .02}, "V_keithley": {"pixels": t_settle, "s": .05}} # Per axis, after every step
+        adaptive = None
+        if spec_button_states.get("adaptive", False): # Adaptive sampling of the x axis of a 1D sweep. The x points set the coarse grid. Tones are on integer df
+            if spec_button_states.get("y_axis") in axis_kinds.keys(): raise Exception("Adaptive sampling is only possible for 1D sweeps. Deselect the y axis. Aborting experiment")
+            adaptive = {"points": int(spec_line_edits.get("adaptive_points") or 0), "resolution": 1 if spec_button_states.get("x_axis") == "f" else 0}
+        axes = []
+        for axis_key in ["y", "x"]:
+            kind = spec_button_states.get(f"{axis_key}_axis")
+            [start, end, steps] = [spec_line_edits.get(f"{axis_key}_{key}") for key in ["start", "end", "points"]]
+            if kind not in axis_kinds.keys() or not isinstance(start, int | float) or not isinstance(end, int | float) or not steps: continue
+            values = np.linspace(start, end, int(steps))
+            if spec_button_states.get(f"{kind}_retrace", False) and not adaptive: values = np.concatenate((values, values[::-1]))
+            settle = settle_policies.get(kind)
+            line_settle = {key: 2 * value for key, value in settle.items()} # After a jump of more than one step, like the jump back at the start of a raster line
+            snake = axis_key == "x" and bool(spec_button_states.get("snake", False)) # Alternate the direction of the fast axis, so that it never jumps back
+            
+            match kind:
+                case "V": axis = nd_sweep.mla_bias_axis(mla, values, port = 1, settle = settle, line_settle = line_settle, snake = snake)
+                case "f": axis = nd_sweep.mla_frequency_axis(mla, values, numbers, settle = settle, line_settle = line_settle, snake = snake)
+                case "amp": axis = nd_sweep.mla_amplitude_axis(mla, values, amplitudes_mV, modulators = modulators, settle = settle, line_settle = line_settle, snake = snake)
+                case "z": axis = nd_sweep.z_axis(nn, values, settle = settle, line_settle = line_settle, snake = snake)
+                case "V_keithley":
+                    if self.keithley is None: raise Exception("A Keithley sweep was requested, but the Keithley is not connected")
+                    axis = nd_sweep.keithley_axis(self.keithley, values, settle = settle, line_settle = line_settle, snake = snake)
+            axes.append(axis)
+            
+            (name, unit) = axis_kinds[kind]
+            step = (end - start) / (steps - 1) if steps > 1 else 0
+            self.output_file.attrs.update({f"{axis_key} axis": axis.name, f"{name} start ({unit})": start, f"{name} end ({unit})": end, f"d{name} ({unit})": step, f"{name} steps": steps})
         
-        # Set up spectroscopy x axis
-        x_values = None
-        x_units = None
-        x_axis_label = ""
-        x_ds = None
+        if len(axes) == 0 or spec_button_states.get("x_axis") not in axis_kinds.keys(): raise Exception("No parameter selected to sweep on the x axis. Aborting experiment")
         
-        [x_start, x_end, x_steps] = [spec_line_edits.get(key) for key in ["x_start", "x_end", "x_points"]]
-        x_values = np.linspace(x_start, x_end, x_steps)
-        dx = (x_end - x_start) / (x_steps - 1)
+        # Channels: the axis values, the reference, and the harmonics
+        if tia_gain_V_per_pA > 1E-12: unit = "nS"
+        else: unit = "mV"
+        channel_names = [axis.name for axis in axes if axis.values.ndim == 1] + ["|a1_ref| (mV)"]
+        [channel_names.extend([f"Re(a{i + 1}) ({unit})", f"Im(a{i + 1}) ({unit})"]) for i in range(len(numbers) - 1)]
+        n_channels = len(channel_names) # Channels computed from the pixels. The pixel count is appended when the integration is noise-targeted
+        if adaptive: adaptive.update({"points": max(adaptive.get("points"), len(axes[-1])), "channels": list(range(n_channels - 2 * (len(numbers) - 1), n_channels))}) # The refinement is steered by the harmonics
+        if integration: channel_names.append(nd_sweep.SweepEngine.count_channel)
+        self.parameters.emit({"dict_name": "view_request", "view": "graph"})
+        self.data_array.emit(np.array(channel_names)) # This triggers the GUI to start graphing data
         
-        if blank_modulators: post_sweep_outputs = "blank"
-        else: post_sweep_outputs = "reset"
         
-        match spec_button_states["x_axis"]:
-            case "V":
-                x_axis_label = "voltage (V)"
-                x_units = "V"
-                if spec_button_states.get("V_retrace", False): x_values = np.concatenate((x_values, x_values[::-1]))
-                x_axis_info = {"V start (V)": x_start, "V end (V)": x_end, "dV (V)": dx, "V steps": x_steps}
-                
-                x_measurement = lambda insert_parameter, channel_names_callback: mla.voltage_sweep(
-                    x_values, settle_pixels = t_settle, pixels_per_datapoint = t_int, modulators = modulators, post_sweep_outputs = post_sweep_outputs,
-                    tia_gain_V_per_pA = tia_gain_V_per_pA, insert_parameter = insert_parameter, return_type = "conductance", tia_corrections = tia_corrections,
-                    abort_callback = self.check_abort_request, data_callback = self.data_array.emit, channel_names_callback = channel_names_callback)
-            case "z":
-                x_axis_label = "tip height (nm)"
-                x_units = "nm"
-                if spec_button_states.get("z_retrace", False): x_values = np.concatenate((x_values, x_values[::-1]))
-                x_axis_info = {"z start (nm)": x_start, "z end (nm)": x_end, "dz (nm)": dx, "z steps": x_steps}
-                
-                raise Exception("Experiment not yet implemented")
-            case "f":
-                x_axis_label = "frequency (Hz)"
-                x_units = "Hz"
-                if spec_button_states.get("f_retrace", False): x_values = np.concatenate((x_values, x_values[::-1]))
-                x_axis_info = {"f start (Hz)": x_start, "f end (Hz)": x_end, "df (Hz)": dx, "f steps": x_steps}
-                
-                x_measurement = lambda insert_parameter, channel_names_callback: mla.frequency_sweep(
-                    x_values, settle_pixels = t_settle, pixels_per_datapoint = t_int, modulators = modulators, post_sweep_outputs = post_sweep_outputs,
-                    tia_gain_V_per_pA = tia_gain_V_per_pA, insert_parameter = insert_parameter, tia_corrections = tia_corrections,
-                    abort_callback = self.check_abort_request, data_callback = self.data_array.emit, channel_names_callback = channel_names_callback)
-            case "amp":
-                x_axis_label = "amplitude (mV)"
-                x_units = "mV"
-                if spec_button_states.get("amp_retrace", False): x_values = np.concatenate((x_values, x_values[::-1]))
-                x_axis_info = {"amp start (mV)": x_start, "amp end (mV)": x_end, "damp (mV)": dx, "amp steps": x_steps}
-                
-                x_measurement = lambda insert_parameter, channel_names_callback: mla.amplitude_sweep(
-                    x_values, settle_pixels = t_settle, pixels_per_datapoint = t_int, modulators = modulators, post_sweep_outputs = post_sweep_outputs,
-                    tia_gain_V_per_pA = tia_gain_V_per_pA, insert_parameter = insert_parameter, tia_corrections = tia_corrections,
-                    abort_callback = self.check_abort_request, data_callback = self.data_array.emit, channel_names_callback = channel_names_callback)
-            case "V_keithley":
-                x_axis_label = "V_Keithley (V)"
-                x_units = "V"
-                if spec_button_states.get("V_keithley_retrace", False): x_values = np.concatenate((x_values, x_values[::-1]))
-                x_axis_info = {"V_Keithley start (V)": x_start, "V_Keithley end (V)": x_end, "dV_Keithley (mV)": dx, "V_Keithley steps": x_steps}
-                
-                raise Exception("Experiment not yet implemented")
-            case _: # No parameter to sweep on the x-axis. Resort to a single point measurement
-                raise Exception("0D spectroscopy not implemented")
-
-        if not isinstance(x_values, np.ndarray): raise Exception("No parameter selected to sweep on the x axis. Aborting experiment")
         
-
-                
-        # Write MLA metadata and set up the sweep group and its x axis
-        self.output_file.attrs.update({"x axis": x_axis_label} | x_axis_info)
+        # Write MLA metadata
         mla_group = self.output_file.create_group("MLA")
         mla_group.attrs.update({"MLA time constant (ms)": time_constant_dict.get("tm (ms)", ""), "MLA df (Hz)": time_constant_dict.get("df (Hz)", ""), "V_port1 (V)": mla_bias.get("port_1 (V)", 0), "V_port2 (V)": mla_bias.get("port_2 (V)", 0),
-                                "f / df": 1, "settling time (1 / df)": 1, "pixels per datapoint (1 / df)": t_int, "intermediate_feedback": intermediate_feedback, "spectroscopy_feedback": spectroscopy_feedback})
+                                "f / df": 1, "settling time (1 / df)": t_settle, "pixels per datapoint (1 / df)": t_int, "target relative error (%)": rel_error_percent, "max pixels per datapoint (1 / df)": max(int(t_max), t_int), "intermediate_feedback": intermediate_feedback, "spectroscopy_feedback": spectroscopy_feedback})
         mla_settings_ds = mla_group.create_dataset("MLA settings", data = mla_setup_array)
         mla_channels_ds = mla_group.create_dataset("MLA setup parameters", data = mla_array_channels)
         mla_channels_ds.make_scale("MLA setup parameters")
         mla_settings_ds.dims[0].attach_scale(mla_channels_ds)
         
+        # Preallocate the sweep datasets, with dimensions (*axes, channels)
         sweep_group = self.output_file.create_group("sweep") # This is the main Nexus measurement group
         sweep_group.attrs.update({"NX_class": "NXdata", "signal": "sweep"})
-        
-        x_ds = sweep_group.create_dataset(x_axis_label, data = x_values)
-        x_ds.make_scale(x_axis_label)
-        
-        
-        
-        # y axis
-        y_values = None
-        y_units = None
-        y_axis_label = ""
-        y_ds = None
-        
-        [y_start, y_end, y_steps] = [spec_line_edits.get(key) for key in ["y_start", "y_end", "y_points"]]
-        if isinstance(y_start, int | float) and isinstance(y_end, int | float):
-            y_values = np.linspace(y_start, y_end, y_steps)
-            dy = (y_end - y_start) / (y_steps - 1)
-        
-        self.parameters.emit({"dict_name": "view_request", "view": "graph"})        
-        match spec_button_states["y_axis"]:
-            case "V":
-                y_axis_label = "voltage (V)"
-                if spec_button_states.get("V_retrace", False): y_values = np.concatenate((y_values, y_values[::-1]))
-                y_axis_info = {"V start (V)": y_start, "V end (V)": y_end, "dV (V)": dy, "steps": y_steps}
-                
-                # Set to the first value of the y parameter sweep, then do the first measurement
-                voltage = y_values[0]
-                
-                if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb) # The z step relative to the feedback setpoint will automatically switch the feedback off
-                if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                else: nn.tip_update({"feedback": False})
-
-                mla.bias_update({"port_1 (V)": voltage}, verbose = False)
-                (single_sweep_array, single_sweep_error_array, channel_names) = x_measurement(insert_parameter = ("voltage (V)", voltage), channel_names_callback = self.data_array.emit)
-            
-            case "z":
-                y_axis_label = "tip height (nm)"
-                if spec_button_states.get("z_retrace", False): y_values = np.concatenate((y_values, y_values[::-1]))                
-                y_axis_info = {"z start (nm)": y_start, "z end (nm)": y_end, "dz (nm)": dy, "steps": y_steps}
-                
-                # Set to the first value of the y parameter sweep, then do the first measurement
-                tip_height = y_values[0]
-                
-                if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb) # The z step relative to the feedback setpoint will automatically switch the feedback off
-                if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                else: nn.tip_update({"feedback": False})
-
-                nn.tip_update({"feedback": False, "z_rel (nm)": tip_height}, verbose = False)
-                (single_sweep_array, single_sweep_error_array, channel_names) = x_measurement(insert_parameter = ("z (nm)", tip_height), channel_names_callback = self.data_array.emit)
-            
-            case "f":
-                y_axis_label = "frequency (Hz)"
-                if spec_button_states.get("f_retrace", False): y_values = np.concatenate((y_values, y_values[::-1]))
-                y_axis_info = {"f start (Hz)": y_start, "f end (Hz)": y_end, "df (Hz)": dy, "steps": y_steps}
-                
-                # Set to the first value of the y parameter sweep, then do the first measurement
-                f_Hz = y_values[0]
-                
-                if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb) # The z step relative to the feedback setpoint will automatically switch the feedback off
-                if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                else: nn.tip_update({"feedback": False})
-                
-                mla.lockin_update({"df (Hz)": f_Hz, "numbers": [1, 1, 2, 3]}, verbose = False)
-                (single_sweep_array, single_sweep_error_array, channel_names) = x_measurement(insert_parameter = ("frequency (Hz)", f_Hz), channel_names_callback = self.data_array.emit)
-            
-            case "amp":
-                y_axis_label = "amplitude (mV)"
-                if spec_button_states.get("amp_retrace", False): y_values = np.concatenate((y_values, y_values[::-1]))
-                y_axis_info = {"amp start (mV)": y_start, "amp end (mV)": y_end, "damp (mV)": dy, "steps": y_steps}
-                
-                # Set to the first value of the y parameter sweep, then do the first measurement
-                amp_mV = y_values[0]
-                
-                if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb) # The z step relative to the feedback setpoint will automatically switch the feedback off
-                if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                else: nn.tip_update({"feedback": False})
-                
-                mla.amplitudes_update({"amplitudes (mV)": {0: amp_mV}}, verbose = False)
-                (single_sweep_array, single_sweep_error_array, channel_names) = x_measurement(insert_parameter = ("amplitude (mV)", amp_mV), channel_names_callback = self.data_array.emit)
-            
-            case _: # No parameter on the y axis. Perform a 1D sweep instead. Then cast the data to a 2D sweep dataset
-                if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb) # The z step relative to the feedback setpoint will automatically switch the feedback off
-                if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                else: nn.tip_update({"feedback": False})
-                
-                (single_sweep_array, single_sweep_error_array, channel_names) = x_measurement(insert_parameter = None, channel_names_callback = self.data_array.emit)
-                                
-                # Experiment finished; clean up
-                self.exp_progress.emit(100)
-                mla.outputs_update({"output_masks": mla_output_masks}, verbose = False)
-                mla.start_lockin()
-                mla.get_pixels(3)
-                mla.stop_lockin()
-                nn.tip_update({"feedback": start_feedback}, verbose = False)
-                
-                # Save 1D sweep data
-                sweep_ds = sweep_group.create_dataset("sweep", data = single_sweep_array, dtype = np.float32)
-                error_ds = sweep_group.create_dataset("sweep_errors", data = single_sweep_error_array, dtype = np.float32)
-                channels_ds = sweep_group.create_dataset("channel", data = np.array([item.encode("utf-8") for item in channel_names]), dtype = h5string)
-                channels_ds.make_scale("channel") # When loaded into Scantelligent, the channel indices dataset attached to the main dataset axis will be exchanged for the channel dataset
-                channel_indices_ds = sweep_group.create_dataset("channel indices", data = np.arange(len(channel_names), dtype = np.int32))
-                channel_indices_ds.make_scale("channel indices")
-                
-                [sweep_ds.dims[dim].attach_scale(dataset) for dim, dataset in enumerate ([x_ds, channel_indices_ds])]
-                [error_ds.dims[dim].attach_scale(dataset) for dim, dataset in enumerate ([x_ds, channel_indices_ds])]
-
-                sweep_group.attrs.update({"axes": [x_axis_label, "channel indices"]})
-                return
-        
-        # Everything below is for 2D measurements only. 1D sweeps have already returned at this point
-        y_ds = self.output_file.create_dataset(y_axis_label, shape = (0,), maxshape = (len(y_values),), dtype = float) # The y axis dataset will grow along with the measurement dataset after every sweep
-        y_ds.make_scale(y_axis_label)
-        self.output_file.attrs.update({"y axis": y_axis_label} | y_axis_info)
-
-
-
-        # Create the measurement array and the hdf5 dataset, using the data from the first sweep
-        dataset_shape = (len(channel_names),) + single_sweep_array.shape
-        sweep_ds = sweep_group.create_dataset("sweep", shape = (0,) + single_sweep_array.shape, maxshape = dataset_shape, dtype = np.float32)
-        error_ds = sweep_group.create_dataset("sweep_errors", shape = (0,) + single_sweep_array.shape, maxshape = dataset_shape, dtype = np.float32)
-        channels_ds = sweep_group.create_dataset("channel", data = np.array([item.encode("utf-8") for item in channel_names]), dtype = h5string) # z axis (channels)
-        channels_ds.make_scale("channel")
+        axis_datasets = []
+        for axis in axes:
+            if adaptive: axis_ds = self.file_functions.create_hdf5_dataset(sweep_group, axis.name, shape = (0,), dtype = axis.values.dtype, layout = None, maxshape = (None,)) # The sorted points are written as they are measured
+            else: axis_ds = sweep_group.create_dataset(axis.name, data = axis.values)
+            axis_ds.make_scale(axis.name)
+            axis_datasets.append(axis_ds)
+        if adaptive: (shape, maxshape) = ((0, len(channel_names)), (None, len(channel_names))) # Resizable along the non-uniform points
+        else: (shape, maxshape) = (tuple(len(axis) for axis in axes) + (len(channel_names),), None)
+        sweep_ds = self.file_functions.create_hdf5_dataset(sweep_group, "sweep", shape = shape, dtype = np.float32, layout = "sweep", maxshape = maxshape)
+        error_ds = self.file_functions.create_hdf5_dataset(sweep_group, "sweep_errors", shape = shape, dtype = np.float32, layout = "sweep", maxshape = maxshape)
+        channels_ds = sweep_group.create_dataset("channel", data = np.array([item.encode("utf-8") for item in channel_names]), dtype = h5string)
+        channels_ds.make_scale("channel") # When loaded into Scantelligent, the channel indices dataset attached to the main dataset axis will be exchanged for the channel dataset
         channel_indices_ds = sweep_group.create_dataset("channel indices", data = np.arange(len(channel_names), dtype = np.int32))
         channel_indices_ds.make_scale("channel indices")
+        [sweep_ds.dims[dim].attach_scale(dataset) for dim, dataset in enumerate(axis_datasets + [channel_indices_ds])]
+        [error_ds.dims[dim].attach_scale(dataset) for dim, dataset in enumerate(axis_datasets + [channel_indices_ds])]
+        sweep_group.attrs.update({"axes": [axis.name for axis in axes] + ["channel indices"]})
+        if adaptive: sweep_group.attrs.update({"adaptive sampling (max points)": adaptive.get("points")})
         
-        [sweep_ds.dims[dim].attach_scale(dataset) for dim, dataset in enumerate([y_ds, x_ds, channel_indices_ds])]
-        [error_ds.dims[dim].attach_scale(dataset) for dim, dataset in enumerate([y_ds, x_ds, channel_indices_ds])]
-
-        sweep_group.attrs.update({"axes": ["channel indices", y_axis_label, x_axis_label]})
-
-
-
-        # Perform the 2D sweep
-        n_total = len(y_values)
-        match y_axis_label:
-            case "voltage (V)": # Experiments that sweep along one parameter while slowly ramping the bias
-                self.add_data_to_datasets(single_sweep_array, single_sweep_error_array, sweep_ds, error_ds, y_ds, 0, parameter = voltage) # Save the first sweep
-                
-                for index, voltage in enumerate(y_values):
-                    self.exp_progress.emit(int(100 * index / n_total))
-                    
-                    if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb)
-                    if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                    elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                    else: nn.tip_update({"feedback": False})
-                    mla.bias_update({"port_1 (V)": voltage}, verbose = False)                    
-                    if blank_modulators: mla.outputs_update({"output_masks": mla_output_masks})
-                    
-                    (single_sweep_array, single_sweep_error_array, sweep_channel_names) = x_measurement(insert_parameter = ("voltage (V)", voltage), channel_names_callback = None)
-                    self.add_data_to_datasets(single_sweep_array, single_sweep_error_array, sweep_ds, error_ds, y_ds, index, parameter = voltage)
+        
+        
+        # Conversion of the lock-in pixels of a point to channels
+        n_harmonics = len(numbers) - 1
+        axis_names = [axis.name for axis in axes]
+        def process(index: tuple, values: list, pix_V: np.ndarray, pix_V_std_dev: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            df = values[axis_names.index("frequency (Hz)")] if "frequency (Hz)" in axis_names else time_constant_dict.get("df (Hz)")
+            mod_voltage_mV = values[axis_names.index("amplitude (mV)")] if "amplitude (mV)" in axis_names else amplitudes_mV[0]
+            (pix_V, pix_V_std_dev) = mla.correct_tia(pix_V, pix_V_std_dev, numbers * df, tia_corrections)
             
-            case "amplitude (mV)":
-                self.add_data_to_datasets(single_sweep_array, single_sweep_error_array, sweep_ds, error_ds, y_ds, 0, parameter = amp_mV) # Save the first sweep
-                
-                for index, amp_mV in enumerate(y_values):
-                    self.exp_progress.emit(int(100 * index / n_total))
-                    
-                    if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb)
-                    if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                    elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                    else: nn.tip_update({"feedback": False})
-                    mla.amplitudes_update({"amplitudes (mV)": {0: amp_mV}}, verbose = False)
-                    if blank_modulators: mla.outputs_update({"output_masks": mla_output_masks})
-                    
-                    (single_sweep_array, single_sweep_error_array, sweep_channel_names) = x_measurement(insert_parameter = ("amplitude (mV)", amp_mV), channel_names_callback = None)
-                    self.add_data_to_datasets(single_sweep_array, single_sweep_error_array, sweep_ds, error_ds, y_ds, index, parameter = amp_mV)
-
-            case "frequency (Hz)":
-                self.add_data_to_datasets(single_sweep_array, single_sweep_error_array, sweep_ds, error_ds, y_ds, 0, parameter = f_Hz) # Save the first sweep
-                
-                for index, f_Hz in enumerate(y_values):
-                    self.exp_progress.emit(int(100 * index / n_total))
-                    mla.time_constant_update({"df (Hz)": f_Hz}, verbose = False)
-                    numbers = np.arange(0, 32)
-                    numbers[0] = 1
-                    
-                    if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb)
-                    if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}) # Feedback unchanged: switch it back on if it was on when the experiment was started
-                    elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True})
-                    else: nn.tip_update({"feedback": False})
-                    mla.frequencies_update({"numbers": numbers})
-                    if blank_modulators: mla.outputs_update({"output_masks": mla_output_masks})
-                    
-                    (single_sweep_array, single_sweep_error_array, sweep_channel_names) = x_measurement(insert_parameter = ("frequency (Hz)", f_Hz), channel_names_callback = None)
-                    self.add_data_to_datasets(single_sweep_array, single_sweep_error_array, sweep_ds, error_ds, y_ds, index, parameter = f_Hz)
+            harmonics_V = np.column_stack((np.real(pix_V[1:]), np.imag(pix_V[1:]))).ravel() # Interleaved real and imaginary parts
+            errors_V = np.column_stack((pix_V_std_dev[1:], np.zeros(n_harmonics))).ravel()
+            if tia_gain_V_per_pA > 1E-12: # Conductance. It diverges for zero modulation bias; replace it with zero
+                scale = 2 / (tia_gain_V_per_pA * mod_voltage_mV) if mod_voltage_mV > 1E-3 else 0
+            else: scale = 2000
             
-            case _:
-                raise Exception("This experiment is not yet implemented")
-    
-        self.exp_progress.emit(100) # Experiment finished
-        mla.outputs_update({"output_masks": mla_output_masks}, verbose = False)
-        mla.start_lockin()
-        mla.get_pixels(3)
-        mla.stop_lockin()
-        nn.tip_update({"feedback": start_feedback}, verbose = False)
+            data_chunk = np.concatenate(([value for value in values if np.ndim(value) == 0], [2000 * np.abs(pix_V[0])], scale * harmonics_V))
+            error_chunk = np.concatenate((np.zeros(n_channels - 2 * n_harmonics), scale * errors_V))
+            return (data_chunk.astype(np.float32), error_chunk.astype(np.float32))
+        
+        # Feedback between lines, with the modulators blanked if requested
+        measurement_output_masks = np.copy(mla_output_masks)
+        measurement_output_masks[0, modulators] = 1
+        def line_callback(index: tuple) -> None:
+            if blank_modulators: mla.transaction().set_output_masks(mla_output_masks).commit()
+            if intermediate_feedback: self.intermediate_feedback(V_fb, I_fb, p_gain_fb, t_const_fb, t_fb, z_fb) # The z step relative to the feedback setpoint will automatically switch the feedback off
+            if spectroscopy_feedback == "unchanged": nn.tip_update({"feedback": start_feedback}, verbose = False) # Feedback unchanged: switch it back on if it was on when the experiment was started
+            elif spectroscopy_feedback == "on": nn.tip_update({"feedback": True}, verbose = False)
+            else: nn.tip_update({"feedback": False}, verbose = False)
+            if blank_modulators: mla.transaction().set_output_masks(measurement_output_masks).commit()
+            return
+        
+        def line_done_callback(line: int) -> None: # In adaptive mode, line is the index of the last point that was written
+            self.mark_valid(sweep_ds, line)
+            self.exp_progress.emit(int(100 * (line + 1) / progress_steps))
+            return
+        
+        sweep = nd_sweep.NDSweep(axes, mla, process, n_channels, settle_pixels = t_settle, pixels_per_datapoint = t_int, abort_callback = self.check_abort_request, data_callback = self.data_array.emit,
+                                 line_callback = line_callback, line_done_callback = line_done_callback, write = self.write, resize = self.resize, integration = integration, adaptive = adaptive)
+        progress_steps = adaptive.get("points") if adaptive else sweep.n_lines
+        self.file_functions.create_hdf5_progress(sweep_group, steps = progress_steps)
+        self.start_swmr() # The file structure is complete. From here on, the sweeps can be read live
+        
+        
+        
+        # Perform the sweep
+        mla.transaction().set_output_masks(measurement_output_masks).commit()
+        try:
+            sweep.run(sweep_ds, error_ds, axis_datasets[0])
+            if adaptive: self.mark_valid(sweep_ds, progress_steps - 1) # The sampler may finish below the maximum number of points
+        finally:
+            # Experiment finished or aborted; clean up
+            mla.transaction().set_output_masks(np.zeros_like(mla_output_masks) if blank_modulators else mla_output_masks).commit()
+            mla.lockin_update(verbose = False) # The sweep bypasses the update methods; read back and broadcast the final lock-in state
+            mla.get_pixels(3)
+            mla.stop_lockin()
+            nn.tip_update({"feedback": start_feedback}, verbose = False)
+        self.exp_progress.emit(100)
 
 
 
@@ -339,14 +203,3 @@ class Experiment(BaseExperiment):
         except:
             pass
         return
-
-    def add_data_to_datasets(self, single_sweep_array, single_sweep_error_array, measurement_ds, error_ds, y_ds, index, parameter) -> None:
-        measurement_ds.resize((index + 1,) + single_sweep_array.shape)
-        error_ds.resize((index + 1,) + single_sweep_array.shape)
-        y_ds.resize((index + 1,))
-        
-        measurement_ds[index, :, :] = single_sweep_array
-        error_ds[index, :, :] = single_sweep_error_array
-        y_ds[index] = parameter
-        return
-
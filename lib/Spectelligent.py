@@ -515,10 +515,12 @@ class Spectelligent(QtCore.QObject):
                 # Pass the parameters from the gui to the experiment
                 spec_line_edits = {}
                 [spec_line_edits.update({f"{quantity}_{key}": self.gui.line_edits[f"sts_{quantity}_{key}"].getValue() for key in ["start", "end", "points"]}) for quantity in ["V", "f", "z", "amp", "V_keithley"]]
-                [spec_line_edits.update({f"t_{key}": self.gui.line_edits[f"sts_t_{key}"].getValue() for key in ["settle", "int"]})]
+                [spec_line_edits.update({f"t_{key}": self.gui.line_edits[f"sts_t_{key}"].getValue() for key in ["settle", "int", "max"]})]
+                spec_line_edits.update({key: self.gui.line_edits[f"sts_{key}"].getValue() for key in ["rel_error", "adaptive_points"]})
                 spec_buttons = {}
                 [spec_buttons.update({f"{quantity}": self.gui.buttons[f"sts_{quantity}"].state_name}) for quantity in ["V", "f", "z", "amp", "V_keithley"]]
                 spec_buttons.update({"nanonis_mla": self.gui.buttons["nanonis_mla"].state_name})
+                spec_buttons.update({key: self.gui.buttons[f"sts_{key}"].isChecked() for key in ["snake", "adaptive"]})
                 
                 gui_parameters = {"combobox": self.gui.comboboxes["direction"].currentText(),
                                   "line_edits": [self.gui.line_edits[f"experiment_{index}"].getValue() for index in range(9)],
@@ -7,8 +7,23 @@ from .api_nanonis import NanonisAPI
 from .api_camera import CameraAPI
 from .api_keithley import KeithleyAPI
 from .api_mla import MLAAPI
+from .tia_correction import TIACorrection
+from .taylor_reconstruction import TaylorReconstruction
+from .mla_transaction import MLATransaction
+from .pixel_stream import PixelStream
+from .sweep_engine import SweepEngine
+from .nd_sweep import NDSweep, SweepAxis
+from .adaptive_sampling import AdaptiveSampler
+from .lut_service import LUTService
 from .audio_generator import AudioGenerator
 from .data_processing import DataProcessing
+from .colorization import Colorizer
 from .file_functions import FileFunctions
+from .hdf5_writer import HDF5Writer
+from .nexus_converter import NexusConverter
+from .processing_service import ProcessingService
+from .file_loader import FileLoader
+from .item_cache import ItemCache
 from .parameter_manager import ParameterManager, UserData
+from .parameter_broadcaster import ParameterBroadcaster, values_equal
 from .base_experiment import BaseExperiment, AbortedError
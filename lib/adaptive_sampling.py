@@ -0,0 +1,98 @@
+import time
+import numpy as np
+
+
+
+class AdaptiveSampler:
+    """
+    Chooses the points of a 1D sweep adaptively. The sweep starts on a coarse uniform grid; after every batch, the interval loss is estimated and new points are placed in the middle of the intervals with the largest loss, until the point or time budget is spent
+    The loss of an interval is flat_weight times its normalized width plus the normalized curvature of its end points. The curvature at a point is the deviation of its value from the straight line through its neighbours, minus twice its noise, normalized to the range of the channel and maximized over the channels. The deviation shrinks with the square of the point spacing, so steps and resonances are refined until they are resolved, while flat or noisy regions keep their coarse density
+    Usage: x = sampler.initial(); then repeatedly measure x, call sampler.tell(x, data, errors) and x = sampler.ask(), until x is empty
+    """
+    def __init__(self, x_start: float, x_end: float, coarse_points: int = 11, max_points: int = 101, max_time_s: float = None, resolution: float = 0, batch_size: int = None, flat_weight: float = .05, channels: list = None, noise_scale: float = 1):
+        self.x_start = x_start
+        self.x_end = x_end
+        self.coarse_points = max(int(coarse_points), 3)
+        self.max_points = max(int(max_points), self.coarse_points)
+        self.max_time_s = max_time_s
+        self.resolution = resolution # Minimum distance between points. New points are rounded to multiples of resolution (for example 1 Hz for df)
+        self.batch_size = batch_size if batch_size else max(self.coarse_points // 2, 1)
+        self.flat_weight = flat_weight
+        self.channels = channels # Data columns that steer the refinement; all columns if None
+        self.noise_scale = noise_scale # Converts the errors passed to tell() to the noise of the data, for example 1 / sqrt(pixels) for the standard deviation of the pixels of a point
+        self.t_start = None
+        self.x = np.empty(0)
+        self.data = None
+        self.errors = None
+
+    def snap(self, x: np.ndarray) -> np.ndarray:
+        if self.resolution > 0: x = np.round(np.asarray(x) / self.resolution) * self.resolution
+        return np.unique(x)
+
+    def initial(self) -> np.ndarray:
+        self.t_start = time.perf_counter()
+        x = self.snap(np.linspace(self.x_start, self.x_end, self.coarse_points))
+        if self.x_end < self.x_start: x = x[::-1] # Keep the sweep direction
+        return x
+
+    def tell(self, x: np.ndarray, data: np.ndarray, errors: np.ndarray = None) -> None:
+        """
+        Adds measured points. data and errors have one row per point
+        """
+        data = np.asarray(data, dtype = float)
+        errors = np.zeros_like(data) if errors is None else np.asarray(errors, dtype = float)
+        if self.data is None: (self.data, self.errors) = (np.empty((0, data.shape[1])), np.empty((0, data.shape[1])))
+
+        x = np.concatenate((self.x, x))
+        order = np.argsort(x, kind = "stable")
+        self.x = x[order]
+        self.data = np.concatenate((self.data, data))[order]
+        self.errors = np.concatenate((self.errors, errors))[order]
+        return
+
+    def losses(self) -> np.ndarray:
+        """
+        Loss of each of the len(x) - 1 intervals between the sorted points
+        """
+        (x, y, sigma) = (self.x, self.data, self.errors)
+        if self.channels is not None: (y, sigma) = (y[:, self.channels], sigma[:, self.channels])
+        span = np.ptp(x) if len(x) > 1 else 1
+        if len(x) < 3 or span == 0: return np.full(max(len(x) - 1, 0), np.inf)
+
+        # Deviation of every interior point from the line through its neighbours
+        (x0, x1, x2) = (x[:-2, None], x[1:-1, None], x[2:, None])
+        weight = (x1 - x0) / (x2 - x0)
+        deviation = np.abs(y[1:-1] - ((1 - weight) * y[:-2] + weight * y[2:]))
+        deviation = np.fmax(deviation - 2 * self.noise_scale * sigma[1:-1], 0)
+        y_range = np.nanmax(y, axis = 0) - np.nanmin(y, axis = 0)
+        y_range[~(y_range > 0)] = np.inf
+        curvature = np.nanmax(deviation / y_range, axis = 1)
+        curvature = np.concatenate(([0], curvature, [0]))
+
+        interval_curvature = np.fmax(curvature[:-1], curvature[1:]) # An interval inherits the curvature of both of its end points
+        return self.flat_weight * np.diff(x) / span + interval_curvature
+
+    def ask(self) -> np.ndarray:
+        """
+        The next batch of points, sorted in the sweep direction. Empty when the budget is spent or no interval can be split further
+        """
+        remaining = self.max_points - len(self.x)
+        if remaining <= 0 or len(self.x) < 2: return np.empty(0)
+        if self.max_time_s is not None and time.perf_counter() - self.t_start > self.max_time_s: return np.empty(0)
+
+        losses = self.losses()
+        widths = np.diff(self.x)
+        losses[widths < 2 * self.resolution] = -np.inf # Intervals that cannot be split anymore
+        candidates = np.argsort(losses)[::-1][: min(self.batch_size, remaining)]
+        candidates = candidates[losses[candidates] > -np.inf]
+
+        x_new = self.snap(.5 * (self.x[candidates] + self.x[candidates + 1]))
+        x_new = x_new[~np.isin(x_new, self.x)]
+        if self.x_end < self.x_start: x_new = x_new[::-1]
+        return x_new
+
+    def result(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Sorted, non-uniform x, data and errors
+        """
+        return (self.x, self.data, self.errors)
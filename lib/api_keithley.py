@@ -1,3 +1,4 @@
+import time
 from PyQt6 import QtCore
 from pymeasure.instruments.keithley import Keithley2400
 import numpy as np
@@ -131,8 +132,19 @@ class KeithleyAPI(QtCore.QObject):
         
         return khw.source_mode
 
-    def set_V(self):
-        return
+    def set_V(self, V: float = 0, dV: float = .1, dt: float = .02) -> float:
+        """
+        Ramps the source voltage to V in steps of dV (V) every dt (s), like the bias slews of the MLA and Nanonis, so that the gate never jumps
+        """
+        khw = self.keithleyhw
+        V = float(np.clip(V, -self.V_max, self.V_max))
+        V_old = float(khw.source_voltage)
+        for V_t in np.arange(V_old, V, dV if V >= V_old else -dV)[1:]:
+            khw.source_voltage = V_t
+            time.sleep(dt)
+        khw.source_voltage = V # Final voltage
+        self.parameters.emit({"dict_name": "keithley_bias", "V_keithley (V)": V})
+        return V
 
     def get_I(self, buffer = None) -> float:
         khw = self.keithleyhw
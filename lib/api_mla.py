@@ -1,6 +1,11 @@
 import os, sys, time
 from PyQt6 import QtCore
 import numpy as np
+from .tia_correction import TIACorrection
+from .sweep_engine import SweepEngine
+from .adaptive_sampling import AdaptiveSampler
+from .mla_transaction import MLATransaction
+from .pixel_stream import PixelStream
 
 
 
@@ -11,7 +16,7 @@ class MLAAPI(QtCore.QObject):
     frequency = QtCore.pyqtSignal(float)
     task_progress = QtCore.pyqtSignal(int)
 
-    def __init__(self, hw_config: dict = {}, message_callback: object = None, status_callback: object = None, test_mode: bool = False):
+    def __init__(self, hw_config: dict = {}, message_callback: object = None, status_callback: object = None, test_mode: bool = False, simulate: bool = False):
         super().__init__()
 
         self.status_callback = lambda status: self.send_status(status) # Use a parameter dict to signal the status to ParameterManager
@@ -22,10 +27,19 @@ class MLAAPI(QtCore.QObject):
         self.test_mode = test_mode
         
         mla_path = False
-        if "mla" in hw_config.keys():
-            mla_dict = hw_config["mla"]
-            if "library_path" in mla_dict:
-                mla_path = mla_dict["library_path"]
+        mla_dict = hw_config.get("mla", {})
+        if isinstance(mla_dict, dict) and "library_path" in mla_dict: mla_path = mla_dict["library_path"]
+        self.stream = None
+        self.stream_settings = mla_dict.get("stream", None) if isinstance(mla_dict, dict) else None # Continuous pixel acquisition while the lock-in runs, for example 'stream: {capacity: 65536, block: 4}' in the mla section of the config file; see start_stream()
+        
+        # Simulated instrument, for working and benchmarking without the MLA. Enable with simulate = True or with 'simulate: true' in the mla section of the config file
+        if simulate or (isinstance(mla_dict, dict) and mla_dict.get("simulate", False)):
+            from .mla_simulator import SimulatedMLA
+            self.mla_path = None
+            self.mla = SimulatedMLA(mla_dict.get("simulation", {}) if isinstance(mla_dict, dict) else {})
+            self.lockin_running = False
+            self.parameters_init()
+            return
         
         if not isinstance(mla_path, str): raise Exception("Could not read the MLA library path")
         if not os.path.isdir(mla_path): raise Exception("The library path provided does not point to a valid folder")
@@ -50,6 +64,9 @@ class MLAAPI(QtCore.QObject):
         self.V = [0, 0]
         self.output_masks = np.zeros((2, 32), dtype = int)
         self.input_mask = np.zeros((32), dtype = int)
+        self.tia_correction = TIACorrection() # Caches the correction vector of the active tones
+        self.shadow = {} # Last known df and tone settings of the lock-in; see shadow_state()
+        self.active_transaction = None # Set while a transaction is used as a context manager. The fast setters stage their changes on it
         self.status = "online"
         self.status_callback(self.status)
         return
@@ -93,15 +110,42 @@ class MLAAPI(QtCore.QObject):
         return self.lockin_update(verbose = verbose)
 
     def start_lockin(self) -> None:
+        if self.lockin_running and self.streaming: return # Restarting the lock-in would interrupt the stream
         self.lockin_running = True
         if not self.test_mode: self.mla.lockin.start_lockin()
+        if isinstance(self.stream_settings, dict): self.start_stream(**self.stream_settings)
         return
 
     def stop_lockin(self) -> None:
+        if self.stream is not None: self.stream.stop() # The stream resumes with the next start_lockin()
         self.lockin_running = False
         if not self.test_mode: self.mla.lockin.stop_lockin()
         return
 
+    @property
+    def streaming(self) -> bool:
+        return self.stream is not None and self.stream.running
+
+    def start_stream(self, capacity: int = 65536, block: int = 4, display_rate_Hz: float = 20) -> PixelStream:
+        """
+        Acquires pixels continuously on a background thread into the ring buffer of a PixelStream, for as long as the lock-in runs. get_pixels() then reads from the buffer, and the 'pixels' parameter dict is emitted with the average of the pixels at display_rate_Hz
+        """
+        self.stream_settings = {"capacity": capacity, "block": block, "display_rate_Hz": display_rate_Hz}
+        if self.test_mode: return None
+        if not self.lockin_running: self.start_lockin() # Starts the stream
+        if self.streaming: return self.stream
+
+        self.stream = PixelStream(self.mla.lockin, n_tones = self.mla.lockin.nr_input_freq, capacity = capacity, block = block, error_callback = lambda message: self.logprint(message, message_type = "error"))
+        self.stream.subscribe(lambda pix, timestamp: self.parameters.emit({"dict_name": "pixels", "pixels": pix}), decimation = max(int(self.df / display_rate_Hz), 1)) # Decimated for the display, instead of every requested block
+        self.stream.start()
+        return self.stream
+
+    def stop_stream(self) -> None:
+        self.stream_settings = None
+        if self.stream is not None: self.stream.stop()
+        self.stream = None
+        return
+
     def logprint(self, message_str: str = "", message_type: str = "error") -> None:
         self.message.emit(message_str, message_type)
         return
@@ -129,7 +173,10 @@ class MLAAPI(QtCore.QObject):
         return
 
     def reset_outputs(self) -> None:
-        try: self.mla.lockin.reset_outputs()
+        try:
+            self.mla.lockin.reset_outputs()
+            self.output_masks = np.zeros_like(self.output_masks)
+            self.V = [0, 0]
         except Exception as e:
             self.logprint(f"{e}")
         return
@@ -148,6 +195,7 @@ class MLAAPI(QtCore.QObject):
             self.parameters.emit({"dict_name": "pixels", "pixels": pix})
             return (pix, None)
         
+        if self.streaming: return self.read_stream(number = number, average = average, bessel_correct = bessel_correct, data_format = data_format, wait_for_new = wait_for_new)
         if wait_for_new: self.mla.lockin.wait_for_new_pixels(number)
         if data_format == "phase": (pix, _) = self.mla.lockin.get_pixels(number, data_format == "phase", unit = "deg")
         else: (pix, _) = self.mla.lockin.get_pixels(number)
@@ -159,10 +207,34 @@ class MLAAPI(QtCore.QObject):
         
         self.parameters.emit({"dict_name": "pixels", "pixels": pix})
         return (pix, pix_var)
+
+    def read_stream(self, number: int = 1, average: bool = False, bessel_correct: bool = True, data_format: str = "IQ", wait_for_new: bool = True) -> tuple[np.ndarray, None | np.ndarray]:
+        """
+        get_pixels() from the ring buffer of the pixel stream. Without averaging, the pixels are a view of the buffer that stays valid until the buffer wraps around
+        """
+        (pix, timestamps) = self.stream.get_pixels(number, wait_for_new = wait_for_new)
+        if data_format == "phase": pix = np.angle(pix, deg = True)
+
+        pix_var = None
+        if average:
+            pix_var = np.var(pix, axis = 1, ddof = int(bessel_correct))
+            pix = np.average(pix, axis = 1)
+        return (pix, pix_var)
     
     def get_phases(self, number_pixels: int = 1) -> np.ndarray:
         return self.get_pixels(number = number_pixels, average = True, data_format = "phase")
 
+    def correct_tia(self, pix: np.ndarray, pix_std_dev: np.ndarray, frequencies: np.ndarray, tia_corrections: np.ndarray | TIACorrection = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Applies the TIA correction to pixels of shape (tones,) or (tones, n). tia_corrections is a correction table or a TIACorrection; None means no correction
+        """
+        if tia_corrections is None: return (pix, pix_std_dev)
+        correction = tia_corrections
+        if not isinstance(correction, TIACorrection):
+            self.tia_correction.set_table(tia_corrections)
+            correction = self.tia_correction
+        return correction.apply(pix, pix_std_dev, frequencies)
+
     def set_DACs_ADCs_safe_range(self) -> None:
         # Set all analog inputs to the correct configuration (range = +-20 V)
         self.mla.hardware.set_input_relay(1, se = True, nodamp = False, term = False, dc = True, gain = False, bypass = False, gain2 = False, event = True)
@@ -187,10 +259,9 @@ class MLAAPI(QtCore.QObject):
         self.mla.lockin.set_input_multiplexer(port_array)
         return
 
-    def set_output_masks(self, output_masks: np.ndarray | list) -> None:
+    def set_output_masks(self, output_masks: np.ndarray | list, ports: list = [1, 2], wait_for_effect: bool = True) -> None:
         if len(output_masks) == 2:
-            self.mla.lockin.set_output_mask(output_masks[0], port = 1, wait_for_effect = True)
-            self.mla.lockin.set_output_mask(output_masks[1], port = 2, wait_for_effect = True)
+            for index, port in enumerate(ports): self.mla.lockin.set_output_mask(output_masks[port - 1], port = port, wait_for_effect = wait_for_effect and index == len(ports) - 1) # Wait for the effect once, after the last port
         else:
             self.logprint("Output masks have the wrong shape")
         return
@@ -199,24 +270,59 @@ class MLAAPI(QtCore.QObject):
         self.mla.lockin.set_dc_offset(port = port, value = value)
         return
 
-    def autophase(self, amplitude_mV: float = 500, verbose: bool = False) -> None:
-        (amplitudes_dict, error) = self.amplitudes_update(verbose = False)
-        if isinstance(amplitude_mV, float | int): self.amplitudes_update({"amplitudes (mV)": {0: amplitude_mV}}, verbose = verbose)
-        self.outputs_update({"mod0": {"port": 1, "on": True}, "blank": True}, verbose = False)
+    # Fast setters for sweeps. Unlike the update methods, these do not read the settings back or broadcast them. Inside a transaction context, the changes are staged on the transaction instead of sent
+    def set_tones(self, df: float, numbers: np.ndarray, wait_for_effect: bool = True) -> np.ndarray:
+        """
+        Sets df and places the tones on the given multiples of df. Returns the tone frequencies (Hz)
+        """
+        transaction = self.active_transaction or self.transaction(wait_for_effect = wait_for_effect, broadcast = False)
+        transaction.set_tones(df, numbers)
+        if transaction is not self.active_transaction:
+            (changes, error) = transaction.commit()
+            if error: raise Exception(error)
+        return np.asarray(numbers, dtype = float) * df
 
-        (phases_dict, error) = self.phases_update(verbose = False)
-        phases = phases_dict.get("phases (deg)")
+    def set_amplitudes(self, amplitudes_mV: np.ndarray, wait_for_effect: bool = True) -> None:
+        transaction = self.active_transaction or self.transaction(wait_for_effect = wait_for_effect, broadcast = False)
+        transaction.set_amplitudes(amplitudes_mV)
+        if transaction is not self.active_transaction:
+            (changes, error) = transaction.commit()
+            if error: raise Exception(error)
+        return
+
+    def ramp_bias(self, port: int = 1, value: float = 0, dV: float = .01, dt: float = .005) -> None:
+        if self.active_transaction: self.active_transaction.set_bias(port = port, value = value)
+        else: self.slew_bias(port = port, value = value, dV = dV, dt = dt)
+        return
+
+    def slew_bias(self, port: int = 1, value: float = 0, dV: float = .01, dt: float = .005) -> None:
+        """
+        Slews the bias of a port to value in steps of dV (V) every dt (s), as bias_update does
+        """
+        if not self.test_mode:
+            for V_t in np.arange(self.V[port - 1], value, dV if value >= self.V[port - 1] else -dV)[1:]:
+                self.set_bias(port = port, value = V_t)
+                time.sleep(dt)
+            self.set_bias(port = port, value = value)
+        self.V[port - 1] = value
+        return
+
+    def autophase(self, amplitude_mV: float = 500, verbose: bool = False) -> None:
+        start_state = self.shadow_state(["amplitudes (mV)", "phases (deg)"])
+        transaction = self.transaction(verbose = verbose).set_modulator(0, port = 1, blank = True)
+        if isinstance(amplitude_mV, float | int): transaction.set_amplitudes({0: amplitude_mV})
+        transaction.commit()
+        phases = start_state.get("phases (deg)")
 
         self.start_lockin()
         for iteration in range(3):
             (pix, pix_var) = self.get_pixels(12, average = True, wait_for_new = True)
             measured_phases = np.rad2deg(np.angle(pix))
             delta_phase = 90 - measured_phases[1]
-            drive_phase = phases[0] + delta_phase
-            (phases_dict, error) = self.phases_update({"phases (deg)": {0: drive_phase}}, verbose = verbose)
-            phases = phases_dict.get("phases (deg)")
+            phases[0] = (phases[0] + delta_phase + 180) % 360 - 180
+            self.transaction(verbose = verbose).set_phases({0: phases[0]}).commit()
                 
-        self.amplitudes_update({"amplitudes (mV)": amplitudes_dict.get("amplitudes (mV)")}, verbose = False)
+        self.transaction().set_amplitudes(start_state.get("amplitudes (mV)")).commit()
         self.get_pixels(3, average = True, wait_for_new = True)
         self.stop_lockin()
         return
@@ -229,6 +335,87 @@ class MLAAPI(QtCore.QObject):
 
 
 
+    # Shadow state and configuration transactions
+    shadow_groups = {"df (Hz)": ["time_constant", "frequencies"], "frequencies (Hz)": ["frequencies"], "phases (deg)": ["phases"], "amplitudes (mV)": ["amplitudes"], "output_masks": ["outputs"], "input_mask": ["inputs"], "port_1 (V)": ["mla_bias"], "port_2 (V)": ["mla_bias"]}
+
+    def transaction(self, wait_for_effect: bool = True, broadcast: bool = True, verbose: bool = False) -> MLATransaction:
+        """
+        Starts a configuration transaction: stage several changes and send them with one commit, which only sends the fields that differ from the shadow state and waits for the effect once
+        """
+        return MLATransaction(self, wait_for_effect = wait_for_effect, broadcast = broadcast, verbose = verbose)
+
+    def shadow_state(self, keys: list = None) -> dict:
+        """
+        Last known configuration of the lock-in (copies). Tone settings that were never written or read are read from the instrument once. The output masks, input mask and bias are tracked in self.output_masks, self.input_mask and self.V
+        """
+        if keys is None: keys = list(self.shadow_groups.keys())
+        for key in [key for key in keys if key in ["df (Hz)", "frequencies (Hz)", "phases (deg)", "amplitudes (mV)"] and not key in self.shadow]:
+            if self.test_mode:
+                match key:
+                    case "df (Hz)": value = self.df
+                    case "frequencies (Hz)": value = np.arange(32) * self.df
+                    case _: value = np.zeros(32)
+            else:
+                match key:
+                    case "df (Hz)": value = self.mla.lockin.get_df()
+                    case "frequencies (Hz)": value = self.mla.lockin.get_frequencies()
+                    case "phases (deg)": value = self.mla.lockin.get_phases(unit = "degree")
+                    case "amplitudes (mV)": value = self.mla.lockin.get_amplitudes() * 1000
+            self.update_shadow({key: value})
+
+        state = {key: np.copy(self.shadow[key]) if isinstance(self.shadow[key], np.ndarray) else self.shadow[key] for key in keys if key in self.shadow}
+        if "output_masks" in keys: state.update({"output_masks": np.copy(self.output_masks)})
+        if "input_mask" in keys: state.update({"input_mask": np.copy(self.input_mask)})
+        [state.update({f"port_{port} (V)": self.V[port - 1]}) for port in [1, 2] if f"port_{port} (V)" in keys]
+        return state
+
+    def update_shadow(self, changes: dict) -> None:
+        if "df (Hz)" in changes:
+            self.df = float(changes["df (Hz)"])
+            self.tm = 1000 / self.df
+            self.shadow["df (Hz)"] = self.df
+        for key, value in changes.items():
+            match key:
+                case "frequencies (Hz)": self.shadow[key] = np.round(np.asarray(value, dtype = float) / self.df) * self.df # The instrument places the tones on integer multiples of df
+                case "phases (deg)" | "amplitudes (mV)": self.shadow[key] = np.array(value, dtype = float)
+                case "output_masks": self.output_masks = np.array(value, dtype = int)
+                case "input_mask": self.input_mask = np.array(value, dtype = int)
+        return
+
+    def groups_of(self, keys: list) -> list:
+        groups = []
+        [groups.append(group) for key in keys for group in self.shadow_groups.get(key, []) if not group in groups]
+        return groups
+
+    def broadcast(self, groups: list) -> dict:
+        """
+        Emits the shadow state of the groups ('time_constant', 'frequencies', 'amplitudes', 'phases', 'outputs', 'inputs', 'mla_bias') as the parameter dicts of the update methods, without reading the instrument
+        """
+        state = self.shadow_state()
+        dicts = {}
+        for group in groups:
+            state_dict = {"dict_name": group}
+            match group:
+                case "time_constant": state_dict.update({"tm (ms)": self.tm, "df (Hz)": self.df})
+                case "frequencies":
+                    frequencies = np.round(state["frequencies (Hz)"], 5)
+                    state_dict.update({"frequencies (Hz)": frequencies, "numbers": np.round(frequencies / self.df, 5), "times (ms)": np.round(np.array([1000 / frequency if not frequency == 0 else 0 for frequency in frequencies]), 5)})
+                case "amplitudes": state_dict.update({"amplitudes (mV)": np.round(state["amplitudes (mV)"], 5)})
+                case "phases": state_dict.update({"phases (deg)": state["phases (deg)"]})
+                case "outputs":
+                    for index in range(4):
+                        if self.output_masks[0, index]: state_dict.update({f"mod{index}": {"on": True, "port": 1}})
+                        elif self.output_masks[1, index]: state_dict.update({f"mod{index}": {"on": True, "port": 2}})
+                        else: state_dict.update({f"mod{index}": {"on": False}})
+                    state_dict.update({"output_masks": np.copy(self.output_masks)})
+                case "inputs": state_dict.update({"input_mask": np.copy(self.input_mask)})
+                case "mla_bias": state_dict.update({"port_1 (V)": self.V[0], "port_2 (V)": self.V[1]})
+            self.parameters.emit(state_dict)
+            dicts.update({group: state_dict})
+        return dicts
+
+
+
     # 'Update' methods that both take and apply parameters supplied to them and read from the mla
     def lockin_update(self, parameters: dict = {}, unlink: bool = False, verbose: bool = True) -> tuple[dict, bool | str]:
         error = False
@@ -241,60 +428,16 @@ class MLAAPI(QtCore.QObject):
             
             if not self.status == "running" and not self.test_mode: self.link()
             
-            # time_constant_update
-            tm = parameters.get("tm (ms)", None)
-            df = parameters.get("df (Hz)", None)
-            if isinstance(df, float | int): (time_constant, error) = self.time_constant_update({"df (Hz)": df}, verbose = verbose)
-            elif isinstance(tm, float | int): (time_constant, error) = self.time_constant_update({"tm (ms)": tm}, verbose = verbose)
-            else: (time_constant, error) = self.time_constant_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({time_constant.get("dict_name"): time_constant})
-            
-            # frequencies_update
-            frequencies = parameters.get("frequencies (Hz)", None)
-            numbers = parameters.get("numbers", None)
-            times = parameters.get("times (ms)", None)
-            if isinstance(frequencies, list | np.ndarray): (frequencies_dict, error) = self.frequencies_update({"frequencies (Hz)": frequencies}, verbose = verbose)
-            elif isinstance(numbers, list | np.ndarray): (frequencies_dict, error) = self.frequencies_update({"numbers": numbers}, verbose = verbose)
-            elif isinstance(times, list | np.ndarray): (frequencies_dict, error) = self.frequencies_update({"times (ms)": times}, verbose = verbose)
-            else: (frequencies_dict, error) = self.frequencies_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({frequencies_dict.get("dict_name"): frequencies_dict})
-            
-            # amplitudes update
-            amplitudes = parameters.get("amplitudes (mV)", None)
-            if isinstance(amplitudes, list | np.ndarray): (amplitudes_dict, error) = self.amplitudes_update({"amplitudes (mV)": amplitudes}, verbose = verbose)
-            else: (amplitudes_dict, error) = self.amplitudes_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({amplitudes_dict.get("dict_name"): amplitudes_dict})
-            
-            # phases update
-            phases = parameters.get("phases (deg)", None)
-            if isinstance(phases, list | np.ndarray): (phases_dict, error) = self.phases_update({"phases (deg)": phases}, verbose = verbose)
-            else: (phases_dict, error) = self.phases_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({phases_dict.get("dict_name"): phases_dict})
-            
-            # outputs update
-            outputs_keys = {key: value for key, value in parameters.items() if key in ["blank", "output_masks", "mod0", "mod1", "mod2", "mod3"]}
-            if len(outputs_keys) > 0: (outputs_dict, error) = self.outputs_update(outputs_keys, verbose = verbose)
-            else: (outputs_dict, error) = self.outputs_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({outputs_dict.get("dict_name"): outputs_dict})
-
-            # outputs update
-            inputs_keys = {key: value for key, value in parameters.items() if key in ["input_mask"]}
-            if len(inputs_keys) > 0: (inputs_dict, error) = self.inputs_update(inputs_keys, verbose = verbose)
-            else: (inputs_dict, error) = self.inputs_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({inputs_dict.get("dict_name"): inputs_dict})
-            
-            # bias update
-            bias_keys = {key: value for key, value in parameters.items() if key in ["port_1 (V)", "port_2 (V)"]}
-            if len(bias_keys) > 0: (bias_dict, error) = self.bias_update(bias_keys, verbose = verbose)
-            else: (bias_dict, error) = self.bias_update(verbose = verbose)
-            if error: raise Exception(error)
-            else: parameters_out.update({bias_dict.get("dict_name"): bias_dict})
+            if len(parameters) > 0: # Send all requested settings in one transaction and report the resulting shadow state
+                (changes, error) = self.transaction(broadcast = False, verbose = verbose).stage(parameters).commit()
+                if error: raise Exception(error)
+                parameters_out.update(self.broadcast(["time_constant", "frequencies", "amplitudes", "phases", "outputs", "inputs", "mla_bias"]))
+            else: # Read everything
+                for update_method in [self.time_constant_update, self.frequencies_update, self.amplitudes_update, self.phases_update, self.outputs_update, self.inputs_update, self.bias_update]:
+                    (state_dict, error) = update_method(verbose = verbose)
+                    if error: raise Exception(error)
+                    else: parameters_out.update({state_dict.get("dict_name"): state_dict})
+            [frequencies_dict, amplitudes_dict, phases_dict, outputs_dict, inputs_dict] = [parameters_out.get(key) for key in ["frequencies", "amplitudes", "phases", "outputs", "inputs"]]
             
             # Create an array that stacks all data
             try:
@@ -336,6 +479,8 @@ class MLAAPI(QtCore.QObject):
                 # Read            
                 self.tm = self.mla.lockin.get_Tm() * 1000 # Default unit in Scantelligent is ms, not s
                 self.df = self.mla.lockin.get_df()
+                if isinstance(df, float | int) or isinstance(tm, float | int): self.shadow.pop("frequencies (Hz)", None) # The tones moved with df
+                self.shadow["df (Hz)"] = self.df
             else:
                 if df:
                     self.df = df
@@ -371,7 +516,7 @@ class MLAAPI(QtCore.QObject):
             
             if self.test_mode: old_frequencies = np.random.random(32) * 1000
             else: old_frequencies = self.mla.lockin.get_frequencies()
-            new_frequencies = old_frequencies # To be overwritten with user data
+            new_frequencies = np.copy(old_frequencies) # To be overwritten with user data
             
             # Set            
             if isinstance(frequencies, list | np.ndarray):
@@ -390,11 +535,13 @@ class MLAAPI(QtCore.QObject):
                     try: new_frequencies[int(key)] = value * self.df
                     except: pass
             
-            if not self.test_mode: self.mla.lockin.set_frequencies(new_frequencies, wait_for_effect = True)
+            if not self.test_mode and not np.array_equal(new_frequencies, old_frequencies): self.mla.lockin.set_frequencies(new_frequencies, wait_for_effect = True) # Only send actual changes
             
             # Read
             if self.test_mode: read_frequencies = np.sort(np.random.random(32) * 1000)
-            else: read_frequencies = np.round(self.mla.lockin.get_frequencies(), 5)
+            else:
+                self.shadow["frequencies (Hz)"] = self.mla.lockin.get_frequencies()
+                read_frequencies = np.round(self.shadow["frequencies (Hz)"], 5)
             read_numbers = np.round(np.array([frequency / self.df for frequency in read_frequencies]), 5)
             osc_times = np.round(np.array([1000 / frequency if not frequency == 0 else 0 for frequency in read_frequencies]), 5)
 
@@ -425,7 +572,7 @@ class MLAAPI(QtCore.QObject):
             
             if self.test_mode: old_amplitudes = np.random.random(32)
             else: old_amplitudes = self.mla.lockin.get_amplitudes() * 1000 # Scantelligent uses mV by default
-            new_amplitudes = old_amplitudes # To be overwritten with user data
+            new_amplitudes = np.copy(old_amplitudes) # To be overwritten with user data
             
             # Set
             if isinstance(amplitudes, list | np.ndarray):
@@ -436,11 +583,13 @@ class MLAAPI(QtCore.QObject):
                     if not isinstance(value, float | int): continue
                     try: new_amplitudes[int(key)] = value
                     except: pass
-            if not self.test_mode: self.mla.lockin.set_amplitudes(new_amplitudes / 1000, wait_for_effect = True)
+            if not self.test_mode and not np.array_equal(new_amplitudes, old_amplitudes): self.mla.lockin.set_amplitudes(new_amplitudes / 1000, wait_for_effect = True) # Only send actual changes
             
             # Read
             if self.test_mode: read_amplitudes = np.random.random((32)) * 500
-            else: read_amplitudes = np.round(self.mla.lockin.get_amplitudes() * 1000, 5)
+            else:
+                self.shadow["amplitudes (mV)"] = self.mla.lockin.get_amplitudes() * 1000
+                read_amplitudes = np.round(self.shadow["amplitudes (mV)"], 5)
 
             amp_dict.update({"amplitudes (mV)": read_amplitudes})
             self.parameters.emit(amp_dict)
@@ -469,7 +618,7 @@ class MLAAPI(QtCore.QObject):
             
             if self.test_mode: old_phases = np.random.random(32)
             else: old_phases = self.mla.lockin.get_phases(unit = "degree") # Scantelligent uses degree instead of radians
-            new_phases = old_phases # To be overwritten with user data
+            new_phases = np.copy(old_phases) # To be overwritten with user data
             
             # Set
             if isinstance(phases, list | np.ndarray):
@@ -480,11 +629,13 @@ class MLAAPI(QtCore.QObject):
                     if not isinstance(value, float | int): continue
                     try: new_phases[int(key)] = value
                     except: pass
-            if not self.test_mode: self.mla.lockin.set_phases(new_phases, unit = "degree", wait_for_effect = True)
+            if not self.test_mode and not np.array_equal(new_phases, old_phases): self.mla.lockin.set_phases(new_phases, unit = "degree", wait_for_effect = True) # Only send actual changes
             
             # Read
             if self.test_mode: read_phases = np.random.random((32)) * 360
-            else: read_phases = self.mla.lockin.get_phases(unit = "degree")
+            else:
+                read_phases = self.mla.lockin.get_phases(unit = "degree")
+                self.shadow["phases (deg)"] = np.copy(read_phases)
 
             phase_dict.update({"phases (deg)": read_phases})
             self.parameters.emit(phase_dict)
@@ -509,10 +660,11 @@ class MLAAPI(QtCore.QObject):
             if not self.status == "running" and not self.test_mode: self.link()
             
             # Read the parameters
+            previous_masks = np.copy(self.output_masks)
             blank = parameters.get("blank", False)
             if blank: self.output_masks *= 0            
             output_masks = parameters.get("output_masks", False)
-            if isinstance(output_masks, np.ndarray) and output_masks.shape == self.output_masks.shape: self.output_masks = output_masks
+            if isinstance(output_masks, np.ndarray) and output_masks.shape == self.output_masks.shape: self.output_masks = np.array(output_masks, dtype = int)
             
             mod0 = parameters.get("mod0", None)
             if not mod0: mod0 = parameters.get("mla_mod0", None)
@@ -540,7 +692,8 @@ class MLAAPI(QtCore.QObject):
                     self.output_masks[chan - 1, index] = 1
                     outputs_dict.update({f"mod{index}": {"on": True, "port": chan}})
             
-            if not self.test_mode: self.set_output_masks(self.output_masks)
+            changed_ports = [port + 1 for port in range(2) if not np.array_equal(self.output_masks[port], previous_masks[port])]
+            if not self.test_mode and len(changed_ports) > 0: self.set_output_masks(self.output_masks, ports = changed_ports) # Only send the ports that changed
             outputs_dict.update({"output_masks": np.copy(self.output_masks)})
             self.parameters.emit(outputs_dict)
             
@@ -565,7 +718,7 @@ class MLAAPI(QtCore.QObject):
             
             mask = parameters.get("input_mask", None)
             if isinstance(mask, list): mask = np.array(mask, dtype = int)
-            if isinstance(mask, np.ndarray) and mask.shape == self.input_mask.shape:
+            if isinstance(mask, np.ndarray) and mask.shape == self.input_mask.shape and not np.array_equal(mask, self.input_mask):
                 self.input_mask = mask
                 if not self.test_mode: self.set_input_multiplexer(self.input_mask)
             
@@ -628,23 +781,38 @@ class MLAAPI(QtCore.QObject):
 
 
     # Parameter sweep experiments
+    def run_sweep(self, engine: SweepEngine, setpoints: np.ndarray, apply: object, process: object, n_channels: int, adaptive: dict = None, resolution: float = 0, steering_channels: list = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Measures the setpoints with the sweep engine. With adaptive = {"points": maximum number of points, "time (s)": time budget, "coarse points": number of initial points}, the first and last setpoint only set the sweep range
+        The points are then chosen by an AdaptiveSampler, which refines where the steering channels deviate most from linear interpolation, and the output rows are sorted along the swept parameter
+        """
+        if not adaptive: return engine.run(list(setpoints), apply, process, n_channels)
+        
+        sampler = AdaptiveSampler(setpoints[0], setpoints[-1], coarse_points = adaptive.get("coarse points", 11), max_points = adaptive.get("points", len(setpoints)), max_time_s = adaptive.get("time (s)", None),
+                                  resolution = resolution, channels = steering_channels)
+        x = sampler.initial()
+        while len(x) > 0:
+            (measurement_array, error_array) = engine.run(list(x), apply, process, n_channels)
+            sampler.tell(x, measurement_array, error_array / np.sqrt(engine.pixel_counts)[:, None]) # The errors are standard deviations of the pixels, not of their average
+            x = sampler.ask()
+        (x, measurement_array, error_array) = sampler.result()
+        return (measurement_array.astype(np.float32), error_array.astype(np.float32))
+
     def frequency_sweep(self, frequencies = np.ndarray, settle_pixels: int = 1, pixels_per_datapoint: int = 4, measurement: object = None, tia_gain_V_per_pA: float = 0, modulators: list = [0, 1],
                         output_port: int = 1, input_port: int = 2, input_reference_port: int = 1, abort_callback: object = None, data_callback: object = None, channel_names_callback: object = None,
-                        insert_parameter: tuple[str, float] = None, tia_corrections: list | np.ndarray = None, post_sweep_outputs: str = "reset") -> tuple[np.ndarray, np.ndarray]:
+                        insert_parameter: tuple[str, float] = None, tia_corrections: list | np.ndarray | TIACorrection = None, post_sweep_outputs: str = "reset", adaptive: dict = None, integration: dict = None) -> tuple[np.ndarray, np.ndarray]:
         
         # In the future, more complicated data acquisitions can be passed rather than just get_pixels
         if measurement: self.logprint(f"Measurements other than data pixel acquisitions are not yet supported for frequency sweeps.", message_type = "error")
-        measurement = lambda: self.get_pixels(pixels_per_datapoint, average = True)
         if not data_callback: data_callback = lambda data_chunk: self.logprint(f"{data_chunk = }", message_type = "result")
 
-        (start_outputs, error) = self.outputs_update(verbose = False) # Read for resetting after the sweep
-        measurement_output_masks = np.copy(start_outputs.get("output_masks"))
+        start_state = self.shadow_state() # For resetting after the sweep
+        measurement_output_masks = np.copy(start_state.get("output_masks"))
         for mod_index in modulators: # Set the modulators according to what was passed
             measurement_output_masks[output_port - 1, mod_index] = 1
-        self.outputs_update({"output_masks": measurement_output_masks}, verbose = False) # Read for resetting after the sweep
+        self.transaction().set_output_masks(measurement_output_masks).commit()
         
-        (amplitudes_dict, error) = self.amplitudes_update(verbose = False) # Read the amplitude
-        mod_voltage_mV = amplitudes_dict.get("amplitudes (mV)")[0]
+        mod_voltage_mV = start_state.get("amplitudes (mV)")[0]
         
         # Prepare to plot these channels
         channel_names = ["f1 (Hz)", "|a1_ref| (mV)", "arg(a1_ref) (deg)", "|a1| (mV)", "arg(a1) (deg)", "|a2| (mV)", "arg(a2) (deg)"] # When a gain is given, convert the voltages to displacement currents and subsequently capacitances
@@ -654,42 +822,34 @@ class MLAAPI(QtCore.QObject):
         if isinstance(insert_parameter, tuple) and isinstance(insert_parameter[0], str) and isinstance(insert_parameter[1], float | int):
             channel_names.insert(0, insert_parameter[0]) # When passed, an extra parameter can be inserted at position 0 of the channels
             insert_value = insert_parameter[1]
+        n_channels = len(channel_names)
+        engine = SweepEngine(self, settle_pixels = settle_pixels, pixels_per_datapoint = pixels_per_datapoint, abort_callback = abort_callback, data_callback = data_callback, integration = integration)
+        if engine.integration: channel_names.append(engine.count_channel) # Number of pixels integrated for every point
         if channel_names_callback: channel_names_callback(np.array(channel_names))
-        measurement_array = np.empty((len(frequencies), len(channel_names)), dtype = np.float32)
-        error_array = np.empty_like(measurement_array, dtype = np.float32)
         
         
         
-        # Main loop
-        n_total = len(frequencies)
-        self.start_lockin()
-        for index, f in enumerate(frequencies):
-            if abort_callback: abort_callback()
-            self.task_progress.emit(int(100 * index / n_total))
+        # Setpoint table: df and the full frequency vector of every point. Tones 0 to 3 are placed on the numbers [1, 1, 2, 3]; the other tones keep their current numbers
+        numbers = np.round(start_state.get("frequencies (Hz)") / start_state.get("df (Hz)"))
+        numbers[:4] = [1, 1, 2, 3]
+        setpoints = np.asarray(frequencies, dtype = float)
+
+        def apply(setpoint: float) -> None:
+            self.set_tones(int(setpoint), numbers)
+            return
+
+        def process(index: int, setpoint: float, pix_V: np.ndarray, pix_V_std_dev: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            f = setpoint
             w = 2 * np.pi * int(f) # Frequency in rad per s
-            self.time_constant_update({"df (Hz)": int(f)}, verbose = False)
-            (frequencies_dict, error) = self.frequencies_update({"numbers": [1, 1, 2, 3]}, verbose = False)
-            freqs = frequencies_dict.get("frequencies (Hz)")
-            
-            self.get_pixels(settle_pixels) # Wait settle_pixels number of pixels
-            (pix_V, pix_V_var) = measurement()
-            pix_V_std_dev = np.sqrt(pix_V_var)
-            
-            if isinstance(tia_corrections, list | np.ndarray): # Apply correction
-                for tone in range(len(pix_V)):
-                    freq_int = int(round(freqs[tone]))
-                    if freq_int < len(tia_corrections):
-                        tone_correction = tia_corrections[freq_int]
-                        pix_V[tone] *= tone_correction
-                        pix_V_std_dev *= np.abs(tone_correction)
+            (pix_V, pix_V_std_dev) = self.correct_tia(pix_V, pix_V_std_dev, numbers * int(f), tia_corrections)
             
             a1refabs = 2000 * np.abs(pix_V[0]) # Reference signal = output directly copied to an MLA input port
             a1refarg = np.rad2deg(np.angle(pix_V[0]))
             
             a1abs_mV = 2000 * np.abs(pix_V[1]) # Drive and second harmonic output measured on input port
             a2abs_mV = 2000 * np.abs(pix_V[2])
-            a1_std_dev_mV = 2000 * np.sqrt(pix_V_std_dev[1])
-            a2_std_dev_mV = 2000 * np.sqrt(pix_V_std_dev[2])
+            a1_std_dev_mV = 2000 * pix_V_std_dev[1]
+            a2_std_dev_mV = 2000 * pix_V_std_dev[2]
             
             a1arg = np.rad2deg(np.angle(pix_V[1]))
             a2arg = np.rad2deg(np.angle(pix_V[2]))
@@ -702,9 +862,6 @@ class MLAAPI(QtCore.QObject):
                 a2_std_dev_pA = a2_std_dev_mV / (1000 * tia_gain_V_per_pA)
                 
                 if mod_voltage_mV > .01: # Convert to femtofarad
-                    #a1abs_nS = a1abs_pA / mod_voltage_mV # Reactance
-                    #a2abs_nS = a2abs_pA / mod_voltage_mV
-                    
                     wV = w * mod_voltage_mV
                     a1abs_fF = 1E6 * a1abs_pA / wV # Capacitance is capacitive reactance divided by frequency
                     a2abs_fF = 1E6 * a2abs_pA / wV
@@ -726,32 +883,35 @@ class MLAAPI(QtCore.QObject):
             if isinstance(insert_value, float | int):
                 data_chunk = np.insert(data_chunk, 0, insert_value)
                 error_chunk = np.insert(error_chunk, 0, 0)
-            
-            measurement_array[index] = data_chunk
-            error_array[index] = error_chunk
-            data_callback(data_chunk)
+            return (data_chunk, error_chunk)
+
+
+
+        # Main loop
+        self.start_lockin()
+        x_column = int(isinstance(insert_value, float | int))
+        (measurement_array, error_array) = self.run_sweep(engine, setpoints, apply, process, n_channels, adaptive = adaptive, resolution = 1, steering_channels = list(range(x_column + 3, n_channels))) # Tones are on integer df
+        self.broadcast(["time_constant", "frequencies"]) # The setters above do not broadcast; broadcast the final state
                 
         self.task_progress.emit(100) # Signal that the measurement is done
-        if post_sweep_outputs == "blank": self.outputs_update({"output_masks": np.zeros((2, 32), dtype = int)}) # Reset outputs
-        elif post_sweep_outputs == "reset": self.outputs_update({"output_masks": start_outputs.get("output_masks")}) # Reset outputs
+        if post_sweep_outputs == "blank": self.transaction().set_output_masks(np.zeros((2, 32), dtype = int)).commit() # Reset outputs
+        elif post_sweep_outputs == "reset": self.transaction().set_output_masks(start_state.get("output_masks")).commit() # Reset outputs
         return (measurement_array, error_array, channel_names)
 
     def amplitude_sweep(self, amplitudes = np.ndarray, settle_pixels: int = 1, pixels_per_datapoint: int = 4, measurement: object = None, tia_gain_V_per_pA: float = 0,
                         output_port: int = 1, modulators: list = [0], abort_callback: object = None, data_callback: object = None, channel_names_callback: object = None,
-                        insert_parameter: tuple[str, float] = None, tia_corrections: list | np.ndarray = None, post_sweep_outputs: str = "reset") -> tuple[np.ndarray, np.ndarray]:
+                        insert_parameter: tuple[str, float] = None, tia_corrections: list | np.ndarray | TIACorrection = None, post_sweep_outputs: str = "reset", integration: dict = None) -> tuple[np.ndarray, np.ndarray]:
         # In the future, more complicated data acquisitions can be passed rather than just mla.get_pixels
         if measurement: self.logprint(f"Measurements other than data pixel acquisitions are not yet supported for frequency sweeps.", message_type = "error")
-        measurement = lambda: self.get_pixels(pixels_per_datapoint, average = True)
         if not data_callback: data_callback = lambda data_chunk: self.logprint(f"{data_chunk = }", message_type = "result")
         
-        (start_outputs, error) = self.outputs_update(verbose = False) # Read for resetting after the sweep
-        measurement_output_masks = np.copy(start_outputs.get("output_masks"))
+        start_state = self.shadow_state() # For resetting after the sweep
+        measurement_output_masks = np.copy(start_state.get("output_masks"))
         for mod_index in modulators: # Set the modulators according to what was passed
             measurement_output_masks[output_port - 1, mod_index] = 1
-        self.outputs_update({"output_masks": measurement_output_masks}, verbose = False) # Read for resetting after the sweep
+        self.transaction().set_output_masks(measurement_output_masks).commit()
         
-        (frequencies_dict, error) = self.frequencies_update() # Knowledge of the absolute frequencies is relevant when correcting for the frequency-dependent response of the TIA
-        freqs = frequencies_dict.get("frequencies (Hz)")
+        freqs = start_state.get("frequencies (Hz)") # Knowledge of the absolute frequencies is relevant when correcting for the frequency-dependent response of the TIA
 
         # Prepare to plot these channels
         channel_names = ["amp (mV)", "|a1_ref| (mV)"]
@@ -761,85 +921,76 @@ class MLAAPI(QtCore.QObject):
         if isinstance(insert_parameter, tuple) and isinstance(insert_parameter[0], str) and isinstance(insert_parameter[1], float | int):
             channel_names.insert(0, insert_parameter[0]) # When passed, an extra parameter can be inserted at position 0 of the channels
             insert_value = insert_parameter[1]
+        n_channels = len(channel_names)
+        engine = SweepEngine(self, settle_pixels = settle_pixels, pixels_per_datapoint = pixels_per_datapoint, abort_callback = abort_callback, data_callback = data_callback, integration = integration)
+        if engine.integration: channel_names.append(engine.count_channel) # Number of pixels integrated for every point
         if channel_names_callback: channel_names_callback(np.array(channel_names)) # Signal the gui to start tracking/plotting these data
-        measurement_array = np.empty((len(amplitudes), len(channel_names)), dtype = np.float32)
-        error_array = np.empty_like(measurement_array, dtype = np.float32)
 
 
 
-        # Main loop
-        n_total = len(amplitudes)
-        self.start_lockin()
-        for index, amp_mV in enumerate(amplitudes):
-            if abort_callback: abort_callback()
-            self.task_progress.emit(int(100 * index / n_total))
-            self.amplitudes_update({"amplitudes (mV)": {number: amp_mV for number in modulators}}, verbose = False)
-            
-            self.get_pixels(settle_pixels)
-            (pix_V, pix_V_var) = measurement()
-            pix_V_std_dev = np.sqrt(pix_V_var)
-            
-            if isinstance(tia_corrections, list | np.ndarray): # Apply correction
-                for tone in range(len(pix_V)):
-                    freq_int = int(round(freqs[tone]))
-                    if freq_int < len(tia_corrections):
-                        tone_correction = tia_corrections[freq_int]
-                        pix_V[tone] *= tone_correction
-                        pix_V_std_dev *= np.abs(tone_correction)
-            
-            if isinstance(insert_value, float | int): data_chunk = np.zeros((len(channel_names) - 1), dtype = np.float32)
-            else: data_chunk = np.zeros((len(channel_names)), dtype = np.float32)
+        # Setpoint table: the full amplitude vector (mV) of every point
+        start_amplitudes = start_state.get("amplitudes (mV)")
+        setpoints = []
+        for amp_mV in amplitudes:
+            amplitudes_mV = np.copy(start_amplitudes)
+            amplitudes_mV[modulators] = amp_mV
+            setpoints.append(amplitudes_mV)
+
+        def apply(setpoint: np.ndarray) -> None:
+            self.set_amplitudes(setpoint)
+            return
+
+        def process(index: int, setpoint: np.ndarray, pix_V: np.ndarray, pix_V_std_dev: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            (pix_V, pix_V_std_dev) = self.correct_tia(pix_V, pix_V_std_dev, freqs, tia_corrections)
+            
+            if isinstance(insert_value, float | int): data_chunk = np.zeros((n_channels - 1), dtype = np.float32)
+            else: data_chunk = np.zeros((n_channels), dtype = np.float32)
             error_chunk = np.zeros_like(data_chunk)
-            data_chunk[0] = amp_mV
+            data_chunk[0] = amplitudes[index]
             data_chunk[1] = 2000 * np.abs(pix_V[0]) # Factor 2 to account for discrepancy between amplitude and lockin measured amplitude
             
-            harmonics_V = np.array([[np.real(tone), np.imag(tone)] for tone in pix_V[1:]]).flatten()
-            errors_V = np.sqrt(np.array([[tone, 0] for tone in pix_V_std_dev[1:]]).flatten())
+            harmonics_V = np.column_stack((np.real(pix_V[1:]), np.imag(pix_V[1:]))).ravel() # Interleaved real and imaginary parts
+            errors_V = np.column_stack((pix_V_std_dev[1:], np.zeros(len(pix_V_std_dev) - 1))).ravel()
             if tia_gain_V_per_pA > 1E-12:
-                harmonics_pA = 2 * harmonics_V / tia_gain_V_per_pA
-                data_chunk[2:] = harmonics_pA
-                
-                errors_pA = 2 * errors_V / tia_gain_V_per_pA
-                error_chunk[2:] = errors_pA
+                data_chunk[2:] = 2 * harmonics_V / tia_gain_V_per_pA
+                error_chunk[2:] = 2 * errors_V / tia_gain_V_per_pA
             else:
-                harmonics_mV = 2000 * harmonics_V
-                data_chunk[2:] = harmonics_mV
-                
-                errors_mV = 2000 * errors_V
-                error_chunk[2:] = errors_mV
+                data_chunk[2:] = 2000 * harmonics_V
+                error_chunk[2:] = 2000 * errors_V
 
             if isinstance(insert_value, float | int):
                 data_chunk = np.insert(data_chunk, 0, insert_value)
                 error_chunk = np.insert(error_chunk, 0, 0)
-            
-            measurement_array[index] = data_chunk
-            error_array[index] = error_chunk
-            data_callback(data_chunk)
+            return (data_chunk, error_chunk)
+
+
+
+        # Main loop
+        self.start_lockin()
+        (measurement_array, error_array) = engine.run(setpoints, apply, process, n_channels)
+        self.broadcast(["amplitudes"]) # The setter above does not broadcast; broadcast the final state
 
         self.task_progress.emit(100) # Signal that the measurement is done
-        if post_sweep_outputs == "blank": self.outputs_update({"output_masks": np.zeros((2, 32), dtype = int)}) # Reset outputs
-        elif post_sweep_outputs == "reset": self.outputs_update({"output_masks": start_outputs.get("output_masks")}) # Reset outputs
+        if post_sweep_outputs == "blank": self.transaction().set_output_masks(np.zeros((2, 32), dtype = int)).commit() # Reset outputs
+        elif post_sweep_outputs == "reset": self.transaction().set_output_masks(start_state.get("output_masks")).commit() # Reset outputs
         return (measurement_array, error_array, channel_names)
 
     def voltage_sweep(self, voltages = np.ndarray, settle_pixels: int = 1, pixels_per_datapoint: int = 4, measurement: object = None, tia_gain_V_per_pA: float = 0,
                       output_port: int = 1, modulators: list = [0], abort_callback: object = None, data_callback: object = None, channel_names_callback: object = None,
-                      insert_parameter: tuple[str, float] = None, return_type: str = "conductance", tia_corrections: list | np.ndarray = None, post_sweep_outputs: str = "reset") -> tuple[np.ndarray, np.ndarray]:
+                      insert_parameter: tuple[str, float] = None, return_type: str = "conductance", tia_corrections: list | np.ndarray | TIACorrection = None, post_sweep_outputs: str = "reset", adaptive: dict = None, integration: dict = None) -> tuple[np.ndarray, np.ndarray]:
         # In the future, more complicated data acquisitions can be passed rather than just mla.get_pixels
         if measurement: self.logprint(f"Measurements other than data pixel acquisitions are not yet supported for frequency sweeps.", message_type = "error")
-        measurement = lambda: self.get_pixels(pixels_per_datapoint, average = True)
         if not data_callback: data_callback = lambda data_chunk: self.logprint(f"{data_chunk = }", message_type = "result")
         
-        (start_outputs, error) = self.outputs_update(verbose = False) # Read for resetting after the sweep
-        measurement_output_masks = np.copy(start_outputs.get("output_masks"))
+        start_state = self.shadow_state() # For resetting after the sweep
+        measurement_output_masks = np.copy(start_state.get("output_masks"))
         for mod_index in modulators: # Set the modulators according to what was passed
             measurement_output_masks[output_port - 1, mod_index] = 1
-        self.outputs_update({"output_masks": measurement_output_masks}, verbose = False) # Read for resetting after the sweep
+        self.transaction().set_output_masks(measurement_output_masks).commit()
         
         # Read the TIA gain and oscillator amplitude to be able to convert values
-        (frequencies_dict, error) = self.frequencies_update()
-        freqs = frequencies_dict.get("frequencies (Hz)")
-        (amplitudes_dict, error) = self.amplitudes_update(verbose = False)
-        mod_voltage_mV = amplitudes_dict.get("amplitudes (mV)")[0]
+        freqs = start_state.get("frequencies (Hz)")
+        mod_voltage_mV = start_state.get("amplitudes (mV)")[0]
         
         # Prepare to plot these channels
         channel_names = [f"V_port{output_port} (V)", "|a1_ref| (mV)"]
@@ -852,40 +1003,31 @@ class MLAAPI(QtCore.QObject):
         if isinstance(insert_parameter, tuple) and isinstance(insert_parameter[0], str) and isinstance(insert_parameter[1], float | int):
             channel_names.insert(0, insert_parameter[0]) # When passed, an extra parameter can be inserted at position 0 of the channels
             insert_value = insert_parameter[1]
+        n_channels = len(channel_names)
+        engine = SweepEngine(self, settle_pixels = settle_pixels, pixels_per_datapoint = pixels_per_datapoint, abort_callback = abort_callback, data_callback = data_callback, integration = integration)
+        if engine.integration: channel_names.append(engine.count_channel) # Number of pixels integrated for every point
         if channel_names_callback: channel_names_callback(np.array(channel_names))
-        measurement_array = np.empty((len(voltages), len(channel_names)), dtype = np.float32)
-        error_array = np.empty_like(measurement_array, dtype = np.float32)
 
 
 
-        # Main loop
-        n_total = len(voltages)
-        self.start_lockin()
-        for index, voltage in enumerate(voltages):
-            if abort_callback: abort_callback()
-            self.task_progress.emit(int(100 * index / n_total))
-            self.bias_update({f"port_{output_port} (V)": voltage}, verbose = False)
-            
-            self.get_pixels(settle_pixels)
-            (pix_V, pix_V_var) = measurement()
-            pix_V_std_dev = np.sqrt(pix_V_var)
-            
-            if isinstance(tia_corrections, list | np.ndarray): # Apply correction for tia response if desired
-                for tone in range(len(pix_V)):
-                    freq_int = int(round(freqs[tone]))
-                    if freq_int < len(tia_corrections):
-                        tone_correction = tia_corrections[freq_int]
-                        pix_V[tone] *= tone_correction
-                        pix_V_std_dev *= np.abs(tone_correction)
+        # Setpoint table: the bias of every point. The bias is slewed from one point to the next in 10 mV steps
+        setpoints = np.asarray(voltages, dtype = float)
+
+        def apply(setpoint: float) -> None:
+            self.ramp_bias(port = output_port, value = setpoint)
+            return
+
+        def process(index: int, setpoint: float, pix_V: np.ndarray, pix_V_std_dev: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            (pix_V, pix_V_std_dev) = self.correct_tia(pix_V, pix_V_std_dev, freqs, tia_corrections) # Apply correction for tia response if desired
                         
-            if isinstance(insert_value, float | int): data_chunk = np.zeros((len(channel_names) - 1), dtype = np.float32)
-            else: data_chunk = np.zeros((len(channel_names)), dtype = np.float32)
+            if isinstance(insert_value, float | int): data_chunk = np.zeros((n_channels - 1), dtype = np.float32)
+            else: data_chunk = np.zeros((n_channels), dtype = np.float32)
             error_chunk = np.zeros_like(data_chunk)
-            data_chunk[0] = voltage
+            data_chunk[0] = setpoint
             data_chunk[1] = 2000 * np.abs(pix_V[0]) # Reference signal in mA
             
-            harmonics_V = np.array([[np.real(tone), np.imag(tone)] for tone in pix_V[1:]]).flatten()
-            errors_V = np.sqrt(np.array([[tone, 0] for tone in pix_V_std_dev[1:]]).flatten())            
+            harmonics_V = np.column_stack((np.real(pix_V[1:]), np.imag(pix_V[1:]))).ravel() # Interleaved real and imaginary parts
+            errors_V = np.column_stack((pix_V_std_dev[1:], np.zeros(len(pix_V_std_dev) - 1))).ravel()            
             if tia_gain_V_per_pA > 1E-12:
                 harmonics_pA = 2 * harmonics_V / tia_gain_V_per_pA
                 errors_pA = 2 * errors_V / tia_gain_V_per_pA
@@ -910,14 +1052,19 @@ class MLAAPI(QtCore.QObject):
             if isinstance(insert_value, float | int):
                 data_chunk = np.insert(data_chunk, 0, insert_value)
                 error_chunk = np.insert(error_chunk, 0, 0)
-            
-            measurement_array[index] = data_chunk
-            error_array[index] = error_chunk
-            data_callback(data_chunk)
+            return (data_chunk, error_chunk)
+
+
+
+        # Main loop
+        self.start_lockin()
+        x_column = int(isinstance(insert_value, float | int))
+        (measurement_array, error_array) = self.run_sweep(engine, setpoints, apply, process, n_channels, adaptive = adaptive, resolution = 1E-4, steering_channels = list(range(x_column + 2, n_channels)))
+        self.broadcast(["mla_bias"]) # Broadcast the final bias
         
         self.task_progress.emit(100) # Signal that the measurement is done
-        if post_sweep_outputs == "blank": self.outputs_update({"output_masks": np.zeros((2, 32), dtype = int)}) # Reset outputs
-        elif post_sweep_outputs == "reset": self.outputs_update({"output_masks": start_outputs.get("output_masks")}) # Reset outputs
+        if post_sweep_outputs == "blank": self.transaction().set_output_masks(np.zeros((2, 32), dtype = int)).commit() # Reset outputs
+        elif post_sweep_outputs == "reset": self.transaction().set_output_masks(start_state.get("output_masks")).commit() # Reset outputs
         return (measurement_array, error_array, channel_names)
 
 
@@ -3,6 +3,25 @@ from PyQt6 import QtCore
 from .hw_nanonis import NanonisHardware
 from .data_processing import DataProcessing
 import time
+from functools import lru_cache
+
+
+
+@lru_cache(maxsize = 4)
+def grid_meshgrids(x_nm: float, y_nm: float, width_nm: float, height_nm: float, angle_deg: float, pixels: int, lines: int) -> tuple[np.ndarray, np.ndarray]:
+    # Construct a local grid with the same size as the Nanonis grid, with center is at (0, 0)
+    (pix_width, pix_height) = (width_nm / pixels, height_nm / lines)
+    x_coords_local = np.linspace(pix_width / 2 - width_nm / 2, width_nm / 2 - pix_width / 2, pixels)
+    y_coords_local = np.linspace(pix_height / 2 - height_nm / 2, height_nm / 2 - pix_height / 2, lines)
+    x_grid_local, y_grid_local = np.meshgrid(x_coords_local, y_coords_local)
+
+    # Apply a rotation and a translation
+    cos = np.cos(np.deg2rad(angle_deg))
+    sin = np.sin(np.deg2rad(angle_deg))
+    x_grid = x_nm + x_grid_local * cos + y_grid_local * sin
+    y_grid = y_nm + y_grid_local * cos - x_grid_local * sin
+    [grid.setflags(write = False) for grid in [x_grid, y_grid]] # The cached arrays are shared
+    return (x_grid, y_grid)
 
 
 
@@ -106,7 +125,7 @@ class NanonisAPI(QtCore.QObject):
             if error: raise Exception(error)
             else: parameters.update({speeds.get("dict_name"): speeds})
             
-            (grid, error) = self.grid_update(verbose = verbose) # Sends frame data combined with grid aspects like number of pixels and lines and calculated x_grid and y_grid, with "dict_name": "grid" (parent of self.frame_update())
+            (grid, error) = self.grid_update(verbose = verbose) # Sends frame data combined with grid aspects like number of pixels and lines, with "dict_name": "grid". The x_grid and y_grid meshgrids are available through self.grid_coordinates() (parent of self.frame_update())
             if error: raise Exception(error)
             else: parameters.update({grid.get("dict_name"): grid})
             
@@ -154,23 +173,26 @@ class NanonisAPI(QtCore.QObject):
         self.parameters.emit(status_dict)
         return
 
+    def grid_coordinates(self, grid_dict: dict = {}, direction: str = "up") -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the x_grid and y_grid meshgrids (nm) of the pixel centers of a grid dict, with shape (lines, pixels)
+        The meshgrids are computed from the grid description and cached, so that they are only materialized where they are needed. They are read-only
+        """
+        [x_nm, y_nm, width_nm, height_nm, angle_deg, pixels, lines] = [grid_dict.get(parameter) for parameter in ["x (nm)", "y (nm)", "width (nm)", "height (nm)", "angle (deg)", "pixels", "lines"]]
+        (x_grid, y_grid) = grid_meshgrids(float(x_nm), float(y_nm), float(width_nm), float(height_nm), float(angle_deg), int(pixels), int(lines))
+        match direction:
+            case "down": return (np.flipud(x_grid), np.flipud(y_grid))
+            case _: return (x_grid, y_grid)
+
     def grids_to_lists(self, grid_dict: dict = {}, direction: str = "up") -> tuple[dict, bool | str]:
         error = False
         lists = {"dict_name": "coordinate_lists"}
         conv = self.nanonis_hardware.conv
 
-        for tag in ["x_grid (nm)", "y_grid (nm)"]:
-            if not tag in grid_dict.keys():
-                error = "grids_to_lists: Input is missing valid grids"
-                return (lists, error)
-
-        [x_grid, y_grid] = [grid_dict.get(attribute) for attribute in ["x_grid (nm)", "y_grid (nm)"]]
-        match direction:
-            case "down":
-                x_grid = np.flipud(x_grid)
-                y_grid = np.flipud(y_grid)
-            case _:
-                pass
+        try: (x_grid, y_grid) = self.grid_coordinates(grid_dict, direction = direction)
+        except Exception:
+            error = "grids_to_lists: Input is missing a valid grid description"
+            return (lists, error)
 
         x_list = x_grid.flatten()
         y_list = y_grid.flatten()
@@ -778,38 +800,19 @@ class NanonisAPI(QtCore.QObject):
 
         if error: return (grid, error)
         
-        # Append the grid data with calculated information
+        # Append the grid data with calculated information. The grid dict only describes the grid (center, size, angle, pixels, lines); the coordinate meshgrids are computed on demand by self.grid_coordinates()
         try:
-            # Construct a local grid with the same size as the Nanonis grid, with center is at (0, 0)            
-            x_coords_local = np.linspace(pix_width / 2 -width / 2, width / 2 - pix_width / 2, pixels)
-            y_coords_local = np.linspace(pix_height / 2 -height / 2, height / 2 - pix_height / 2, lines)
-            x_grid_local, y_grid_local = np.meshgrid(x_coords_local, y_coords_local)
-
-            # Apply a rotation
+            # Pixel centers at the corners of the grid, in the order of the Nanonis grid (bottom left first)
+            x_local = np.array([pix_width / 2 - width / 2, pix_width / 2 - width / 2, width / 2 - pix_width / 2, width / 2 - pix_width / 2])
+            y_local = np.array([pix_height / 2 - height / 2, height / 2 - pix_height / 2, height / 2 - pix_height / 2, pix_height / 2 - height / 2])
             cos = np.cos(np.deg2rad(angle))
             sin = np.sin(np.deg2rad(angle))
-            x_grid = np.zeros_like(x_grid_local)
-            y_grid = np.zeros_like(y_grid_local)
-
-            for i in range(lines):
-                for j in range(pixels):
-                    x_grid[i, j] = x_grid_local[i, j] * cos + y_grid_local[i, j] * sin
-                    y_grid[i, j] = y_grid_local[i, j] * cos - x_grid_local[i, j] * sin
-
-            # Apply a translation
-            x_grid += grid["x (nm)"]
-            y_grid += grid["y (nm)"]
-
-            # Add vertex information
-            frame_vertices = np.asarray([[x_grid[0, 0], y_grid[0, 0]], [x_grid[-1, 0], y_grid[-1, 0]], [x_grid[-1, -1], y_grid[-1, -1]], [x_grid[0, -1], y_grid[0, -1]]])
+            frame_vertices = np.stack([grid["x (nm)"] + x_local * cos + y_local * sin, grid["y (nm)"] + y_local * cos - x_local * sin], axis = 1)
             bottom_left_corner = frame_vertices[0]
-            top_left_corner = frame_vertices[1]            
+            top_left_corner = frame_vertices[1]
             grid.update({"vertices (nm)": frame_vertices, "bottom_left_corner (nm)": bottom_left_corner, "top_left_corner (nm)": top_left_corner})
             
             if verbose and len(parameters) < 1: self.logprint(f"{grid}", message_type = "result")
-
-            # Add the meshgrids to the grid dictionary
-            grid.update({"x_grid (nm)": x_grid, "y_grid (nm)": y_grid})
             
             self.parameters.emit(grid)
         
@@ -4,6 +4,8 @@ import numpy as np
 from datetime import datetime
 from .file_functions import FileFunctions
 from .data_processing import DataProcessing
+from .hdf5_writer import HDF5Writer
+from .lut_service import LUTService
 from .api_mla import MLAAPI # For type checking only
 from .api_nanonis import NanonisAPI # For type checking only
 
@@ -33,6 +35,7 @@ class BaseExperiment(QObject):
         
         self.mla: MLAAPI = kwargs.pop("mla", None)
         self.nanonis: NanonisAPI = kwargs.pop("nanonis", None)
+        self.keithley = kwargs.pop("keithley", None)
         
         self.file_functions = FileFunctions()
         self.data = DataProcessing() # You can use self.data to access data processing functions. However, do not use self.data.scan_processing_flags to communicate with the GUI. Use self.scan_processing_flags instead
@@ -43,21 +46,16 @@ class BaseExperiment(QObject):
         self.start_parameters = {}
         self.luts = {}
         self.gui_parameters = {}
+        self.writer: HDF5Writer = None
+        self.swmr = False
         
         super().__init__()
         
-        # Read look-up tables
+        # Look-up tables are read once per process and shared between experiments. self.luts is a snapshot of the tables; use self.lut_service for interpolation
+        self.lut_service: LUTService = None
         if isinstance(self.sct_folder, str) and os.path.isdir(self.sct_folder):
-            try:
-                sys_folder = os.path.join(self.sct_folder, "sys")
-                with h5py.File(os.path.join(sys_folder, "LUTs.hdf5"), "r") as f:
-                    datasets = {key: value for key, value in f.items() if isinstance(value, h5py.Dataset)} # Filter out datasets from the items in the HDF5 file
-                    self.luts.update({key: datasets[key][:] for key in datasets.keys() if key in ["LN 10^9", "LN 10^8", "LN 10^7"]}) # Transimpedance amplifier corrections are stored as a dict with key given by the TIA setting name
-                    
-                    # Retrieve the temperature diode calibration
-                    if "DT-670" in datasets.keys(): self.luts.update({"DT-670": datasets["DT-670"][:]})
-            except:
-                pass
+            self.lut_service = LUTService.shared(os.path.join(self.sct_folder, "sys", "LUTs.hdf5"))
+            self.luts.update(self.lut_service.get_tables(["LN 10^9", "LN 10^8", "LN 10^7", "DT-670"])) # Transimpedance amplifier corrections are stored with key given by the TIA setting name
 
 
 
@@ -92,13 +90,17 @@ class BaseExperiment(QObject):
         return
 
     def prepare_hdf5(self) -> None:
-        self.output_file = h5py.File(self.experiment_file, "w") # Open the new HDF5 file
+        self.output_file = h5py.File(self.experiment_file, "w", libver = "latest", **self.file_functions.hdf5_cache) # Open the new HDF5 file with a chunk cache tuned for acquisition. libver = "latest" is required for SWMR
+        
+        # Start the write-behind writer. Acquisition loops should use self.write() instead of assigning to datasets directly, so that disk latency does not stall the hardware loop
+        self.writer = HDF5Writer(self.output_file)
+        self.writer.message.connect(self.message)
+        self.writer.start()
         date_time_group = self.output_file.create_group("date_time")
         date_time_group.attrs.update({"date": datetime.now().strftime("%Y/%m/%d"), "start_time": datetime.now().strftime("%H:%M:%S")})
         
         # Fetch the temperature using a Nanonis call and conversion using a lookup table
         if "DT-670" in self.luts.keys():
-            temp_calib = self.luts["DT-670"]
             try:
                 # Find the signal index corresponding to the temperature sensor
                 metadata = self.start_parameters["nanonis"].get("scan_metadata")
@@ -112,7 +114,7 @@ class BaseExperiment(QObject):
                 if temp_channel: (result, error) = self.nanonis.signals_update([temp_channel], samples = 4, verbose = False)
                 if result:
                     temp_V = result[temp_channel][1]
-                    temp_K = float(np.interp(temp_V, temp_calib[:, 0][::-1], temp_calib[:, 1][::-1]))
+                    temp_K = float(self.lut_service.evaluate("DT-670", temp_V))
                     temp_group = self.output_file.create_group("temperature")
                     temp_group.attrs.update({"temperature (K)": temp_K})
             except:
@@ -140,6 +142,46 @@ class BaseExperiment(QObject):
         tia_group.attrs.update({"TIA gain setting": tia_gain, "TIA gain (V/pA)": tia_gain_V_per_pa})
         return
 
+    def write(self, dataset: h5py.Dataset, selection: tuple | int | slice, array: np.ndarray) -> None:
+        if self.writer is not None and not self.writer.closed: self.writer.write(dataset, selection, array)
+        else: dataset[selection] = array
+        return
+
+    def resize(self, dataset: h5py.Dataset, shape: tuple) -> None:
+        if self.writer is not None and not self.writer.closed: self.writer.resize(dataset, shape)
+        else: dataset.resize(shape)
+        return
+
+    def start_swmr(self) -> None:
+        """
+        Switch the experiment file to single-writer/multiple-reader mode, so that Scanalyzer or a notebook can read it while it is being written (see FileFunctions.poll_hdf5_live)
+        Call this after all groups, datasets and attributes of the experiment have been created. In SWMR mode, datasets can only be written and resized
+        """
+        try:
+            self.output_file.swmr_mode = True
+            self.swmr = True
+        except Exception as e:
+            self.logprint(f"Could not switch the experiment file to SWMR mode. {e}", message_type = "warning")
+        return
+
+    def mark_valid(self, target: h5py.Group | h5py.Dataset, index: int) -> None:
+        group = target if isinstance(target, h5py.Group) else target.parent
+        progress_ds = group.get(self.file_functions.hdf5_progress_name)
+        if progress_ds is not None: self.write(progress_ds, 0, index)
+        return
+
+    def close_writer(self) -> None:
+        """
+        Waits until the writer has written everything that was queued. The experiment file must not be closed while the writer thread is still writing to it
+        """
+        if self.writer is None: return
+        error = self.writer.close()
+        while self.writer.isRunning(): # Timed out; keep waiting
+            self.logprint(f"{error} Waiting for the writer to finish before closing the experiment file.", message_type = "warning")
+            error = self.writer.close()
+        if error: self.logprint(f"Not all data could be written to the experiment file. {error}", message_type = "error")
+        return
+
     def connection_test(self, amplitude_mV: float = 200, frequency_Hz: float = 600, output_port: int = 1, verbose: bool = True, autophase: bool = False) -> str:
         """
         Returns which device the STM bias cable is connected to, and autophases the lockin amplifier for the corresponding device
@@ -264,6 +306,15 @@ class BaseExperiment(QObject):
                 self.logprint(f"Error: {e}", message_type = "error")
                 self.abort_requested = True
             finally:
+                self.close_writer() # Flush all queued writes, also after an abort
+                if self.swmr: # Attributes cannot be written in SWMR mode. Reopen the file to write them
+                    try: self.output_file.close()
+                    except: pass
+                    try: self.output_file = h5py.File(self.experiment_file, "r+", libver = "latest")
+                    except BlockingIOError: # A live reader still holds the file lock
+                        try: self.output_file = h5py.File(self.experiment_file, "r+", libver = "latest", locking = False)
+                        except: pass
+                    except: pass
                 try: self.output_file["date_time"].attrs.update({"end_time": datetime.now().strftime("%H:%M:%S"), "experiment_aborted": self.abort_requested})
                 except: pass
                 try: self.output_file.close()
@@ -348,6 +399,7 @@ class BaseExperiment(QObject):
         t_start = time.time()
         t_elapsed = 0
         scan_finished = False
+        completed_lines = np.zeros(len(nanonis_channel_indices), dtype = int)
         for iteration in range(1000000):
             channel_index = iteration % len(nanonis_channel_indices)
             nanonis_name = nanonis_channel_names[channel_index]
@@ -363,12 +415,14 @@ class BaseExperiment(QObject):
             (scan_image, error) = self.nanonis.scan_update(nanonis_index, backward = False, emit_image = False, verbose = False)
             self.file_functions.convert_data_to_unit(scan_image, nanonis_name) # This rescales the data slice to preferred nm, pA units
             self.array_slice.emit(scan_image.transpose(), [0, channel_index], [0, 1])
-            dataset[0, channel_index] = scan_image.transpose()
+            self.write(dataset, (0, channel_index), scan_image.transpose())
             
             (scan_image_bwd, error) = self.nanonis.scan_update(nanonis_index, backward = True, emit_image = False, verbose = False)
             self.file_functions.convert_data_to_unit(scan_image_bwd, nanonis_name)
             self.array_slice.emit(scan_image_bwd.transpose(), [1, channel_index], [0, 1])
-            dataset[1, channel_index] = scan_image_bwd.transpose()
+            self.write(dataset, (1, channel_index), scan_image_bwd.transpose())
+            completed_lines[channel_index] = np.sum(np.all(np.isfinite(scan_image_bwd), axis = 1))
+            self.mark_valid(dataset, int(np.min(completed_lines)) - 1) # Lines that are complete in every channel and both directions
 
             # 3. Check exit conditions
             self.check_abort_request()
@@ -400,15 +454,16 @@ class BaseExperiment(QObject):
             (scan_image, error) = self.nanonis.scan_update(nanonis_index, backward = False, emit_image = False, verbose = False)
             self.file_functions.convert_data_to_unit(scan_image, nanonis_name) # This rescales the data slice to preferred nm, pA units
             self.array_slice.emit(scan_image.transpose(), [0, channel_index], [0, 1])
-            dataset[0, channel_index] = scan_image.transpose()
+            self.write(dataset, (0, channel_index), scan_image.transpose())
             output_array[0, channel_index] = scan_image.transpose()
             
             (scan_image_bwd, error) = self.nanonis.scan_update(nanonis_index, backward = True, emit_image = False, verbose = False)
             self.file_functions.convert_data_to_unit(scan_image_bwd, nanonis_name)
             self.array_slice.emit(scan_image_bwd.transpose(), [1, channel_index], [0, 1])
-            dataset[1, channel_index] = scan_image_bwd.transpose()
-            output_array[1, channel_index] = scan_image.transpose()        
+            self.write(dataset, (1, channel_index), scan_image_bwd.transpose())
+            output_array[1, channel_index] = scan_image_bwd.transpose()        
         
+        self.mark_valid(dataset, dataset.shape[-1] - 1)
         return output_array
 
     def check_abort_request(self, withdraw: bool = False) -> None:
@@ -0,0 +1,112 @@
+import threading
+import numpy as np
+from matplotlib import colors, colormaps
+
+
+
+class Colorizer:
+    """
+    Colours complex and multichannel images through precomputed uint8 lookup tables
+    Complex images: the phase is quantized to phase_steps hues and the magnitude to magnitude_steps brightness levels. Both indices select an RGB triplet from a 2D lookup table, which is either hue-brightness (HSV) or a cyclic colormap ('twilight', 'hsv', ...) scaled in brightness
+    All intermediate arrays are preallocated per thread and per image shape and reused on every frame. Pass out (see output_buffer) to also reuse the output array
+    The complex lookup tables hold packed RGBA pixels of 4 bytes, which are gathered several times faster than 3-byte RGB triplets. The RGB image is returned as a view of the RGBA buffer
+    """
+    def __init__(self, phase_steps: int = 256, magnitude_steps: int = 256):
+        self.phase_steps = phase_steps
+        self.magnitude_steps = magnitude_steps
+        self.luts = {} # (colormap name, saturate) -> ((phase_steps + 1) * magnitude_steps) uint32 lookup table of RGBA pixels, or (phase_steps + 1) if saturate
+        self.lock = threading.Lock()
+        self.local = threading.local() # Scratch buffers of the calling thread
+
+    def complex_lut(self, colormap: str = "hsv", saturate: bool = False) -> np.ndarray:
+        key = (colormap, saturate)
+        with self.lock:
+            lut = self.luts.get(key)
+            if lut is not None: return lut
+
+            phases = (np.arange(self.phase_steps + 1) % self.phase_steps + .5) / self.phase_steps # The extra row repeats the first: a phase of exactly pi wraps around to -pi
+            brightness = np.ones(1) if saturate else np.linspace(0, 1, self.magnitude_steps)
+            if colormap == "hsv": hues = colors.hsv_to_rgb(np.stack([phases, np.ones_like(phases), np.ones_like(phases)], axis = 1))
+            else: hues = colormaps[colormap](phases)[:, :3]
+            rgb = np.round(255 * hues[:, None, :] * brightness[None, :, None]).astype(np.uint8).reshape(-1, 3) # Row index: phase_index * magnitude_steps + magnitude_index
+            lut = np.concatenate((rgb, np.full((len(rgb), 1), 255, dtype = np.uint8)), axis = 1).view(np.uint32).ravel() # Bytes in memory order R, G, B, A
+            self.luts[key] = lut
+        return lut
+
+    def buffers(self, shape: tuple) -> dict:
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None or buffers["shape"] != shape:
+            buffers = {"shape": shape, "phase": np.empty(shape, dtype = np.float32), "magnitude": np.empty(shape, dtype = np.float32), "index": np.empty(shape, dtype = np.intp),
+                       "magnitude_index": np.empty(shape, dtype = np.intp)}
+            self.local.buffers = buffers
+        return buffers
+
+    def output_buffer(self, shape: tuple) -> np.ndarray:
+        """
+        (..., 4) uint8 RGBA buffer for the out argument of complex_to_colors
+        """
+        return np.empty(tuple(shape) + (4,), dtype = np.uint8)
+
+
+
+    def complex_to_colors(self, image: np.ndarray, saturate: bool = False, colormap: str = "hsv", magnitude_limit: float = None, out: np.ndarray = None) -> np.ndarray:
+        """
+        Returns a (..., 3) uint8 RGB image, which is a view of the RGBA buffer out (a new buffer if out is None or does not match; the buffer is the base of the returned view). The hue follows the phase; unless saturate is True, the brightness follows the magnitude, scaled to magnitude_limit (the maximum magnitude if None)
+        """
+        buffers = self.buffers(image.shape)
+        [phase, magnitude, index, magnitude_index] = [buffers[key] for key in ["phase", "magnitude", "index", "magnitude_index"]]
+
+        # Phase index: [-pi, pi] -> [0, phase_steps]; the lookup table has an extra row for pi. fmax also maps NaN to 0. The integer cast truncates, which is the floor for these non-negative values
+        np.arctan2(image.imag, image.real, out = phase) # The real and imaginary parts are views, not copies
+        np.multiply(phase, self.phase_steps / (2 * np.pi), out = phase)
+        np.add(phase, self.phase_steps / 2, out = phase)
+        np.fmax(phase, 0, out = phase)
+        np.copyto(index, phase, casting = "unsafe")
+
+        if not saturate:
+            np.multiply(index, self.magnitude_steps, out = index)
+            np.abs(image, out = magnitude) # A single vectorized pass; squaring the strided real and imaginary views is several times slower
+            clip = magnitude_limit is not None # Scaled to the maximum, the magnitude index cannot exceed magnitude_steps - 1
+            if magnitude_limit is None: magnitude_limit = np.nanmax(magnitude)
+            scale = (self.magnitude_steps - 1) / magnitude_limit if magnitude_limit and np.isfinite(magnitude_limit) else 0
+            np.multiply(magnitude, scale, out = magnitude)
+            np.fmax(magnitude, 0, out = magnitude)
+            if clip: np.fmin(magnitude, self.magnitude_steps - 1, out = magnitude)
+            np.copyto(magnitude_index, magnitude, casting = "unsafe")
+            np.add(index, magnitude_index, out = index)
+
+        if out is None or out.shape != image.shape + (4,) or out.dtype != np.uint8 or not out.flags.c_contiguous: out = self.output_buffer(image.shape)
+        np.take(self.complex_lut(colormap, saturate), index, out = out.view(np.uint32).reshape(image.shape), mode = "clip")
+        return out[..., :3]
+
+    def channels_to_colors(self, images: list, channel_colors: list, limits: list = None, out: np.ndarray = None) -> np.ndarray:
+        """
+        Additive RGB composite of several real images of the same shape. Every image is scaled to its limits ([min, max] if None) and tinted with its colour, given as an RGB triplet between 0 and 1
+        """
+        shape = images[0].shape
+        buffers = self.buffers(shape)
+        [scaled, index] = [buffers[key] for key in ["phase", "index"]]
+        accumulator = getattr(self.local, "accumulator", None)
+        if accumulator is None or accumulator.shape != shape + (3,):
+            accumulator = self.local.accumulator = np.empty(shape + (3,), dtype = np.uint16)
+            self.local.tint = np.empty(shape + (3,), dtype = np.uint16)
+        tint = self.local.tint
+        accumulator.fill(0)
+        steps = self.magnitude_steps
+
+        for channel_index, (image, color) in enumerate(zip(images, channel_colors)):
+            [lower, upper] = limits[channel_index] if limits else [np.nanmin(image), np.nanmax(image)]
+            scale = (steps - 1) / (upper - lower) if upper > lower else 0
+            np.subtract(image, lower, out = scaled, casting = "unsafe")
+            np.multiply(scaled, scale, out = scaled)
+            np.fmax(scaled, 0, out = scaled)
+            np.fmin(scaled, steps - 1, out = scaled)
+            np.copyto(index, scaled, casting = "unsafe")
+            lut = np.round(np.linspace(0, 1, steps)[:, None] * 255 * np.asarray(color, dtype = float)[None, :3]).astype(np.uint16)
+            np.take(lut, index, axis = 0, out = tint, mode = "clip")
+            np.add(accumulator, tint, out = accumulator)
+
+        if out is None or out.shape != shape + (3,) or out.dtype != np.uint8: out = np.empty(shape + (3,), dtype = np.uint8)
+        np.minimum(accumulator, 255, out = accumulator)
+        np.copyto(out, accumulator, casting = "unsafe")
+        return out
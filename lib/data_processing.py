@@ -1,16 +1,16 @@
 import pint, re
 import numpy as np
-from matplotlib import colors
 from PyQt6.QtCore import QMutex, QMutexLocker
 from scipy.signal import convolve2d, fftconvolve
 from scipy.ndimage import gaussian_filter, binary_erosion
 from scipy.fft import fft2, fftshift
 from scipy.linalg import lstsq
 from scipy.spatial import distance_matrix
-from scipy.special import factorial
 from python_tsp.heuristics import solve_tsp_simulated_annealing
 from sklearn.model_selection import train_test_split
 import sklearn.gaussian_process as gp
+from .colorization import Colorizer
+from .taylor_reconstruction import TaylorReconstruction
 
 
 
@@ -40,6 +40,8 @@ class DataProcessing:
     def __init__(self):
         self.scan_processing_flags = self.create_scan_processing_flage()
         self.spec_processing_flags = self.create_spec_processing_flags()
+        self.colorizer = Colorizer() # Lookup-table colouring of complex images, with reusable buffers
+        self.taylor_reconstruction = TaylorReconstruction() # Caches the harmonics-to-derivatives matrix per (max order, Vac)
         
     def create_scan_processing_flage(self) -> dict:
         scan_processing_flags = ThreadSafeDict()
@@ -283,44 +285,15 @@ class DataProcessing:
         (index_list, distance_list) = solve_tsp_simulated_annealing(dist_matrix)
         return coordinates[index_list]
 
-    def taylor_coefficients_from_harmonics(self, harmonics_nS: np.ndarray, Vac_mV: float) -> dict:
-        max_n = 32
-        Vac_V = .001 * Vac_mV
-        
-        # The raw, uncorrected Taylor coefficients
-        D_raw = {}
-        for n in range(1, max_n + 1):
-            if n in harmonics_nS:
-                prefactor = (2 ** (n - 1) * factorial(n, exact = True)) / (Vac_V ** (n - 1))
-                D_raw[n] = harmonics_nS[n] * prefactor
-            else:
-                # If a high harmonic is missing, pad with zeros
-                D_raw[n] = np.zeros_like(harmonics_nS[1])
-
-        # Coupling matrix describing the influence of higher harmonics on lower ones
-        A = np.zeros((max_n + 1, max_n + 1))
-        for n in range(1, max_n + 1):
-            for m in range(n, max_n + 1, 2):
-                k = (m - n) // 2
-                numerator = factorial(n, exact = True)
-                denominator = (4 ** k) * factorial(k, exact = True) * factorial(n + k, exact = True)
-                A[n, m] = numerator / denominator
-        
-        A_sub = A[1:, 1:]
-        B_sub = np.linalg.inv(A_sub)
-        B = np.zeros((max_n + 1, max_n + 1))
-        B[1:, 1:] = B_sub
-
-        num_points = len(harmonics_nS[1])
-        derivatives = {n: np.zeros(num_points) for n in range(1, max_n + 1)}
-        
-        for n in range(1, max_n + 1):
-            for m in range(n, max_n + 1, 2):
-                # Apply scaling factor based on the matrix coefficient and V_ac powers
-                weight = B[n, m] / (Vac_V ** (m - n))
-                derivatives[n] += weight * D_raw[m]
-
-        return derivatives
+    def taylor_coefficients_from_harmonics(self, harmonics_nS: np.ndarray | dict, Vac_mV: float, max_order: int = 32) -> dict:
+        """
+        Derivatives {n: d^nI/dV^n} of order 1 to max_order from the harmonics {n: harmonic}, or from an array with harmonic n in row n. Missing harmonics are taken as zero
+        The arrays may have any shape, like a full map; see TaylorReconstruction
+        """
+        if isinstance(harmonics_nS, dict): harmonics = {n: harmonics_nS[n] for n in range(1, max_order + 1) if n in harmonics_nS}
+        else: harmonics = {n: harmonics_nS[n] for n in range(1, min(max_order + 1, len(harmonics_nS)))}
+        (derivatives, _) = self.taylor_reconstruction.reconstruct(harmonics, Vac_mV, max_order = max_order)
+        return {n: derivatives[n - 1] for n in range(1, max_order + 1)}
 
 
 
@@ -450,7 +423,7 @@ class DataProcessing:
             y_data = spectrum.get("y_data")
             x_data = spectrum.get("x_data")
             
-            dx = x_data[1] - x_data[0]
+            dx = np.diff(x_data) # Also valid for non-uniform (for example adaptively sampled) spectra
             dy = np.diff(y_data)
             dydx = dy / dx
             x_avg = np.convolve(x_data, np.array([0.5, 0.5]), mode = "valid")
@@ -464,9 +437,9 @@ class DataProcessing:
                 x_avg = np.convolve(x_bwd_data, np.array([0.5, 0.5]), mode = "valid")
                 
                 dy_bwd = np.diff(y_bwd_data)
-                dy_bwddx = dy_bwd / dx
+                dy_bwddx = dy_bwd / np.diff(x_bwd_data)
                 
-                spectrum.update({"y_bwd_data": x_avg, "y_bwd_data": dy_bwddx})
+                spectrum.update({"x_bwd_data": x_avg, "y_bwd_data": dy_bwddx})
     
         except Exception as e:
             error = e
@@ -503,34 +476,41 @@ class DataProcessing:
 
 
     # Image operations
-    def process_scan(self, image: np.ndarray) -> tuple[np.ndarray, dict, list, bool | str]:
+    def process_scan(self, image: np.ndarray, statistics: bool = True, out: np.ndarray = None) -> tuple[np.ndarray, dict, list, bool | str]:
+        """
+        With statistics = False (live updates) the sorted image statistics are only computed if the selected limit methods need them
+        out is an optional RGBA buffer (Colorizer.output_buffer) for the colourized projections, kept by the caller per view
+        """
         error = False
-        statistics = False
         limits = [0, 1]
 
         try:
             if np.isnan(image).all(): return (image, {}, [], "All-NaN image")
             
             # Apply matrix operations
-            (processed_scan, error) = self.operate_scan(image)
+            (processed_scan, error) = self.operate_scan(image, out = out)
             if error: raise Exception("Scan operation error: " + error)
 
             # Calculate the image statistics and display them
-            (statistics, error) = self.get_image_statistics(processed_scan)
-            if error: raise Exception("Scan statistics error: " + error)
+            image_statistics = {}
+            if statistics or self.limits_need_statistics():
+                (image_statistics, error) = self.get_image_statistics(processed_scan)
+                if error: raise Exception("Scan statistics error: " + error)
         
             # Calculate the limits
-            (limits, error) = self.calculate_limits(processed_scan)
+            (limits, error) = self.calculate_limits(processed_scan, image_statistics)
             self.scan_processing_flags.update({"min_limit": limits[0], "max_limit": limits[1]})
             if error: raise Exception("Scan limits error: " + error)
+            statistics = image_statistics
         
         except Exception as e:
             print(f"{e}")
             error = e
+            statistics = False
         
         return (processed_scan, statistics, limits, error)
 
-    def operate_scan(self, image: np.ndarray) -> tuple[np.ndarray, bool | str]:
+    def operate_scan(self, image: np.ndarray, out: np.ndarray = None) -> tuple[np.ndarray, bool | str]:
         error = False
         flags = self.scan_processing_flags.get_all()
         scan_range_nm = flags["frame"].get("domain (nm)")
@@ -572,15 +552,19 @@ class DataProcessing:
                 case "abs": image = np.abs(image)
                 case "abs^2": image = np.abs(image) ** 2
                 case "arg (b/w)": image = np.angle(image)
-                case "arg (hue)": (image, error) = self.complex_image_to_colors(image, saturate = True)
-                case "complex": (image, error) = self.complex_image_to_colors(image, saturate = False)
+                case "arg (hue)": (image, error) = self.complex_image_to_colors(image, saturate = True, out = out)
+                case "complex": (image, error) = self.complex_image_to_colors(image, saturate = False, out = out)
                 case "log(abs)": image = np.log(np.abs(image))
                 case _: image = np.real(image)
         except:
             pass    
         return (image, error)
  
-    def calculate_limits(self, image: np.ndarray) -> tuple[list, bool | str]:
+    def limits_need_statistics(self) -> bool:
+        methods = [self.scan_processing_flags.get(key) for key in ["min_method", "max_method"]]
+        return any(method in ["percentiles", "deviations"] for method in methods)
+
+    def calculate_limits(self, image: np.ndarray, statistics: dict = None) -> tuple[list, bool | str]:
         error = False
         limits = [0, 1]
         min_value = 0
@@ -591,11 +575,15 @@ class DataProcessing:
         flags = self.scan_processing_flags
         
         try:
-            (statistics, error) = self.get_image_statistics(image)
-            print(f"{statistics = }")
-            if error:
-                print(f"Something went awry: {error}")
-                raise
+            # Only sort the image if a limit method needs percentiles or deviations. Absolute limits need no statistics at all, and 'full' only needs the extremes
+            if not statistics and self.limits_need_statistics():
+                (statistics, error) = self.get_image_statistics(image)
+                if error:
+                    print(f"Something went awry: {error}")
+                    raise
+            elif not statistics:
+                methods = [flags.get(key) for key in ["min_method", "max_method"]]
+                statistics = {"min": np.nanmin(np.real(image)), "max": np.nanmax(np.real(image))} if "full" in methods else {}
             data_sorted = statistics.get("data_sorted")
             min_method = flags.get("min_method")
             max_method = flags.get("max_method")
@@ -872,7 +860,7 @@ class DataProcessing:
 
         return (image_subtracted, error)
 
-    def complex_image_to_colors(self, image: np.ndarray, saturate: bool = False) -> tuple[np.ndarray, bool | str]:
+    def complex_image_to_colors(self, image: np.ndarray, saturate: bool = False, out: np.ndarray = None) -> tuple[np.ndarray, bool | str]:
         error = False
 
         if not isinstance(image, np.ndarray):
@@ -880,18 +868,7 @@ class DataProcessing:
             return (image, error)
         
         try:
-            magnitude = np.abs(image)
-            phase = np.angle(image)
-            phase_norm = (phase + np.pi) / (2 * np.pi)
-            
-            if saturate:
-                hsv_matrix = np.dstack((phase_norm, np.ones_like(phase_norm), np.ones_like(phase_norm)))
-            else:
-                hsv_matrix = np.dstack((phase_norm, np.ones_like(phase_norm), magnitude))
-            
-            # Convert from HSV color space to RGB
-            rgb_array = colors.hsv_to_rgb(hsv_matrix)
-        
+            rgb_array = self.colorizer.complex_to_colors(image, saturate = saturate, out = out) # uint8 RGB view of the RGBA buffer out: the phase sets the hue, and the magnitude (scaled to its maximum) the brightness
         except:
             error = "Error. Computing the colorized complex image failed."
             return (image, error)
@@ -1009,8 +986,6 @@ class DataProcessing:
             n_pixels = len(data_sorted)
             data_firsthalf = data_sorted[:int(n_pixels / 2)]
             data_secondhalf = data_sorted[-int(n_pixels / 2):]
-            
-            print(f"{data_non_nan = }")
 
             range_mean = np.nanmean(data_sorted) # Calculate the mean
             Q1 = np.nanmean(data_firsthalf) # Calculate the first and third quartiles
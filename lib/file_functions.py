@@ -1,4 +1,4 @@
-import re, os, sys, yaml, pint, h5py
+import re, os, sys, time, yaml, pint, h5py
 import importlib.util
 import numpy as np
 import nanonispy2 as nap
@@ -11,19 +11,40 @@ class FileFunctions():
     def __init__(self):
         self.ureg = pint.UnitRegistry()
         self.data = DataProcessing()
+        
+        # HDF5 dataset layout policy. 'full_axes' are written completely by a single acquisition step, 'growth_axis' is the axis along which consecutive steps arrive
+        self.hdf5_layouts = {
+            "scan": {"full_axes": [2], "growth_axis": 3}, # (direction, channel, pixels, lines): chunks span whole lines and grow line by line
+            "map": {"full_axes": [0], "growth_axis": 2}, # (channel, lines, pixels): chunks span all channels of a pixel and grow pixel by pixel along a line
+            "sweep": {"full_axes": [-2, -1], "growth_axis": 0} # (sweeps, points, channels) or (points, channels): chunks span whole sweeps
+        }
+        self.hdf5_chunk_bytes = 128 * 1024 # Target chunk size. HDF5 performs best with chunks between roughly 10 kB and 1 MB
+        self.hdf5_cache = {"rdcc_nbytes": 32 * 1024 ** 2, "rdcc_nslots": 10007, "rdcc_w0": 1} # File-level chunk cache. rdcc_w0 = 1 evicts fully written chunks first, which suits acquisition order
+        self.hdf5_progress_name = "last valid index" # Name of the dataset that tracks how far a live (SWMR) measurement group has been written. SWMR does not allow attributes to change while writing, so this is a dataset
 
 
 
     # IO
-    def read_file(self, file_path: str) -> dict:
+    def read_file(self, file_path: str, max_pixels: int = None) -> dict:
+        """
+        With max_pixels, a decimated preview is returned in which the last two (image) axes are strided down to at most max_pixels
+        """
         output = {}
         match os.path.splitext(file_path)[1]:
-            case ".hdf5" | ".h5": output = self.read_hdf5(file_path)
-            case ".sxm": output = self.read_sxm(file_path)
+            case ".hdf5" | ".h5": output = self.read_hdf5(file_path, max_pixels = max_pixels)
+            case ".sxm":
+                output = self.read_sxm(file_path)
+                if max_pixels and isinstance(output.get("dataset"), np.ndarray):
+                    steps = self.preview_steps(output["dataset"].shape, max_pixels)
+                    output.update({"dataset": output["dataset"][(Ellipsis, slice(None, None, steps[0]), slice(None, None, steps[1]))], "preview": steps})
             case _: print("I do not know how to read this file")        
         return output
     
-    def read_hdf5(self, file_path: str) -> dict:
+    def preview_steps(self, shape: tuple, max_pixels: int = 256) -> tuple:
+        if len(shape) < 2: return (1, 1)
+        return tuple(max(int(np.ceil(length / max_pixels)), 1) for length in shape[-2:])
+    
+    def read_hdf5(self, file_path: str, max_pixels: int = None) -> dict:
         if not os.path.isfile(file_path):
             print("Invalid file path provided to read_hdf5")
             return {}
@@ -97,7 +118,13 @@ class FileFunctions():
                     signal_name = main_group.attrs.get("signal", "")
                     if isinstance(signal_name, bytes): signal_name = signal_name.decode("utf-8")
 
-                    dataset = main_group[signal_name][:]
+                    signal_ds = main_group[signal_name]
+                    if max_pixels: # Strided read of the image axes: only a fraction of the data is transferred
+                        steps = self.preview_steps(signal_ds.shape, max_pixels)
+                        dataset = signal_ds[(Ellipsis, slice(None, None, steps[0]), slice(None, None, steps[1]))]
+                        output_dict.update({"preview": steps})
+                    else:
+                        dataset = signal_ds[:]
                     output_dict.update({"signal": signal_name, "dataset": dataset})
 
                 if "axes" in main_group.attrs:
@@ -110,7 +137,9 @@ class FileFunctions():
                     for axis_index, axis_name in enumerate(axes_names): # Loop over axis names
                         split_name = axis_name.split()
                         if not "indices" in split_name[-1]:
-                            axis_data.update({axis_name: main_group[axis_name][:]})
+                            axis_values = main_group[axis_name][:]
+                            if "preview" in output_dict and axis_index >= len(axes_names) - 2: axis_values = axis_values[::output_dict["preview"][axis_index - len(axes_names) + 2]] # Keep the image axes consistent with the strided dataset
+                            axis_data.update({axis_name: axis_values})
                             continue
                         
                         quantity = " ".join(split_name[:-1]) # Discard 'indices' from the name
@@ -323,7 +352,7 @@ class FileFunctions():
                 
         return found_files
 
-    def load_experiment_from_file(self, file_path: str, hw_config: dict = {}, experiment_file: str = "", scantelligent_folder: str = "", scan_processing_flags = None, nanonis: object = None, mla: object = None):
+    def load_experiment_from_file(self, file_path: str, hw_config: dict = {}, experiment_file: str = "", scantelligent_folder: str = "", scan_processing_flags = None, nanonis: object = None, mla: object = None, keithley: object = None):
         """
         Finds and instantiates the 'Experiment' class from a specific file.
         """
@@ -338,7 +367,241 @@ class FileFunctions():
 
         # 2. Get the 'Experiment' class and instantiate it
         experiment = getattr(module, "Experiment")        
-        return experiment(hw_config = hw_config, experiment_file = experiment_file, scantelligent_folder = scantelligent_folder, scan_processing_flags = scan_processing_flags, nanonis = nanonis, mla = mla)
+        return experiment(hw_config = hw_config, experiment_file = experiment_file, scantelligent_folder = scantelligent_folder, scan_processing_flags = scan_processing_flags, nanonis = nanonis, mla = mla, keithley = keithley)
+
+
+
+    # HDF5 layout
+    def hdf5_chunk_shape(self, shape: tuple, dtype: np.dtype = np.float32, layout: str = "scan", maxshape: tuple = None) -> tuple:
+        """
+        Chunk shape aligned with the order in which the data arrive, so that every acquisition step touches a constant number of chunks
+        """
+        policy = self.hdf5_layouts.get(layout)
+        ndim = len(shape)
+        if not policy or ndim == 0: return None
+        
+        # Use the maximum shape for resizable datasets. Unlimited axes fall back to the current size
+        extent = [max(int(size), 1) for size in shape]
+        if maxshape: extent = [int(max_size) if max_size else size for size, max_size in zip(extent, maxshape)]
+        
+        chunk = [1] * ndim
+        for axis in policy.get("full_axes", []):
+            if -ndim <= axis < ndim: chunk[axis] = extent[axis]
+        
+        growth_axis = policy.get("growth_axis", 0)
+        if not -ndim <= growth_axis < ndim: growth_axis = 0
+        step_bytes = int(np.prod(chunk)) * np.dtype(dtype).itemsize
+        steps = max(self.hdf5_chunk_bytes // max(step_bytes, 1), 1)
+        if maxshape and maxshape[growth_axis] is None: chunk[growth_axis] = max(chunk[growth_axis], steps)
+        else: chunk[growth_axis] = min(max(chunk[growth_axis], steps), extent[growth_axis])
+        
+        return tuple(chunk)
+
+    def create_hdf5_dataset(self, group: h5py.Group, name: str, shape: tuple = None, dtype: np.dtype = np.float32, layout: str = "scan", data: np.ndarray = None, maxshape: tuple = None, compression: str = "gzip") -> h5py.Dataset:
+        """
+        Shared dataset factory for experiment files. Applies the chunk layout belonging to 'layout' together with shuffle + gzip/lzf compression and a per-dataset chunk cache
+        'compression' can be "gzip", "lzf" or None. layout = None creates a plain contiguous dataset
+        """
+        if data is not None:
+            data = np.asarray(data, dtype = dtype)
+            shape = data.shape
+        
+        chunks = self.hdf5_chunk_shape(shape, dtype = dtype, layout = layout, maxshape = maxshape) if layout else None
+        if chunks is None and maxshape is None: return group.create_dataset(name, shape = shape, dtype = dtype, data = data)
+        
+        kwargs = {"chunks": chunks if chunks else True}
+        match compression:
+            case "gzip": kwargs.update({"compression": "gzip", "compression_opts": 4, "shuffle": True}) # Level 4 is close to the maximum ratio for smooth topography at a fraction of the cost
+            case "lzf": kwargs.update({"compression": "lzf", "shuffle": True}) # Faster than gzip, somewhat larger files
+            case _: pass
+        
+        # Size the chunk cache to hold one full acquisition frame of the dataset, so that partially filled chunks are not compressed and decompressed on every write
+        frame_bytes = int(np.prod([max(int(size), 1) for size in (maxshape if maxshape and None not in maxshape else shape)])) * np.dtype(dtype).itemsize
+        rdcc_nbytes = int(np.clip(frame_bytes, 1024 ** 2, 4 * self.hdf5_cache["rdcc_nbytes"]))
+        kwargs.update({"rdcc_nbytes": rdcc_nbytes, "rdcc_nslots": self.hdf5_cache["rdcc_nslots"], "rdcc_w0": self.hdf5_cache["rdcc_w0"]})
+        
+        return group.create_dataset(name, shape = shape, dtype = dtype, data = data, maxshape = maxshape, **kwargs)
+
+    def create_hdf5_progress(self, group: h5py.Group, steps: int) -> h5py.Dataset:
+        """
+        Creates the 'last valid index' dataset of a measurement group. It holds the index of the last completed acquisition step (-1 when nothing was written yet), out of 'steps' steps
+        """
+        progress_ds = group.create_dataset(self.hdf5_progress_name, shape = (1,), dtype = np.int64, fillvalue = -1)
+        progress_ds.attrs.update({"steps": int(steps)})
+        return progress_ds
+
+
+
+    # Live files (single writer, multiple readers)
+    def open_hdf5_live(self, file_path: str) -> tuple[h5py.File, bool | str]:
+        error = False
+        live_file = None
+        
+        try: live_file = h5py.File(file_path, "r", libver = "latest", swmr = True)
+        except Exception as e: error = f"Could not open {file_path} in SWMR mode: {e}"
+        
+        return (live_file, error)
+
+    def read_hdf5_live(self, live_file: h5py.File, group_name: str, since_index: int = -1) -> tuple[dict, bool | str]:
+        """
+        Refreshes the signal dataset of a measurement group in a live file and reads it if new data were written after 'since_index'
+        """
+        error = False
+        output = {"last valid index": -1, "steps": 0, "updated": False, "finished": False, "data": None}
+        
+        try:
+            group = live_file[group_name]
+            progress_ds = group.get(self.hdf5_progress_name)
+            signal_ds = group[group.attrs.get("signal")]
+            
+            if progress_ds is not None:
+                progress_ds.refresh()
+                last_index = int(progress_ds[0])
+                steps = int(progress_ds.attrs.get("steps", 0))
+            else: # Not a live group; all data are valid
+                last_index = signal_ds.shape[0] - 1
+                steps = signal_ds.shape[0]
+            signal_ds.refresh()
+            
+            output.update({"last valid index": last_index, "steps": steps, "updated": last_index > since_index, "finished": steps > 0 and last_index >= steps - 1})
+            if last_index > since_index: output.update({"data": signal_ds[()]})
+        except Exception as e:
+            error = e
+        
+        return (output, error)
+
+    def poll_hdf5_live(self, file_path: str, group_name: str, interval_s: float = 1, timeout_s: float = None):
+        """
+        Generator that yields the output of read_hdf5_live every time new data were written, until the measurement is finished or the timeout expires
+        """
+        (live_file, error) = self.open_hdf5_live(file_path)
+        if error:
+            print(error)
+            return
+        
+        t_start = time.time()
+        last_index = -1
+        try:
+            while True:
+                (output, error) = self.read_hdf5_live(live_file, group_name, since_index = last_index)
+                if error:
+                    print(f"Problem reading the live file: {error}")
+                    break
+                if output["updated"]:
+                    last_index = output["last valid index"]
+                    yield output
+                if output["finished"]: break
+                if timeout_s is not None and time.time() - t_start > timeout_s: break
+                time.sleep(interval_s)
+        finally:
+            live_file.close()
+        return
+
+
+
+    # Stacks (virtual datasets)
+    def create_hdf5_stack(self, group: h5py.Group, name: str, datasets: list, frame_metadata: dict = {}) -> h5py.Dataset:
+        """
+        Creates a virtual dataset that presents a series of equally shaped datasets (scans, maps) as one array with a leading time/frame axis, without copying any data
+        'frame_metadata' holds arrays that are aligned with the frames, like {"time (s)": [...], "center (nm)": [...]}. The group becomes a Nexus group with the stack as its signal
+        """
+        if len(datasets) < 1: raise Exception("No datasets to stack")
+        shape = datasets[0].shape
+        dtype = datasets[0].dtype
+        for dataset in datasets:
+            if dataset.shape != shape: raise Exception(f"Cannot stack {dataset.name} with shape {dataset.shape} onto frames with shape {shape}")
+        
+        # Sources in the same file are referenced as '.', others by their path relative to this file, so that the files can be moved together
+        stack_folder = os.path.dirname(os.path.abspath(group.file.filename))
+        layout = h5py.VirtualLayout(shape = (len(datasets),) + shape, dtype = dtype)
+        for index, dataset in enumerate(datasets):
+            if os.path.abspath(dataset.file.filename) == os.path.abspath(group.file.filename): source_file = "."
+            else: source_file = os.path.relpath(os.path.abspath(dataset.file.filename), stack_folder)
+            layout[index] = h5py.VirtualSource(source_file, dataset.name, shape = shape, dtype = dtype)
+        stack_ds = group.create_virtual_dataset(name, layout, fillvalue = np.nan if np.issubdtype(dtype, np.floating) else 0)
+        
+        # Frame metadata, aligned with the first axis of the stack
+        if not "time (s)" in frame_metadata.keys(): frame_metadata = {"time (s)": np.arange(len(datasets), dtype = float)} | frame_metadata
+        for key, values in frame_metadata.items():
+            values = np.asarray(values)
+            if values.dtype.kind in ["U", "O"]: group.create_dataset(key, data = np.array([str(value).encode("utf-8") for value in values]), dtype = h5py.string_dtype(encoding = "utf-8"))
+            else: group.create_dataset(key, data = values)
+        group.create_dataset("source", data = np.array([f"{dataset.file.filename}::{dataset.name}".encode("utf-8") for dataset in datasets]), dtype = h5py.string_dtype(encoding = "utf-8"))
+        time_ds = group["time (s)"]
+        time_ds.make_scale("time (s)")
+        stack_ds.dims[0].attach_scale(time_ds)
+        
+        # Copy the (small) axis datasets of the first frame, so the stack reads like any other Nexus group
+        source_group = datasets[0].parent
+        axes = source_group.attrs.get("axes", [])
+        axes = [axis.decode("utf-8") if isinstance(axis, bytes) else str(axis) for axis in (axes.tolist() if hasattr(axes, "tolist") else axes)]
+        for key, item in source_group.items():
+            if not isinstance(item, h5py.Dataset) or item.name == datasets[0].name or key == self.hdf5_progress_name or key in group.keys(): continue
+            group.create_dataset(key, data = item[()], dtype = item.dtype)
+        
+        group.attrs.update({"NX_class": "NXdata", "signal": name, "axes": ["time (s)"] + axes})
+        return stack_ds
+
+    def stack_hdf5_files(self, file_paths: list, output_path: str, group_name: str = "stack") -> tuple[str, bool | str]:
+        """
+        Writes a small HDF5 file that stacks the main datasets of a series of experiment files (for example a scan series) as one virtual dataset
+        """
+        error = False
+        datasets = []
+        centers = []
+        angles = []
+        times = []
+        sources = []
+        
+        try:
+            files = [h5py.File(file_path, "r") for file_path in file_paths]
+            try:
+                for f in files:
+                    main_groups = [group for group in f.values() if isinstance(group, h5py.Group) and "signal" in group.attrs and "NX_class" in group.attrs]
+                    if not main_groups:
+                        print(f"No Nexus measurement group found in {f.filename}")
+                        continue
+                    signal_names = [group.attrs.get("signal") for group in main_groups]
+                    signal_names = [name.decode("utf-8") if isinstance(name, bytes) else name for name in signal_names]
+                    recorded_groups = [(group, name) for group, name in zip(main_groups, signal_names) if name in group.keys() and not group[name].is_virtual] # Do not stack stacks
+                    if not recorded_groups:
+                        print(f"No recorded measurement data found in {f.filename}")
+                        continue
+                    (main_group, signal_name) = recorded_groups[-1]
+                    
+                    grid = dict(f["grid"].attrs) if "grid" in f.keys() else {}
+                    date_time = dict(f["date_time"].attrs) if "date_time" in f.keys() else {}
+                    try: start = datetime.strptime(f"{date_time.get('date')} {date_time.get('start_time')}", "%Y/%m/%d %H:%M:%S").timestamp()
+                    except: start = np.nan
+                    
+                    datasets.append(main_group[signal_name])
+                    centers.append(grid.get("center (nm)", [np.nan, np.nan]))
+                    angles.append(grid.get("angle (deg)", np.nan))
+                    times.append(start)
+                    sources.append(os.path.basename(f.filename))
+                
+                times = np.array(times, dtype = float)
+                if np.any(np.isfinite(times)): times = times - np.nanmin(times)
+                frame_metadata = {"time (s)": times, "center (nm)": np.array(centers, dtype = float), "angle (deg)": np.array(angles, dtype = float), "file": sources}
+                
+                with h5py.File(output_path, "w") as output_file:
+                    self.create_hdf5_stack(output_file.create_group(group_name), group_name, datasets, frame_metadata = frame_metadata)
+            finally:
+                [f.close() for f in files]
+        except Exception as e:
+            error = e
+        
+        return (output_path, error)
+
+    def iterate_hdf5_stack(self, stack_ds: h5py.Dataset, frames_per_block: int = 1):
+        """
+        Generator that streams through a stack block by block, yielding (frame_slice, block), so that stack-wide analyses do not need to load the full stack into memory
+        """
+        n_frames = stack_ds.shape[0]
+        for start in range(0, n_frames, frames_per_block):
+            frame_slice = slice(start, min(start + frames_per_block, n_frames))
+            yield (frame_slice, stack_ds[frame_slice])
+        return
 
 
 
@@ -0,0 +1,133 @@
+import os
+from collections import OrderedDict
+from PyQt6 import QtCore
+
+
+
+class FileLoader(QtCore.QObject):
+    """
+    Loads data files in the background for browsing through a folder
+    A requested file first appears as a decimated preview (for HDF5 files, where a strided read transfers only part of the data), then at full resolution. Loaded files are kept in a small LRU cache, and the previous and next files in the folder ordering are prefetched
+    """
+    preview = QtCore.pyqtSignal(str, dict) # file path, decimated file data
+    loaded = QtCore.pyqtSignal(str, dict) # file path, full file data
+    preview_ready = QtCore.pyqtSignal(str, dict) # Internal: emitted from the worker thread
+
+    def __init__(self, file_functions, processing, cache_size: int = 6, preview_pixels: int = 256, extensions: list = [".sxm", ".hdf5", ".h5"]):
+        super().__init__()
+        self.file_functions = file_functions
+        self.processing = processing
+        self.cache_size = cache_size
+        self.preview_pixels = preview_pixels
+        self.extensions = extensions
+
+        self.cache = OrderedDict() # file path -> (modification time, file data), least recently used first
+        self.in_flight = {} # processing job key -> file path
+        self.orderings = {} # folder -> (folder modification time, sorted file paths)
+        self.current = None
+        self.preview_ready.connect(self.emit_preview, QtCore.Qt.ConnectionType.QueuedConnection)
+        self.processing.failed.connect(self.job_failed)
+
+
+
+    # Requests (GUI thread)
+    def request(self, file_path: str) -> None:
+        self.current = file_path
+        cached = self.get_cached(file_path)
+        if cached is not None:
+            self.loaded.emit(file_path, cached)
+            self.prefetch(file_path)
+            return
+
+        if file_path in self.in_flight.values(): return # Already being prefetched: it is shown when it arrives
+        self.submit("open_file", file_path, preview = True)
+        return
+
+    def step(self, offset: int = 1) -> str | None:
+        """
+        Requests the file offset positions away from the current one in the folder ordering. Returns its path
+        """
+        if not isinstance(self.current, str): return None
+        file_path = self.neighbour(self.current, offset)
+        if file_path is not None: self.request(file_path)
+        return file_path
+
+    def neighbour(self, file_path: str, offset: int = 1) -> str | None:
+        ordering = self.ordering(os.path.dirname(file_path))
+        if not file_path in ordering: return None
+        index = ordering.index(file_path) + offset
+        if index < 0 or index >= len(ordering): return None
+        return ordering[index]
+
+    def ordering(self, folder: str) -> list:
+        try: folder_mtime = os.path.getmtime(folder)
+        except OSError: return []
+        (mtime, file_paths) = self.orderings.get(folder, (None, []))
+        if mtime != folder_mtime: # New files appeared (or disappeared) since the last listing
+            file_paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if os.path.splitext(name)[1] in self.extensions)
+            self.orderings[folder] = (folder_mtime, file_paths)
+        return file_paths
+
+    def prefetch(self, file_path: str) -> None:
+        for index, offset in enumerate([1, -1]):
+            neighbour = self.neighbour(file_path, offset)
+            if neighbour is None or neighbour in self.cache or neighbour in self.in_flight.values(): continue
+            self.submit(f"prefetch_{index}", neighbour, preview = False)
+        return
+
+    def submit(self, key: str, file_path: str, preview: bool = False) -> None:
+        self.in_flight[key] = file_path
+        self.processing.submit(key, self.load, file_path, preview, callback = lambda result, key = key, file_path = file_path: self.store(key, file_path, result))
+        return
+
+
+
+    # Cache
+    def get_cached(self, file_path: str) -> dict | None:
+        if not file_path in self.cache: return None
+        (mtime, file_data) = self.cache[file_path]
+        try:
+            if os.path.getmtime(file_path) != mtime: # The file changed on disk
+                del self.cache[file_path]
+                return None
+        except OSError:
+            return None
+        self.cache.move_to_end(file_path)
+        return file_data
+
+    def store(self, key: str, file_path: str, result: tuple) -> None:
+        if self.in_flight.get(key) == file_path: del self.in_flight[key]
+        (mtime, file_data) = result
+        if not isinstance(file_data, dict) or not file_data: return
+
+        self.cache[file_path] = (mtime, file_data)
+        self.cache.move_to_end(file_path)
+        while len(self.cache) > self.cache_size: self.cache.popitem(last = False)
+
+        if file_path == self.current:
+            self.loaded.emit(file_path, file_data)
+            self.prefetch(file_path)
+        return
+
+    def clear(self) -> None:
+        self.cache.clear()
+        self.orderings.clear()
+        return
+
+    def job_failed(self, key: str, version: int, error: str) -> None:
+        self.in_flight.pop(key, None) # The processing service reports the error itself
+        return
+
+
+
+    # Worker thread
+    def load(self, file_path: str, preview: bool = False) -> tuple[float, dict]:
+        mtime = os.path.getmtime(file_path)
+        if preview and os.path.splitext(file_path)[1] in [".hdf5", ".h5"]:
+            preview_data = self.file_functions.read_file(file_path, max_pixels = self.preview_pixels)
+            if "preview" in preview_data and preview_data.get("preview") != (1, 1): self.preview_ready.emit(file_path, preview_data)
+        return (mtime, self.file_functions.read_file(file_path))
+
+    def emit_preview(self, file_path: str, preview_data: dict) -> None:
+        if file_path == self.current and not file_path in self.cache: self.preview.emit(file_path, preview_data)
+        return
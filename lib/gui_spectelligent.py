@@ -101,6 +101,8 @@ class SpectelligentGUI(QtWidgets.QMainWindow):
 
             "start_spectroscopy": MSB(tooltip = "Acquire spectrum", size = 28, click_to_toggle = False, states = [{"name": "idle", "color": sct_black, "icon": icons.get("start_spectrum")},
                                                                                                                   {"name": "running", "color": sct_blue, "icon": icons.get("stop_spectrum")}]),
+            "sts_adaptive": MSB(icon = icons.get("gaussian_process"), size = 28, states = [{"name": "off", "color": sct_black, "tooltip": "Uniform sampling of the x axis (fast axis)"},
+                                                                                              {"name": "on", "color": sct_blue, "tooltip": "Adaptive sampling of the x axis of a 1D sweep: the x points are measured first,\nafter which points are added where the spectrum deviates most from a straight line"}]),
             "tia_correct": MSB(icon = icons.get("tia_response"), size = 28, states = [{"name": "off", "color": sct_black, "tooltip": "Do not correct for the tia response"},
                                                                                       {"name": "on", "color": sct_blue, "tooltip": "Correct for the tia response"}]),
             
@@ -133,6 +135,9 @@ class SpectelligentGUI(QtWidgets.QMainWindow):
                                                    {"name": "f", "icon": icons.get("f"), "tooltip": "Perform a frequency sweep on the y axis (slow axis)"},
                                                    {"name": "V_keithley", "icon": icons.get("V_keithley"), "tooltip": "Perform a Keithley voltage sweep on the y axis (slow axis)"}]),
 
+            "sts_snake": MSB(size = 28, states = [{"name": "off", "tooltip": "Raster: every line of the x axis (fast axis) starts at its start value", "icon": icons.get("lines"), "color": sct_black},
+                                                  {"name": "on", "tooltip": "Snake: the x axis (fast axis) alternates direction from line to line,\nso that it never jumps back", "icon": icons.get("path"), "color": sct_blue}]),
+
             "get_pixel_nanonis": MSB(tooltip = "Click to receive a pixel from Nanonis", icon = icons.get("nanonis")),
             "get_pixel_mla": MSB(tooltip = "Click to receive a pixel from the MLA", icon = icons.get("mla")),
             
@@ -270,6 +275,9 @@ class SpectelligentGUI(QtWidgets.QMainWindow):
             "sts_t_int": LE(tooltip = "integration time per data point in units\nof the modulator time constant", value = 10, unit = "t", limits = [1, 10000], digits = 0, trigger_warnings = [lambda value: value < 3], max_width = 80),
             "sts_t_settle": LE(tooltip = "settling time per data point in units\nof the modulator time constant\nRecommended value: 2", value = 2, unit = "t", limits = [0, 10000], digits = 0, trigger_warnings = [lambda value: value < 2], max_width = 80),
             "sts_t_feedback": LE(tooltip = "feedback dwell time in between measurements\nin units of the modulator time constant", value = 4, unit = "t", limits = [0, 10000], digits = 0, trigger_warnings = [lambda value: value < 2], max_width = 80),
+            "sts_rel_error": LE(tooltip = "target relative error of the first harmonic per data point\nIntegration continues in blocks of t_int until it is reached\n0 = fixed integration time", value = 0, unit = "%", limits = [0, 100], digits = 1, max_width = 80),
+            "sts_adaptive_points": LE(tooltip = "maximum number of data points of an adaptive sweep", value = 201, unit = "pts", limits = [3, 100000], digits = 0, max_width = 80),
+            "sts_t_max": LE(tooltip = "maximum integration time per data point with a target\nrelative error, in units of the modulator time constant", value = 100, unit = "t", limits = [1, 100000], digits = 0, max_width = 80),
             
             "sts_t_int_ms": LE(tooltip = "integration time per data point", value = 1, unit = "ms", limits = [0, 100000], digits = 2, max_width = 80),
             "sts_t_settle_ms": LE(tooltip = "settling time per data point", value = 1, unit = "ms", limits = [0, 100000], digits = 2, max_width = 80),
@@ -458,6 +466,9 @@ class SpectelligentGUI(QtWidgets.QMainWindow):
         [layouts["spectroscopy_settings"].addWidget(buttons[key], 0, 4 + index, 2, 1) for index, key in enumerate(["blank_modulators", "intermediate_feedback"])]
         [layouts["spectroscopy_settings"].addWidget(line_edits[f"sts_{key}_feedback"], index % 2, 6 + int(index / 2)) for index, key in enumerate(["V", "I", "p", "t_const", "t", "z"])]
         layouts["spectroscopy_settings"].addWidget(line_edits[f"sts_t_feedback_ms"], 0, 9)
+        [layouts["spectroscopy_settings"].addWidget(line_edits[name], index, 10) for index, name in enumerate(["sts_rel_error", "sts_t_max"])]
+        layouts["spectroscopy_settings"].addWidget(buttons["sts_adaptive"], 0, 11, 2, 1)
+        layouts["spectroscopy_settings"].addWidget(line_edits["sts_adaptive_points"], 0, 12)
         
         layouts["modulators"].addWidget(self.buttons[f"no_modulators"], 0, 0, 2, 1)
         [layouts["modulators"].addWidget(self.checkboxes[f"modulator_{index}"], int(index / 16), 1 + index % 16) for index in range(32)]
@@ -486,7 +497,7 @@ class SpectelligentGUI(QtWidgets.QMainWindow):
         layouts["parameter_space"].addLayout(layouts["parameter_space_getset"])
                 
         [layouts["xy_plot_y"].addWidget(widget) for widget in [line_edits["sts_y_end"], buttons["sts_y_axis"], line_edits["sts_y_points"], line_edits["sts_y_start"]]]
-        [layouts["xy_plot_x"].addWidget(widget) for widget in [line_edits["sts_x_start"], buttons["sts_x_axis"], line_edits["sts_x_points"], line_edits["sts_x_end"]]]
+        [layouts["xy_plot_x"].addWidget(widget) for widget in [line_edits["sts_x_start"], buttons["sts_x_axis"], buttons["sts_snake"], line_edits["sts_x_points"], line_edits["sts_x_end"]]]
         layouts["xy_plot"].addLayout(layouts["xy_plot_y"], 0, 0)
         layouts["xy_plot"].addWidget(self.parameter_space_plot, 0, 1)
         layouts["xy_plot"].addLayout(layouts["xy_plot_x"], 1, 1)
@@ -0,0 +1,215 @@
+import time, queue, h5py
+import numpy as np
+from PyQt6 import QtCore
+
+
+
+class HDF5Writer(QtCore.QThread):
+    """
+    Write-behind writer for experiment files. The acquisition loop enqueues (dataset, selection, array) items and returns immediately; this thread writes them to disk
+    Consecutive writes to the same selection are coalesced (only the last one is written), writes to adjacent indices along one axis of a dataset are merged into a single slice write, also when writes to other datasets come in between
+    """
+    message = QtCore.pyqtSignal(str, str) # First argument is the message string, second argument is the message type, like 'warning', 'code', 'result', 'message', or 'error'
+
+    def __init__(self, output_file: h5py.File, max_queue_mb: float = 256, flush_interval_s: float = 2.0, max_batch: int = 4096):
+        super().__init__()
+        self.output_file = output_file
+        self.max_queue_bytes = int(max_queue_mb * 1024 ** 2) # Back-pressure threshold: enqueueing blocks while more than this many bytes are waiting to be written
+        self.flush_interval_s = flush_interval_s
+        self.max_batch = max_batch
+
+        self.queue = queue.Queue()
+        self.mutex = QtCore.QMutex()
+        self.drained = QtCore.QWaitCondition()
+        self.pending_bytes = 0
+        self.error = False
+        self.timed_out = False # close() timed out while the thread was still writing
+        self.closed = False
+        self.written_items = 0
+        self.coalesced_items = 0
+
+
+
+    # Producer side (acquisition thread)
+    def write(self, dataset: h5py.Dataset, selection: tuple | int | slice, array: np.ndarray) -> None:
+        array = np.array(array, copy = True) # The caller may reuse its buffer after this call
+        self.enqueue(("write", dataset, self.normalize_selection(selection), array), array.nbytes)
+        return
+
+    def resize(self, dataset: h5py.Dataset, shape: tuple) -> None:
+        self.enqueue(("resize", dataset, tuple(shape), None), 0)
+        return
+
+    def set_attrs(self, obj: h5py.HLObject, attrs: dict) -> None:
+        self.enqueue(("attrs", obj, None, dict(attrs)), 0)
+        return
+
+    def enqueue(self, item: tuple, nbytes: int) -> None:
+        if self.closed: raise Exception("The HDF5 writer is closed")
+        if self.error: raise Exception(f"The HDF5 writer failed: {self.error}")
+
+        with QtCore.QMutexLocker(self.mutex):
+            while self.pending_bytes > self.max_queue_bytes and self.isRunning(): self.drained.wait(self.mutex, 100) # Back-pressure
+            self.pending_bytes += nbytes
+        self.queue.put(item + (nbytes,))
+        return
+
+    def close(self, timeout_s: float = 60) -> bool | str:
+        """
+        Write everything that is still queued, flush the file and stop the thread. Safe to call more than once
+        If the thread is still writing after timeout_s, the error is a TimeoutError and the file must not be closed yet; call close() again to keep waiting
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None) # Sentinel
+            if not self.isRunning(): self.process_batch(self.drain()) # The thread was never started: write synchronously
+
+        if self.isRunning() and not self.wait(int(timeout_s * 1000)):
+            self.error = TimeoutError(f"The HDF5 writer did not finish within {timeout_s} s. {self.pending_bytes} bytes have not been written yet")
+            self.timed_out = True
+            return self.error
+        if self.timed_out: (self.error, self.timed_out) = (False, False) # A later call waited until everything was written
+
+        try: self.output_file.flush()
+        except Exception as e:
+            if not self.error: self.error = e
+        return self.error
+
+
+
+    # Consumer side (writer thread)
+    def run(self) -> None:
+        t_flush = time.time()
+        running = True
+
+        while running:
+            try: first = self.queue.get(timeout = min(self.flush_interval_s, .2))
+            except queue.Empty: first = False
+
+            batch = [] if first is False else [first]
+            if first is not False: batch.extend(self.drain())
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)] + [item for item in batch[batch.index(None) + 1:] if item is not None]
+
+            self.process_batch(batch)
+
+            if time.time() - t_flush > self.flush_interval_s or not running:
+                try: self.output_file.flush()
+                except Exception as e: self.report(e)
+                t_flush = time.time()
+        return
+
+    def drain(self) -> list:
+        batch = []
+        while len(batch) < self.max_batch:
+            try: batch.append(self.queue.get_nowait())
+            except queue.Empty: break
+        return batch
+
+    def process_batch(self, batch: list) -> None:
+        if not batch: return
+
+        operations = self.coalesce([item for item in batch if item is not None])
+        for (operation, target, selection, payload, nbytes) in operations:
+            try:
+                match operation:
+                    case "write": target[selection] = self.assemble(payload)
+                    case "resize": target.resize(selection)
+                    case "attrs": target.attrs.update(payload)
+                    case _: pass
+                self.written_items += 1
+            except Exception as e:
+                self.report(e)
+
+        released = sum(item[-1] for item in batch if item is not None)
+        with QtCore.QMutexLocker(self.mutex):
+            self.pending_bytes = max(self.pending_bytes - released, 0)
+            self.drained.wakeAll()
+        return
+
+    def coalesce(self, batch: list) -> list:
+        operations = []
+        last_write = {} # (dataset id, selection key) -> position in operations
+        mergeable = {} # Dataset id -> position of the last write to that dataset
+
+        for item in batch:
+            (operation, target, selection, payload, nbytes) = item
+            if operation != "write":
+                last_write = {key: position for key, position in last_write.items() if key[0] != id(target)} # Do not coalesce writes across a resize or attribute update
+                mergeable.pop(id(target), None)
+                operations.append(item)
+                continue
+
+            # A later write to an identical selection supersedes the earlier one
+            key = (id(target), self.selection_key(selection))
+            if key in last_write:
+                position = last_write.pop(key)
+                operations[position] = None
+                if mergeable.get(id(target)) == position: mergeable.pop(id(target))
+                self.coalesced_items += 1
+
+            # Merge with the last write to the same dataset if the selections are adjacent along one axis. Writes to other datasets in between, like the errors and the progress of a pixel, do not matter
+            position = mergeable.get(id(target))
+            merged = self.merge_writes(operations[position], item) if position is not None else None
+            if merged is not None:
+                operations[position] = merged
+                last_write = {k: p for k, p in last_write.items() if p != position}
+                self.coalesced_items += 1
+                continue
+
+            operations.append(item)
+            last_write[key] = mergeable[id(target)] = len(operations) - 1
+
+        return [operation for operation in operations if operation is not None]
+
+    def merge_writes(self, previous: tuple, item: tuple) -> tuple | None:
+        (operation_0, target_0, selection_0, payload_0, nbytes_0) = previous
+        (operation_1, target_1, selection_1, payload_1, nbytes_1) = item
+        if operation_0 != "write" or target_0 is not target_1 or len(selection_0) != len(selection_1): return None
+
+        differing = [axis for axis, (s0, s1) in enumerate(zip(selection_0, selection_1)) if self.selection_key((s0,)) != self.selection_key((s1,))]
+        if len(differing) != 1: return None
+        axis = differing[0]
+        [s0, s1] = [selection_0[axis], selection_1[axis]]
+        array_axis = sum(1 for entry in selection_0[:axis] if isinstance(entry, slice)) # Integer indices drop a dimension from the written array
+
+        # The pieces are concatenated once, when the write is executed (see assemble)
+        try:
+            if isinstance(s0, int) and isinstance(s1, int) and s1 == s0 + 1 and np.shape(payload_0) == np.shape(payload_1): # Two single indices become a slice
+                payload = {"axis": array_axis, "pieces": [np.expand_dims(payload_0, array_axis), np.expand_dims(payload_1, array_axis)]}
+                new_entry = slice(s0, s1 + 1)
+            elif isinstance(s0, slice) and s0.step in [None, 1] and isinstance(s1, int) and s1 == s0.stop: # Extend an earlier merged slice
+                payload = payload_0 if isinstance(payload_0, dict) else {"axis": array_axis, "pieces": [payload_0]}
+                piece = np.expand_dims(payload_1, array_axis)
+                if np.delete(np.shape(payload["pieces"][0]), array_axis).tolist() != np.delete(np.shape(piece), array_axis).tolist(): return None
+                payload["pieces"].append(piece)
+                new_entry = slice(s0.start, s1 + 1)
+            else:
+                return None
+        except Exception:
+            return None
+
+        selection = selection_0[:axis] + (new_entry,) + selection_0[axis + 1:]
+        return ("write", target_0, selection, payload, nbytes_0 + nbytes_1)
+
+    def assemble(self, payload: np.ndarray | dict) -> np.ndarray:
+        if isinstance(payload, dict): return np.concatenate(payload["pieces"], axis = payload["axis"])
+        return payload
+
+    def normalize_selection(self, selection: tuple | int | slice) -> tuple:
+        if not isinstance(selection, tuple): selection = (selection,)
+        return tuple(int(entry) if isinstance(entry, int | np.integer) else entry for entry in selection)
+
+    def selection_key(self, selection: tuple) -> tuple:
+        key = []
+        for entry in selection:
+            if isinstance(entry, slice): key.append(("slice", entry.start, entry.stop, entry.step))
+            elif isinstance(entry, list | np.ndarray): key.append(("array",) + tuple(np.ravel(entry).tolist())) # Fancy indices are not hashable
+            else: key.append(entry)
+        return tuple(key)
+
+    def report(self, error: Exception) -> None:
+        if not self.error: self.error = error
+        self.message.emit(f"HDF5 writer error: {error}", "error")
+        return
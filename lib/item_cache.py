@@ -0,0 +1,139 @@
+import os, tempfile, h5py
+import numpy as np
+from PyQt6 import QtGui
+
+
+
+class ItemCache:
+    """
+    Keeps the saved ArrayItems within a memory budget
+    Items are listed most recently saved first. When the arrays of the resident items exceed budget_mb, the least recently used items spill their data array to a temporary HDF5 file and display a thumbnail instead. An item is restored transparently when it is shown again
+    While spilled, item.array is the HDF5 dataset, so slicing it (getSlice) still works
+    """
+    def __init__(self, budget_mb: float = 2048, thumbnail_pixels: int = 128, max_items: int = 500, spill_folder: str = None):
+        self.budget_bytes = int(budget_mb * 1024 ** 2)
+        self.thumbnail_pixels = thumbnail_pixels
+        self.max_items = max_items
+        self.spill_folder = spill_folder
+        self.items = [] # Most recently saved first. The list is modified in place, so it can be shared with the GUI
+        self.last_used = {} # id(item) -> use counter, for the least-recently-used order
+        self.use_counter = 0
+        self.spilled = {} # id(item) -> spill group name, and the transform and levels of the full-resolution image
+        self.spill_file = None
+        self.spill_path = None
+
+
+
+    def add(self, item) -> None:
+        if item in self.items: self.items.remove(item)
+        self.items.insert(0, item)
+        for old_item in self.items[self.max_items :]: self.forget(old_item)
+        del self.items[self.max_items :]
+        self.touch(item)
+        return
+
+    def touch(self, item) -> None:
+        """
+        Marks an item as used, restoring its data if they were spilled. The order of self.items is not changed
+        """
+        self.restore(item)
+        self.use_counter += 1
+        self.last_used[id(item)] = self.use_counter
+        self.enforce()
+        return
+
+    def resident_bytes(self) -> int:
+        return sum(self.item_bytes(item) for item in self.items if not id(item) in self.spilled)
+
+    def item_bytes(self, item) -> int:
+        nbytes = 0
+        for array in [getattr(item, "array", None), getattr(item, "image", None), getattr(item, "row_buffer", None)]:
+            if isinstance(array, np.ndarray): nbytes += array.nbytes
+        image = getattr(item, "image", None)
+        if isinstance(image, np.ndarray): nbytes += 4 * image.shape[0] * image.shape[1] # The rendered ARGB QImage
+        return nbytes
+
+    def enforce(self) -> None:
+        resident = self.resident_bytes()
+        by_use = sorted(self.items, key = lambda item: self.last_used.get(id(item), 0))
+        for item in by_use[:-1]: # Never spill the most recently used item
+            if resident <= self.budget_bytes: break
+            if id(item) in self.spilled: continue
+            freed = self.item_bytes(item)
+            if self.spill(item): resident -= freed
+        return
+
+
+
+    # Spilling
+    def open_spill_file(self) -> h5py.File:
+        if self.spill_file is None:
+            (handle, self.spill_path) = tempfile.mkstemp(prefix = "scantelligent_items_", suffix = ".hdf5", dir = self.spill_folder)
+            os.close(handle)
+            self.spill_file = h5py.File(self.spill_path, "w")
+        return self.spill_file
+
+    def spill(self, item) -> bool:
+        array = getattr(item, "array", None)
+        image = getattr(item, "image", None)
+        if not isinstance(array, np.ndarray) or not isinstance(image, np.ndarray) or image.ndim < 2: return False
+
+        try:
+            spill_file = self.open_spill_file()
+            group_name = f"item_{id(item)}"
+            if group_name in spill_file: del spill_file[group_name]
+            group = spill_file.create_group(group_name)
+            group.create_dataset("array", data = array)
+            group.create_dataset("image", data = image)
+
+            # Show a strided thumbnail, scaled up so that it covers the same area as the full image
+            transform = QtGui.QTransform(item.transform())
+            steps = [max(int(np.ceil(length / self.thumbnail_pixels)), 1) for length in image.shape[:2]]
+            thumbnail = np.array(image[:: steps[0], :: steps[1]], copy = True)
+            levels = item.levels
+            item.setImage(thumbnail)
+            if levels is not None: item.setLevels(levels)
+            item.setTransform(QtGui.QTransform.fromScale(steps[1], steps[0]) * transform)
+            item.row_buffer = None
+
+            item.array = group["array"] # Slicing keeps working, it now reads from disk
+            self.spilled[id(item)] = {"group": group_name, "transform": transform, "levels": levels}
+        except Exception as e:
+            print(f"Could not spill item {getattr(item, 'name', '')}: {e}")
+            return False
+        return True
+
+    def restore(self, item) -> bool:
+        entry = self.spilled.pop(id(item), None)
+        if entry is None: return False
+
+        try:
+            group = self.spill_file[entry["group"]]
+            item.array = group["array"][()]
+            item.setImage(group["image"][()])
+            if entry["levels"] is not None: item.setLevels(entry["levels"])
+            item.setTransform(entry["transform"])
+            del self.spill_file[entry["group"]]
+        except Exception as e:
+            print(f"Could not restore item {getattr(item, 'name', '')}: {e}")
+            return False
+        return True
+
+    def forget(self, item) -> None:
+        self.last_used.pop(id(item), None)
+        entry = self.spilled.pop(id(item), None)
+        if entry is not None and self.spill_file is not None:
+            try: del self.spill_file[entry["group"]]
+            except Exception: pass
+        return
+
+    def close(self) -> None:
+        self.spilled = {}
+        if self.spill_file is not None:
+            try: self.spill_file.close()
+            except Exception: pass
+            self.spill_file = None
+        if isinstance(self.spill_path, str) and os.path.isfile(self.spill_path):
+            try: os.remove(self.spill_path)
+            except OSError: pass
+        return
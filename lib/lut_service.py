@@ -0,0 +1,111 @@
+import os, time, threading, h5py
+import numpy as np
+from .tia_correction import TIACorrection
+
+
+
+class LUTService:
+    """
+    Process-wide access to the look-up tables in sys/LUTs.hdf5 (TIA corrections like 'LN 10^9', the 'DT-670' temperature diode calibration)
+    The file is read once per process; use LUTService.shared(path) instead of instantiating. Large contiguous datasets are memory-mapped instead of read. The tables are reloaded when the modification time of the file changes
+    Interpolators are built when the tables are loaded: evaluate() maps arrays of voltages or frequencies in one vectorized call
+    """
+    instances = {} # Absolute file path -> LUTService
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, file_path: str) -> "LUTService":
+        file_path = os.path.abspath(file_path)
+        with cls.instances_lock:
+            if not file_path in cls.instances: cls.instances[file_path] = cls(file_path)
+            return cls.instances[file_path]
+
+    def __init__(self, file_path: str, mmap_bytes: int = 4 * 1024 ** 2, check_interval: float = 1.):
+        self.file_path = file_path
+        self.mmap_bytes = mmap_bytes # Datasets larger than this are memory-mapped
+        self.check_interval = check_interval # Seconds between checks of the file modification time
+        self.lock = threading.RLock()
+        self.mtime = None
+        self.last_check = -np.inf
+        self.tables = {} # Name -> np.ndarray (or np.memmap)
+        self.interpolators = {} # Name -> callable evaluating the table on an array
+        self.corrections = {} # Name -> TIACorrection, for the complex (2, n) tables
+
+
+
+    # Loading
+    def refresh(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_check < self.check_interval and self.mtime is not None: return
+            self.last_check = now
+            try: mtime = os.path.getmtime(self.file_path)
+            except OSError: return
+            if mtime != self.mtime: self.load(mtime)
+        return
+
+    def load(self, mtime: float) -> None: # Called with the lock held
+        tables = {}
+        try:
+            with h5py.File(self.file_path, "r") as f:
+                for name, dataset in f.items():
+                    if isinstance(dataset, h5py.Dataset): tables[name] = self.read_dataset(dataset)
+        except Exception as e:
+            print(f"Could not read the look-up tables from {self.file_path}: {e}")
+            return
+
+        self.tables = tables
+        self.interpolators = {}
+        self.corrections = {}
+        for name, table in tables.items():
+            try: self.build_interpolator(name, table)
+            except Exception as e: print(f"Could not build an interpolator for look-up table {name}: {e}")
+        self.mtime = mtime
+        return
+
+    def read_dataset(self, dataset: h5py.Dataset) -> np.ndarray:
+        offset = dataset.id.get_offset()
+        contiguous = dataset.chunks is None and dataset.compression is None and offset is not None
+        if contiguous and dataset.nbytes > self.mmap_bytes: return np.memmap(self.file_path, dtype = dataset.dtype, mode = "r", offset = offset, shape = dataset.shape)
+        return dataset[()]
+
+    def build_interpolator(self, name: str, table: np.ndarray) -> None:
+        if table.ndim != 2: return
+        if table.shape[0] == 2 and np.iscomplexobj(table): # TIA correction: frequencies (Hz) and complex corrections
+            correction = TIACorrection(np.asarray(table))
+            self.corrections[name] = correction
+            self.interpolators[name] = correction.vector
+        elif table.shape[1] == 2: # Calibration curve: input values in the first column, output values in the second
+            order = np.argsort(table[:, 0])
+            (x_values, y_values) = (np.array(table[order, 0], dtype = float), np.array(table[order, 1], dtype = float))
+            self.interpolators[name] = lambda x, x_values = x_values, y_values = y_values: np.interp(x, x_values, y_values)
+        return
+
+
+
+    # Access
+    def keys(self) -> list:
+        self.refresh()
+        return list(self.tables.keys())
+
+    def get(self, name: str, default = None) -> np.ndarray:
+        self.refresh()
+        return self.tables.get(name, default)
+
+    def get_tables(self, names: list = None) -> dict:
+        self.refresh()
+        return {name: table for name, table in self.tables.items() if names is None or name in names}
+
+    def evaluate(self, name: str, values: np.ndarray | float) -> np.ndarray | float:
+        """
+        Evaluates the table on an array of values, for example the temperature (K) of the 'DT-670' diode for an array of voltages, or the complex TIA correction for an array of frequencies
+        """
+        self.refresh()
+        interpolator = self.interpolators.get(name)
+        if interpolator is None: raise KeyError(f"No interpolator for look-up table {name}")
+        if np.ndim(values) == 0 and name in self.corrections: return interpolator(np.atleast_1d(values))[0]
+        return interpolator(values)
+
+    def tia_correction(self, name: str) -> TIACorrection | None:
+        self.refresh()
+        return self.corrections.get(name)
@@ -0,0 +1,236 @@
+import time, threading
+import numpy as np
+
+
+
+class SimulatedMLA:
+    """
+    Stand-in for mla_api.MLA, implementing the part of its interface that MLAAPI uses
+    Output port 1 drives a nonlinear tunnel junction I(V) = I0 * sinh(V / V0) in parallel with a tip-sample capacitance. The junction current goes through a transimpedance amplifier with a first-order bandwidth, whose output is input port 2. Input port 1 is a loopback of output port 1 (the reference)
+    Pixels are demodulated exactly from one period 1 / df of the simulated signals, so that intermodulation products appear at the right tones. White noise is added to every pixel, and a pixel acquired while the settings change is a mix of the old and the new response
+    Timing: get_pixels waits for the pixels to be 'measured' (1 / df each, scaled by time_scale), and every call to the instrument takes latency_ms. A setter with wait_for_effect = True returns after the pixel during which the change happened
+    """
+    def __init__(self, settings: dict = {}):
+        defaults = {"I0 (pA)": 50., "V0 (V)": .4, "C (fF)": 20., "gain (V/pA)": 1E-3, "tia_bandwidth (Hz)": 2000., "noise (V/rtHz)": 2E-6, "latency_ms": 1., "time_scale": 1., "seed": None}
+        self.settings = defaults | dict(settings)
+        self.lockin = SimulatedLockin(self)
+        self.hardware = SimulatedHardware()
+        self.osc = SimulatedOscilloscope()
+        self.feedback = SimulatedFeedback()
+        self.connected = False
+
+    def connect(self, server_text_callback: object = None, ping_attempts: int = 1) -> None:
+        self.lockin.wait_latency()
+        self.connected = True
+        if callable(server_text_callback): server_text_callback("Connected to the simulated MLA")
+        return
+
+    def disconnect(self) -> None:
+        self.connected = False
+        self.lockin.running = False
+        return
+
+
+
+class SimulatedLockin:
+    def __init__(self, mla: SimulatedMLA):
+        self.mla = mla
+        self.nr_input_freq = 32
+        self.nr_output_ports = 2
+        self.rng = np.random.default_rng(mla.settings.get("seed"))
+        self.lock = threading.Lock()
+
+        self.df = 100.
+        self.frequencies = np.arange(self.nr_input_freq) * self.df
+        self.amplitudes = np.zeros(self.nr_input_freq) # V
+        self.phases = np.zeros(self.nr_input_freq) # rad
+        self.output_masks = np.zeros((self.nr_output_ports, self.nr_input_freq), dtype = int)
+        self.input_multiplexer = np.ones(self.nr_input_freq, dtype = int)
+        self.dc_offsets = np.zeros(self.nr_output_ports) # V
+
+        self.running = False
+        self.response = None # Noise-free pixel for the current settings, recomputed after every change
+        self.previous_response = None # Response before the last change, for the pixel during which the change happened
+        self.pixel_clock = 0 # Number of pixels 'measured' since start_lockin()
+        self.next_pixel_time = 0
+
+
+
+    # Timing
+    def wait_latency(self) -> None:
+        latency_s = self.mla.settings["latency_ms"] / 1000
+        if latency_s > 0: time.sleep(latency_s)
+        return
+
+    def start_lockin(self) -> None:
+        self.wait_latency()
+        self.running = True
+        self.next_pixel_time = time.perf_counter()
+        return
+
+    def stop_lockin(self) -> None:
+        self.wait_latency()
+        self.running = False
+        return
+
+    def wait_for_new_pixels(self, number: int = 1) -> None:
+        pixel_time = self.mla.settings["time_scale"] / self.df
+        self.next_pixel_time = max(self.next_pixel_time, time.perf_counter()) + number * pixel_time
+        wait = self.next_pixel_time - time.perf_counter()
+        if wait > 0: time.sleep(wait)
+        return
+
+    def changed(self, wait_for_effect: bool = False) -> None:
+        with self.lock:
+            if self.response is not None and self.previous_response is None: self.previous_response = self.response
+            self.response = None
+        self.wait_latency()
+        if wait_for_effect and self.running:
+            time.sleep(self.mla.settings["time_scale"] / self.df) # One pixel; the pixel clock is left to the reader of the pixels, which may be the pixel stream
+            with self.lock: self.previous_response = None # The mixed pixel has passed
+        return
+
+
+
+    # Settings
+    def set_df(self, df: float, wait_for_effect: bool = True) -> None:
+        numbers = np.round(self.frequencies / self.df)
+        self.df = float(df)
+        self.frequencies = numbers * self.df # The tones stay on the same multiples of df
+        self.changed(wait_for_effect)
+        return
+
+    def set_Tm(self, Tm: float, wait_for_effect: bool = True) -> None:
+        self.set_df(1 / Tm, wait_for_effect = wait_for_effect)
+        return
+
+    def get_df(self) -> float:
+        self.wait_latency()
+        return self.df
+
+    def get_Tm(self) -> float:
+        self.wait_latency()
+        return 1 / self.df
+
+    def set_frequencies(self, frequencies: np.ndarray, wait_for_effect: bool = True) -> None:
+        frequencies = np.asarray(frequencies, dtype = float)[: self.nr_input_freq]
+        self.frequencies[: len(frequencies)] = np.round(frequencies / self.df) * self.df # Tones are snapped to integer multiples of df
+        self.changed(wait_for_effect)
+        return
+
+    def get_frequencies(self) -> np.ndarray:
+        self.wait_latency()
+        return np.copy(self.frequencies)
+
+    def set_amplitudes(self, amplitudes: np.ndarray, wait_for_effect: bool = True) -> None:
+        amplitudes = np.asarray(amplitudes, dtype = float)[: self.nr_input_freq]
+        self.amplitudes[: len(amplitudes)] = amplitudes
+        self.changed(wait_for_effect)
+        return
+
+    def get_amplitudes(self) -> np.ndarray:
+        self.wait_latency()
+        return np.copy(self.amplitudes)
+
+    def set_phases(self, phases: np.ndarray, unit: str = "degree", wait_for_effect: bool = True) -> None:
+        phases = np.asarray(phases, dtype = float)[: self.nr_input_freq]
+        self.phases[: len(phases)] = np.deg2rad(phases) if unit in ["degree", "deg"] else phases
+        self.changed(wait_for_effect)
+        return
+
+    def get_phases(self, unit: str = "degree") -> np.ndarray:
+        self.wait_latency()
+        return np.rad2deg(self.phases) if unit in ["degree", "deg"] else np.copy(self.phases)
+
+    def set_output_mask(self, mask: np.ndarray, port: int = 1, wait_for_effect: bool = True) -> None:
+        mask = np.asarray(mask, dtype = int)[: self.nr_input_freq]
+        self.output_masks[port - 1, : len(mask)] = mask
+        self.changed(wait_for_effect)
+        return
+
+    def set_input_multiplexer(self, ports: np.ndarray) -> None:
+        ports = np.asarray(ports, dtype = int)[: self.nr_input_freq]
+        self.input_multiplexer[: len(ports)] = ports
+        self.changed()
+        return
+
+    def set_dc_offset(self, port: int = 1, value: float = 0) -> None:
+        self.dc_offsets[port - 1] = value
+        self.changed()
+        return
+
+    def reset_outputs(self) -> None:
+        self.output_masks[:] = 0
+        self.dc_offsets[:] = 0
+        self.changed()
+        return
+
+
+
+    # Physics
+    def compute_response(self) -> np.ndarray:
+        """
+        Noise-free demodulated pixel (complex, in V) of all tones for the current settings
+        """
+        s = self.mla.settings
+        numbers = np.round(self.frequencies / self.df).astype(int)
+        n_max = max(int(np.max(np.abs(numbers))), 1)
+        n_samples = int(2 ** np.ceil(np.log2(8 * n_max + 16))) # Resolves intermodulation products up to well above the highest tone
+        t = np.arange(n_samples) / (n_samples * self.df)
+
+        # Output port voltages during one period of df
+        ports = np.empty((self.nr_output_ports, n_samples))
+        for port in range(self.nr_output_ports):
+            ports[port] = self.dc_offsets[port]
+            for tone in np.flatnonzero(self.output_masks[port] * self.amplitudes):
+                ports[port] += self.amplitudes[tone] * np.cos(2 * np.pi * self.frequencies[tone] * t + self.phases[tone])
+
+        # Junction current (pA) driven by port 1: the nonlinear tunnel current and the displacement current of the capacitance
+        spectrum_V = np.fft.rfft(ports[0]) / n_samples
+        spectrum_pA = np.fft.rfft(s["I0 (pA)"] * np.sinh(ports[0] / s["V0 (V)"])) / n_samples
+        omega = 2 * np.pi * self.df * np.arange(len(spectrum_pA))
+        spectrum_pA += 1j * omega * s["C (fF)"] * 1E-3 * spectrum_V # C (fF) * dV/dt (V/s) = 1E-3 pA
+        tia = -s["gain (V/pA)"] / (1 + 1j * omega / (2 * np.pi * s["tia_bandwidth (Hz)"])) # Inverting amplifier with a first-order roll-off
+
+        # Demodulate every tone on its input port. A cosine of amplitude A demodulates to A / 2, as on the instrument
+        response = np.zeros(self.nr_input_freq, dtype = complex)
+        for tone, (number, port) in enumerate(zip(np.abs(numbers), self.input_multiplexer)):
+            if number >= len(spectrum_V): continue
+            match port:
+                case 1: value = spectrum_V[number]
+                case 2: value = tia[number] * spectrum_pA[number]
+                case _: value = 0
+            response[tone] = np.conj(value) if numbers[tone] < 0 else value
+        return response
+
+    def get_pixels(self, number: int = 1, phase_format: bool = False, unit: str = "deg") -> tuple[np.ndarray, dict]:
+        if not self.running: raise Exception("The simulated lockin is not running")
+        with self.lock:
+            if self.response is None: self.response = self.compute_response()
+            response = self.response
+            previous_response = self.previous_response
+            self.previous_response = None
+
+        pixels = np.repeat(response[:, None], number, axis = 1)
+        if previous_response is not None: pixels[:, 0] = .5 * (previous_response + response) # The pixel during which the settings changed
+        noise_std = self.mla.settings["noise (V/rtHz)"] * np.sqrt(self.df / 2) # Per quadrature; the demodulation bandwidth equals df
+        pixels += noise_std * (self.rng.standard_normal(pixels.shape) + 1j * self.rng.standard_normal(pixels.shape))
+        self.pixel_clock += number
+
+        if phase_format: return (np.angle(pixels, deg = unit in ["deg", "degree"]), {"pixel_clock": self.pixel_clock})
+        return (pixels, {"pixel_clock": self.pixel_clock})
+
+
+
+class SimulatedHardware:
+    def set_input_relay(self, port: int, **kwargs) -> None: return
+    def set_output_relay(self, port: int, **kwargs) -> None: return
+
+class SimulatedOscilloscope:
+    def set_downsampling(self, factor: int) -> None:
+        self.downsampling = factor
+        return
+
+class SimulatedFeedback:
+    def setup(self, **kwargs) -> None: return
+    def set_feedback_type_slow(self, feedback_type: int) -> None: return
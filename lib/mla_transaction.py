@@ -0,0 +1,192 @@
+import numpy as np
+from .parameter_broadcaster import values_equal
+
+
+
+class MLATransaction:
+    """
+    Staged configuration change of the MLA lock-in. Changes are staged with the set methods (or with stage(), which takes the parameter dicts of MLAAPI.lockin_update) and sent with commit()
+    commit() compares the staged values with the shadow state of MLAAPI (the last values written to or read from the instrument), sends only the fields that differ, and waits for the effect once, on the last write
+    The fields are sent in a fixed order: input multiplexer, outputs that switch off, df, frequencies, phases, amplitudes, outputs that switch on, bias. Tones are therefore fully configured before they are put on an output, and the bias slew comes last
+    Usage: mla.transaction().set_amplitudes({0: 20}).set_modulator(0, port = 1).commit(), or as a context manager, which commits when the block exits without an exception
+    """
+    def __init__(self, mla_api, wait_for_effect: bool = True, broadcast: bool = True, verbose: bool = False):
+        self.mla_api = mla_api # MLAAPI
+        self.wait_for_effect = wait_for_effect
+        self.broadcast = broadcast # Emit the changed settings as parameter dicts, like the update methods do. Sweeps switch this off for the changes between points
+        self.verbose = verbose
+        self.staged = {}
+        self.previous = None # Transaction that was active when this one was entered as a context manager
+
+    def __enter__(self) -> "MLATransaction":
+        self.previous = self.mla_api.active_transaction
+        self.mla_api.active_transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.mla_api.active_transaction = self.previous
+        if exc_type is None:
+            (changes, error) = self.commit()
+            if error: raise Exception(error)
+        return False
+
+    def current(self, key: str):
+        """
+        Staged value of a field, or its value in the shadow state
+        """
+        if key in self.staged: return self.staged[key]
+        return self.mla_api.shadow_state([key])[key]
+
+
+
+    # Staging
+    def set_df(self, df: float) -> "MLATransaction":
+        self.staged["df (Hz)"] = float(df)
+        return self
+
+    def set_frequencies(self, frequencies: list | np.ndarray | dict) -> "MLATransaction":
+        self.staged["frequencies (Hz)"] = self.merge(self.current("frequencies (Hz)"), frequencies)
+        return self
+
+    def set_numbers(self, numbers: list | np.ndarray | dict) -> "MLATransaction":
+        df = self.current("df (Hz)")
+        if isinstance(numbers, dict): frequencies = {key: value * df for key, value in numbers.items() if isinstance(value, float | int)}
+        else: frequencies = np.asarray(numbers, dtype = float) * df
+        return self.set_frequencies(frequencies)
+
+    def set_tones(self, df: float, numbers: list | np.ndarray) -> "MLATransaction":
+        self.set_df(df)
+        return self.set_numbers(numbers)
+
+    def set_amplitudes(self, amplitudes_mV: list | np.ndarray | dict) -> "MLATransaction":
+        self.staged["amplitudes (mV)"] = self.merge(self.current("amplitudes (mV)"), amplitudes_mV)
+        return self
+
+    def set_phases(self, phases_deg: list | np.ndarray | dict) -> "MLATransaction":
+        self.staged["phases (deg)"] = self.merge(self.current("phases (deg)"), phases_deg)
+        return self
+
+    def set_output_masks(self, output_masks: np.ndarray) -> "MLATransaction":
+        output_masks = np.array(output_masks, dtype = int)
+        if output_masks.shape == self.mla_api.output_masks.shape: self.staged["output_masks"] = output_masks
+        return self
+
+    def set_modulator(self, index: int, port: int = 1, on: bool = True, blank: bool = False) -> "MLATransaction":
+        """
+        Puts modulator index on output port 1 or 2, or takes it off both ports. With blank = True, all other modulators are switched off first
+        """
+        output_masks = np.zeros_like(self.mla_api.output_masks) if blank else np.copy(self.current("output_masks"))
+        output_masks[:, index] = 0
+        if on and port in [1, 2]: output_masks[port - 1, index] = 1
+        self.staged["output_masks"] = output_masks
+        return self
+
+    def set_input_mask(self, input_mask: list | np.ndarray) -> "MLATransaction":
+        input_mask = np.array(input_mask, dtype = int)
+        if input_mask.shape == self.mla_api.input_mask.shape: self.staged["input_mask"] = input_mask
+        return self
+
+    def set_bias(self, port: int = 1, value: float = 0) -> "MLATransaction":
+        if port in [1, 2]: self.staged[f"port_{port} (V)"] = float(value)
+        return self
+
+    def stage(self, parameters: dict) -> "MLATransaction":
+        """
+        Stages the settings in a parameter dict with the keys of the MLAAPI update methods
+        """
+        tm = parameters.get("tm (ms)", None)
+        df = parameters.get("df (Hz)", None)
+        if isinstance(df, float | int): self.set_df(df)
+        elif isinstance(tm, float | int): self.set_df(1000 / tm)
+
+        [frequencies, numbers, times] = [parameters.get(key, None) for key in ["frequencies (Hz)", "numbers", "times (ms)"]]
+        if isinstance(frequencies, list | np.ndarray | dict): self.set_frequencies(frequencies)
+        elif isinstance(numbers, list | np.ndarray | dict): self.set_numbers(numbers)
+        elif isinstance(times, list | np.ndarray): self.set_numbers(np.asarray(times, dtype = float) * self.current("df (Hz)") / 1000)
+
+        [amplitudes, phases] = [parameters.get(key, None) for key in ["amplitudes (mV)", "phases (deg)"]]
+        if isinstance(amplitudes, list | np.ndarray | dict): self.set_amplitudes(amplitudes)
+        if isinstance(phases, list | np.ndarray | dict): self.set_phases(phases)
+
+        if parameters.get("blank", False): self.set_output_masks(np.zeros_like(self.mla_api.output_masks))
+        if isinstance(parameters.get("output_masks", None), list | np.ndarray): self.set_output_masks(parameters.get("output_masks"))
+        for index in range(4):
+            mod = parameters.get(f"mod{index}", parameters.get(f"mla_mod{index}", None))
+            if not isinstance(mod, dict): continue
+            port = mod.get("channel", mod.get("signal", mod.get("port", None))) # Channel, signal and port are all considered valid keywords to indicate the output port
+            if mod.get("on", False) and port not in [1, 2]: continue
+            self.set_modulator(index, port = port, on = bool(mod.get("on", False)))
+
+        if isinstance(parameters.get("input_mask", None), list | np.ndarray): self.set_input_mask(parameters.get("input_mask"))
+        [self.set_bias(port, parameters.get(f"port_{port} (V)")) for port in [1, 2] if isinstance(parameters.get(f"port_{port} (V)", None), float | int)]
+        return self
+
+    def merge(self, values: np.ndarray, update: list | np.ndarray | dict) -> np.ndarray:
+        """
+        Overwrites the first len(update) entries of values, or the entries {index: value} of a dict
+        """
+        values = np.array(values, dtype = float)
+        if isinstance(update, dict):
+            for key, value in update.items():
+                if not isinstance(value, float | int): continue
+                try: values[int(key)] = value
+                except: pass
+        else:
+            update = np.asarray(update, dtype = float)[: len(values)]
+            values[: len(update)] = update
+        return values
+
+
+
+    # Commit
+    def diff(self) -> dict:
+        """
+        The staged fields that differ from the shadow state
+        """
+        shadow = self.mla_api.shadow_state(list(self.staged.keys()) + ["df (Hz)", "frequencies (Hz)"])
+        changes = {key: value for key, value in self.staged.items() if not values_equal(value, shadow.get(key))}
+        if "df (Hz)" in changes and not "frequencies (Hz)" in changes: changes["frequencies (Hz)"] = np.round(shadow["frequencies (Hz)"] / shadow["df (Hz)"]) * changes["df (Hz)"] # Keep the tones on the same multiples of df
+        return changes
+
+    def commit(self) -> tuple[dict, bool | str]:
+        """
+        Sends the changes to the instrument. Returns the dict of changed fields and an error
+        """
+        error = False
+        changes = {}
+
+        try:
+            changes = self.diff()
+            self.staged = {}
+            if self.verbose and len(changes) > 0: self.mla_api.logprint(f"mla.transaction().stage({changes}).commit()", message_type = "code")
+            if len(changes) == 0: return (changes, error)
+
+            api = self.mla_api
+            old_masks = np.copy(api.output_masks)
+            new_masks = changes.get("output_masks", old_masks)
+            off_masks = old_masks * new_masks # Outputs that switch off go first, outputs that switch on last
+
+            # Steps as (waitable, function(wait_for_effect))
+            steps = []
+            if "input_mask" in changes: steps.append((False, lambda wait: api.mla.lockin.set_input_multiplexer(changes["input_mask"])))
+            for port in range(2):
+                if not np.array_equal(off_masks[port], old_masks[port]): steps.append((True, lambda wait, port = port: api.mla.lockin.set_output_mask(off_masks[port], port = port + 1, wait_for_effect = wait)))
+            if "df (Hz)" in changes: steps.append((True, lambda wait: api.mla.lockin.set_df(changes["df (Hz)"], wait_for_effect = wait)))
+            if "frequencies (Hz)" in changes: steps.append((True, lambda wait: api.mla.lockin.set_frequencies(changes["frequencies (Hz)"], wait_for_effect = wait)))
+            if "phases (deg)" in changes: steps.append((True, lambda wait: api.mla.lockin.set_phases(changes["phases (deg)"], unit = "degree", wait_for_effect = wait)))
+            if "amplitudes (mV)" in changes: steps.append((True, lambda wait: api.mla.lockin.set_amplitudes(changes["amplitudes (mV)"] / 1000, wait_for_effect = wait)))
+            for port in range(2):
+                if not np.array_equal(new_masks[port], off_masks[port]): steps.append((True, lambda wait, port = port: api.mla.lockin.set_output_mask(new_masks[port], port = port + 1, wait_for_effect = wait)))
+
+            if not api.test_mode:
+                waitable = [index for index, (can_wait, step) in enumerate(steps) if can_wait]
+                last_wait = waitable[-1] if len(waitable) > 0 and self.wait_for_effect else -1
+                [step(index == last_wait) for index, (can_wait, step) in enumerate(steps)]
+            [api.slew_bias(port = port, value = changes[f"port_{port} (V)"]) for port in [1, 2] if f"port_{port} (V)" in changes] # The bias is slewed, not waited for
+
+            # Update the shadow state and broadcast the changed groups
+            api.update_shadow(changes)
+            if self.broadcast: api.broadcast(api.groups_of(changes.keys()))
+
+        except Exception as e: error = e
+        return (changes, error)
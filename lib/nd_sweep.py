@@ -0,0 +1,240 @@
+import time
+import numpy as np
+from .sweep_engine import SweepEngine
+from .adaptive_sampling import AdaptiveSampler
+
+
+
+class SweepAxis:
+    """
+    One axis of an N-dimensional sweep
+    apply(value) moves the hardware to a value of the axis. settle is the settle policy after every step of the axis: {"pixels": lock-in pixels to discard, "s": seconds to wait}. line_settle replaces it when the axis jumps by more than one step, like the jump back at the start of a raster line
+    With snake = True the axis reverses direction every time an outer axis steps, so that it never jumps back. reset() is called before the first point and after every line callback, for axes that measure relative to a reference (like the tip height)
+    """
+    def __init__(self, name: str, values: np.ndarray, apply: object, settle: dict = {}, line_settle: dict = None, snake: bool = False, reset: object = None):
+        self.name = name # Label of the axis, including units, like 'voltage (V)'. Also the name of the axis dataset
+        self.values = np.asarray(values)
+        self.apply = apply
+        self.settle = settle
+        self.line_settle = line_settle if line_settle is not None else settle
+        self.snake = snake
+        self.reset = reset
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+
+class NDSweep:
+    """
+    Declarative N-dimensional sweep, measured with the MLA lock-in. axes[0] is the slowest axis and axes[-1] the fastest
+    The setpoint table (the index along every axis of every point, in acquisition order) is computed up front. At every point only the axes whose value changes are applied, in one MLA transaction, and the settle time is the longest settle time of those axes. Acquisition, configuration and processing are pipelined by SweepEngine
+    process(index, values, pix_V, pix_V_std_dev) returns the (data_chunk, error_chunk) of a point, with one entry per channel. Chunks are streamed to data_callback and written into preallocated datasets of shape (*axis lengths, channels) as they come in
+    With noise-targeted integration (see SweepEngine), the number of pixels of every point is appended as an extra channel; the datasets need n_channels + 1 channels
+    With adaptive = {"points": maximum number of points, "time (s)": time budget, "resolution": minimum distance between points, "channels": steering channels}, a 1D sweep is sampled adaptively (see run_adaptive)
+    """
+    def __init__(self, axes: list, mla_api, process: object, n_channels: int, settle_pixels: int = 0, pixels_per_datapoint: int = 4, abort_callback: object = None,
+                 data_callback: object = None, line_callback: object = None, line_done_callback: object = None, write: object = None, resize: object = None, integration: dict = None, adaptive: dict = None):
+        self.axes = [axis for axis in axes if len(axis) > 0]
+        self.mla_api = mla_api # MLAAPI
+        self.process = process
+        self.n_channels = n_channels
+        self.settle_pixels = settle_pixels # Minimum number of settle pixels at every point
+        self.pixels_per_datapoint = pixels_per_datapoint
+        self.abort_callback = abort_callback
+        self.data_callback = data_callback
+        self.line_callback = line_callback # Called with the index of the first point of every line, before the axes are applied. All axes are applied after it
+        self.line_done_callback = line_done_callback # Called with the line number when the last point of a line has been processed. In adaptive mode, called with the index of the last point after every batch
+        self.write = write # write(dataset, selection, array), like BaseExperiment.write. Writes directly to the datasets if None
+        self.resize = resize # resize(dataset, shape), like BaseExperiment.resize. Only used in adaptive mode
+        self.integration = integration # Noise-targeted integration settings of SweepEngine
+        self.adaptive = adaptive
+        self.engine = None
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(len(axis) for axis in self.axes)
+
+    @property
+    def n_lines(self) -> int:
+        return int(np.prod(self.shape[:-1])) if len(self.axes) > 1 else 1
+
+    def setpoint_table(self) -> np.ndarray:
+        """
+        (points, axes) array of the index along every axis, in acquisition order
+        """
+        shape = self.shape
+        raster = np.stack(np.unravel_index(np.arange(int(np.prod(shape))), shape), axis = 1)
+        table = np.copy(raster)
+        for axis_index, axis in enumerate(self.axes):
+            if not axis.snake or axis_index == 0: continue
+            outer_steps = np.ravel_multi_index(tuple(raster[:, :axis_index].T), shape[:axis_index]) # Number of steps of the outer axes so far
+            reverse = outer_steps % 2 == 1
+            table[reverse, axis_index] = shape[axis_index] - 1 - raster[reverse, axis_index]
+        return table
+
+
+
+    def run(self, dataset = None, error_dataset = None, axis_dataset = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the data and errors as arrays of shape (*axis lengths, channels), or (points, channels) in adaptive mode
+        """
+        if self.adaptive: return self.run_adaptive(dataset, error_dataset, axis_dataset)
+        table = self.setpoint_table()
+        n_axes = len(self.axes)
+        points_per_line = self.shape[-1]
+        write = self.write
+        if write is None:
+            def write(dataset, selection, array): dataset[selection] = array
+
+        def apply(point: int) -> int:
+            index = table[point]
+            line_start = point % points_per_line == 0
+            if point == 0 or (line_start and self.line_callback): changed = range(n_axes)
+            else: changed = np.flatnonzero(index != table[point - 1])
+
+            if line_start and self.line_callback: self.line_callback(tuple(index))
+            if point == 0 or (line_start and self.line_callback): [axis.reset() for axis in self.axes if axis.reset]
+
+            [settle_pixels, settle_s] = [self.settle_pixels, 0]
+            restart = point == 0 or (line_start and self.line_callback) # Everything is applied from scratch, for example after an intermediate feedback
+            with self.mla_api.transaction(broadcast = False): # The lock-in changes of all axes are sent in one commit, with a single wait for the effect
+                for axis_index in changed:
+                    axis = self.axes[axis_index]
+                    axis.apply(axis.values[index[axis_index]])
+                    previous = table[point - 1][axis_index]
+                    jump = restart or (abs(int(index[axis_index]) - int(previous)) > 1 and not np.array_equal(axis.values[index[axis_index]], axis.values[previous])) # Snake lines (and raster lines with a retrace) start where the previous line ended
+                    policy = axis.line_settle if jump else axis.settle
+                    settle_pixels = max(settle_pixels, policy.get("pixels", 0))
+                    settle_s = max(settle_s, policy.get("s", 0))
+            if settle_s > 0: time.sleep(settle_s)
+            return settle_pixels
+
+        def process(point: int, setpoint: int, pix_V: np.ndarray, pix_V_std_dev: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            index = tuple(table[point])
+            values = [axis.values[axis_index] for axis, axis_index in zip(self.axes, index)]
+            return self.process(index, values, pix_V, pix_V_std_dev)
+
+        def store(point: int, data_chunk: np.ndarray, error_chunk: np.ndarray) -> None: # Called with the complete chunks, including the pixel count channel
+            index = tuple(table[point])
+            if dataset is not None: write(dataset, index, np.asarray(data_chunk, dtype = dataset.dtype))
+            if error_dataset is not None: write(error_dataset, index, np.asarray(error_chunk, dtype = error_dataset.dtype))
+            if (point + 1) % points_per_line == 0 and self.line_done_callback: self.line_done_callback(point // points_per_line)
+            return
+
+        self.mla_api.start_lockin()
+        self.engine = SweepEngine(self.mla_api, settle_pixels = self.settle_pixels, pixels_per_datapoint = self.pixels_per_datapoint, abort_callback = self.abort_callback, data_callback = self.data_callback,
+                                  integration = self.integration, point_callback = store)
+        (measurement_array, error_array) = self.engine.run(list(range(len(table))), apply, process, self.n_channels)
+
+        # Sort the points from acquisition order into the grid
+        data = np.empty(self.shape + (measurement_array.shape[1],), dtype = np.float32)
+        errors = np.empty_like(data)
+        data[tuple(table.T)] = measurement_array
+        errors[tuple(table.T)] = error_array
+        return (data, errors)
+
+    def run_adaptive(self, dataset = None, error_dataset = None, axis_dataset = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        1D sweep with the points chosen by an AdaptiveSampler. The first and last value of the axis set the range, and the number of values the coarse grid that is measured first
+        The points are kept sorted along the axis: data_callback receives the points of a batch as they come in, and after every batch 'clear data' followed by all points so far in sorted order. At the same time, the datasets (points, channels) and axis_dataset (points,), which must be resizable along the points, are resized and rewritten
+        """
+        if len(self.axes) != 1 or self.axes[0].values.ndim != 1: raise Exception("Adaptive sampling requires a 1D sweep of a scalar parameter")
+        axis = self.axes[0]
+        (write, resize) = (self.write, self.resize)
+        if write is None:
+            def write(dataset, selection, array): dataset[selection] = array
+        if resize is None:
+            def resize(dataset, shape): dataset.resize(shape)
+
+        sampler = AdaptiveSampler(axis.values[0], axis.values[-1], coarse_points = len(axis), max_points = self.adaptive.get("points", len(axis)), max_time_s = self.adaptive.get("time (s)", None),
+                                  resolution = self.adaptive.get("resolution", 0), channels = self.adaptive.get("channels", None))
+        coarse_step = abs(axis.values[-1] - axis.values[0]) / max(len(axis) - 1, 1)
+        previous = {"value": None}
+
+        def apply(value: float) -> int:
+            with self.mla_api.transaction(broadcast = False): axis.apply(value)
+            jump = previous["value"] is None or abs(value - previous["value"]) > coarse_step # The first point of every batch jumps back to the start of the range
+            policy = axis.line_settle if jump else axis.settle
+            previous["value"] = value
+            if policy.get("s", 0) > 0: time.sleep(policy.get("s", 0))
+            return max(self.settle_pixels, policy.get("pixels", 0))
+
+        def process(index: int, value: float, pix_V: np.ndarray, pix_V_std_dev: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            return self.process((len(sampler.x) + index,), [value], pix_V, pix_V_std_dev)
+
+        self.mla_api.start_lockin()
+        if self.line_callback: self.line_callback((0,))
+        if axis.reset: axis.reset()
+        self.engine = SweepEngine(self.mla_api, settle_pixels = self.settle_pixels, pixels_per_datapoint = self.pixels_per_datapoint, abort_callback = self.abort_callback, data_callback = self.data_callback,
+                                  integration = self.integration)
+
+        acquired = {"x": [], "errors": []} # Per batch. The sampler keeps the standard errors of the means; the datasets get the standard deviations of the pixels, like a uniform sweep
+        batch = sampler.initial()
+        while len(batch) > 0:
+            (measurement_array, error_array) = self.engine.run(list(batch), apply, process, self.n_channels)
+            sampler.tell(batch, measurement_array, error_array / np.sqrt(self.engine.pixel_counts)[:, None])
+            acquired["x"].append(batch)
+            acquired["errors"].append(error_array)
+
+            (x, data, _) = sampler.result()
+            errors = np.concatenate(acquired["errors"])[np.argsort(np.concatenate(acquired["x"]), kind = "stable")] # The points are unique, so this is the order of the sampler
+            for target, array in [(axis_dataset, x), (dataset, data), (error_dataset, errors)]:
+                if target is None: continue
+                resize(target, array.shape)
+                write(target, slice(None), np.asarray(array, dtype = target.dtype))
+            if self.data_callback: # Redraw the batch in place
+                self.data_callback(np.array(["clear data"]))
+                self.data_callback(np.asarray(data, dtype = np.float32))
+            if self.line_done_callback: self.line_done_callback(len(x) - 1)
+            batch = sampler.ask()
+
+        return (data.astype(np.float32), errors.astype(np.float32))
+
+
+
+# Axes
+def mla_bias_axis(mla, values: np.ndarray, port: int = 1, settle: dict = {}, line_settle: dict = None, snake: bool = False) -> SweepAxis:
+    return SweepAxis(f"V_port{port} (V)" if port != 1 else "voltage (V)", values, lambda value: mla.ramp_bias(port = port, value = value), settle = settle, line_settle = line_settle, snake = snake)
+
+def mla_frequency_axis(mla, values: np.ndarray, numbers: np.ndarray, settle: dict = {}, line_settle: dict = None, snake: bool = False) -> SweepAxis:
+    """
+    Sweeps df, keeping the tones on the given multiples of df
+    """
+    return SweepAxis("frequency (Hz)", values, lambda value: mla.set_tones(value, numbers), settle = settle, line_settle = line_settle, snake = snake)
+
+def mla_amplitude_axis(mla, values: np.ndarray, amplitudes_mV: np.ndarray, modulators: list = [0], settle: dict = {}, line_settle: dict = None, snake: bool = False) -> SweepAxis:
+    """
+    Sweeps the amplitude of the modulators. The other tones keep the amplitudes in amplitudes_mV
+    """
+    amplitudes_mV = np.array(amplitudes_mV, dtype = float)
+    def apply(value: float) -> None:
+        amplitudes_mV[modulators] = value
+        mla.set_amplitudes(amplitudes_mV)
+        return
+    return SweepAxis("amplitude (mV)", values, apply, settle = settle, line_settle = line_settle, snake = snake)
+
+def z_axis(nanonis, values: np.ndarray, settle: dict = {}, line_settle: dict = None, snake: bool = False) -> SweepAxis:
+    """
+    Tip height relative to the height at the start of the sweep, or at the end of the last line callback (for example an intermediate feedback). The feedback is switched off
+    """
+    nhw = nanonis.nanonis_hardware
+    reference = {"z (nm)": 0}
+    def reset() -> None:
+        nhw.set_fb(False)
+        time.sleep(.2)
+        reference["z (nm)"] = nhw.get_z_nm()
+        return
+    return SweepAxis("tip height (nm)", values, lambda value: nhw.set_z_nm(reference["z (nm)"] + value), settle = settle, line_settle = line_settle, snake = snake, reset = reset)
+
+def tip_position_axis(nanonis, positions_nm: np.ndarray, settle: dict = {}, line_settle: dict = None, snake: bool = False) -> SweepAxis:
+    """
+    Moves the tip along a list of (x, y) positions (nm) and waits until it has arrived
+    """
+    return SweepAxis("tip position (nm)", positions_nm, lambda xy: nanonis.tip_update({"x (nm)": xy[0], "y (nm)": xy[1]}, wait = True, fast_mode = True, verbose = False), settle = settle, line_settle = line_settle, snake = snake)
+
+def keithley_axis(keithley, values: np.ndarray, settle: dict = {}, line_settle: dict = None, snake: bool = False, dV: float = .1, dt: float = .02) -> SweepAxis:
+    """
+    Gate voltage of the Keithley, ramped in steps of dV (V) every dt (s) at every step of the axis, including the jumps back at the line starts
+    """
+    return SweepAxis("V_Keithley (V)", values, lambda value: keithley.set_V(value, dV = dV, dt = dt), settle = settle, line_settle = line_settle, snake = snake)
@@ -0,0 +1,253 @@
+import os, sys, time, h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .file_functions import FileFunctions
+
+
+
+worker_file_functions = None # One FileFunctions object (and pint registry) per worker process
+
+def init_worker() -> None:
+    global worker_file_functions
+    worker_file_functions = FileFunctions()
+    return
+
+def parse_nanonis_file(file_path: str) -> tuple[str, dict, bool | str]:
+    """
+    Runs in a worker process. Parses a single .sxm or .dat file into a picklable payload of attributes, subgroups and datasets. Writing is left to the parent process
+    """
+    error = False
+    payload = {}
+    file_functions = worker_file_functions if worker_file_functions is not None else FileFunctions()
+
+    try:
+        match os.path.splitext(file_path)[1].lower():
+            case ".sxm":
+                file_data = file_functions.read_sxm(file_path)
+                dataset = file_data.get("dataset")
+                if not isinstance(dataset, np.ndarray): raise Exception("No scan data found")
+                [frame, axes_data, z_controller] = [file_data.get(key, {}) for key in ["frame", "axes_data", "z_controller"]]
+                domain = frame.get("domain (nm)", [np.nan, np.nan])
+                [n_directions, n_channels, pixels, lines] = dataset.shape
+
+                payload = {"kind": "scan", "signal": "scan", "layout": "scan", "axes": ["direction indices", "channel indices", "x (nm)", "y (nm)"],
+                           "attrs": {key: file_data.get(key) for key in ["scan_date", "start_time", "up_or_down", "V_nanonis (V)"] if file_data.get(key) is not None},
+                           "groups": {"frame": frame, "z_controller": z_controller},
+                           "datasets": {"scan": dataset, "direction": axes_data.get("directions", ["forward", "backward"]), "direction indices": np.arange(n_directions, dtype = np.int32),
+                                        "channel": axes_data.get("channels", []), "channel indices": np.arange(n_channels, dtype = np.int32),
+                                        "x (nm)": np.linspace(-domain[0] / 2, domain[0] / 2, pixels, dtype = np.float32), "y (nm)": np.linspace(-domain[1] / 2, domain[1] / 2, lines, dtype = np.float32),
+                                        "header": [str(line).rstrip("\n") for line in file_data.get("raw_header", [])]}}
+                payload["attrs"].update({"date_time": f"{file_data.get('scan_date', '')} {file_data.get('start_time', '')}".strip()})
+
+            case ".dat":
+                (spec_object, error) = file_functions.get_spectroscopy_object(file_path)
+                if error: raise Exception(error)
+                channels = [str(channel) for channel in spec_object.channels]
+                matrix = np.array(spec_object.matrix, dtype = np.float32).transpose() # (points, channels), as in the spectroscopy experiments
+                coords_nm = [float(coordinate.magnitude) for coordinate in spec_object.coords]
+                header = {str(key): str(value) for key, value in spec_object.header.items()}
+
+                payload = {"kind": "spectrum", "signal": "sweep", "layout": "sweep", "axes": [channels[0], "channel indices"],
+                           "attrs": {"date_time": spec_object.date_time.strftime("%Y/%m/%d %H:%M:%S"), "x (nm)": coords_nm[0], "y (nm)": coords_nm[1], "z (nm)": coords_nm[2]},
+                           "groups": {"header": header},
+                           "datasets": {"sweep": matrix, channels[0]: matrix[:, 0], "channel": channels, "channel indices": np.arange(len(channels), dtype = np.int32)}}
+
+            case _:
+                raise Exception("Unsupported file type")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return (file_path, payload, error)
+
+
+
+class NexusConverter:
+    """
+    Converts folders of Nanonis .sxm/.dat files into a single chunked Nexus HDF5 container with one group per file and a top-level index table
+    Parsing runs on a process pool; the parent process is the only writer. Conversion is resumable: files that are already in the index with the same size and modification time are skipped
+    """
+    def __init__(self, max_workers: int = None, verbose: bool = True):
+        self.file_functions = FileFunctions()
+        self.max_workers = max_workers if max_workers else max((os.cpu_count() or 2) - 1, 1)
+        self.verbose = verbose
+        self.extensions = [".sxm", ".dat"]
+        self.index_positions = {} # Relative file path -> row in the index table
+        self.str_dtype = h5py.string_dtype(encoding = "utf-8")
+        self.index_dtype = np.dtype([("path", self.str_dtype), ("group", self.str_dtype), ("kind", self.str_dtype), ("date_time", self.str_dtype), ("size (bytes)", np.int64), ("mtime (s)", np.float64),
+                                     ("x (nm)", np.float64), ("y (nm)", np.float64), ("width (nm)", np.float64), ("height (nm)", np.float64), ("angle (deg)", np.float64), ("pixels", np.int32), ("lines", np.int32), ("channels", np.int32)])
+
+
+
+    def find_files(self, folder: str) -> list:
+        file_paths = []
+        for (root, dirs, files) in os.walk(folder):
+            dirs.sort()
+            file_paths.extend([os.path.join(root, file) for file in sorted(files) if os.path.splitext(file)[1].lower() in self.extensions])
+        return file_paths
+
+    def group_name(self, folder: str, file_path: str) -> str:
+        relative_path = os.path.relpath(file_path, folder).replace(os.sep, "/")
+        return f"files/{relative_path}" # Subfolders (sessions) become nested groups
+
+    def read_index(self, container: h5py.File) -> dict:
+        """
+        Returns {relative path: (row number, index row)} for all files in the index table of the container
+        """
+        if not "index" in container.keys(): return {}
+        rows = container["index"][()]
+        return {(row["path"].decode("utf-8") if isinstance(row["path"], bytes) else row["path"]): (position, row) for position, row in enumerate(rows)}
+
+
+
+    def convert(self, folder: str, container_path: str, progress_callback: object = None, abort_callback: object = None) -> tuple[dict, bool | str]:
+        """
+        Converts all .sxm and .dat files in 'folder' (recursively) into the container at 'container_path', which is created or appended to
+        progress_callback(done, total) is called after every file; abort_callback() is called regularly and may raise to stop the conversion. Converted files are kept
+        """
+        error = False
+        summary = {"converted": 0, "skipped": 0, "failed": {}}
+        folder = os.path.abspath(folder)
+
+        try:
+            file_paths = self.find_files(folder)
+            with h5py.File(container_path, "a", libver = "latest", **self.file_functions.hdf5_cache) as container:
+                index = self.read_index(container)
+                self.index_positions = {path: position for path, (position, row) in index.items()}
+                if not "index" in container.keys():
+                    container.create_dataset("index", shape = (0,), maxshape = (None,), dtype = self.index_dtype, chunks = (1024,), compression = "gzip", shuffle = True)
+                    container.attrs.update({"source_folder": folder, "created": time.strftime("%Y/%m/%d %H:%M:%S")})
+
+                # Skip files that were converted before and have not changed since
+                todo = []
+                for file_path in file_paths:
+                    relative_path = os.path.relpath(file_path, folder).replace(os.sep, "/")
+                    stat = os.stat(file_path)
+                    (position, row) = index.get(relative_path, (None, None))
+                    if row is not None and int(row["size (bytes)"]) == stat.st_size and float(row["mtime (s)"]) == stat.st_mtime:
+                        summary["skipped"] += 1
+                        continue
+                    todo.append(file_path)
+                total = len(todo)
+                if self.verbose: print(f"Converting {total} files ({summary['skipped']} already converted) using {self.max_workers} processes")
+
+                # Parse in worker processes, with a bounded number of files in flight so that memory use stays limited
+                executor = ProcessPoolExecutor(max_workers = self.max_workers, initializer = init_worker)
+                try:
+                    pending = set()
+                    done = 0
+                    for file_path in todo:
+                        pending.add(executor.submit(parse_nanonis_file, file_path))
+                        if len(pending) < 4 * self.max_workers: continue
+
+                        finished = next(as_completed(pending))
+                        pending.remove(finished)
+                        done += 1
+                        self.store(container, folder, finished.result(), summary)
+                        if progress_callback: progress_callback(done, total)
+                        if abort_callback: abort_callback()
+
+                    for finished in as_completed(pending):
+                        done += 1
+                        self.store(container, folder, finished.result(), summary)
+                        if progress_callback: progress_callback(done, total)
+                        if abort_callback: abort_callback()
+                finally:
+                    executor.shutdown(wait = True, cancel_futures = True) # On an abort, files that were not parsed yet are dropped. They are converted on the next run
+
+                container.attrs.update({"updated": time.strftime("%Y/%m/%d %H:%M:%S")})
+        except Exception as e:
+            error = e
+
+        if self.verbose: print(f"Converted {summary['converted']} files, skipped {summary['skipped']}, {len(summary['failed'])} failed")
+        return (summary, error)
+
+    def store(self, container: h5py.File, folder: str, result: tuple, summary: dict) -> None:
+        (file_path, payload, error) = result
+        relative_path = os.path.relpath(file_path, folder).replace(os.sep, "/")
+        if error:
+            summary["failed"].update({relative_path: error})
+            if self.verbose: print(f"Could not convert {relative_path}: {error}")
+            return
+
+        try:
+            group_name = self.group_name(folder, file_path)
+            if group_name in container: del container[group_name] # Left over from an interrupted conversion, or the file changed
+            group = container.create_group(group_name)
+
+            # Metadata
+            group.attrs.update({key: value for key, value in payload["attrs"].items() if value is not None})
+            for subgroup_name, attributes in payload["groups"].items():
+                subgroup = group.create_group(subgroup_name)
+                for key, value in attributes.items():
+                    try: subgroup.attrs.update({key: value})
+                    except: subgroup.attrs.update({key: str(value)})
+
+            # Data and axes
+            for name, data in payload["datasets"].items():
+                if name == payload["signal"]: self.file_functions.create_hdf5_dataset(group, name, data = data, dtype = data.dtype, layout = payload["layout"])
+                elif isinstance(data, list): group.create_dataset(name, data = np.array([str(item).encode("utf-8") for item in data]), dtype = self.str_dtype)
+                else: group.create_dataset(name, data = data)
+            group.attrs.update({"NX_class": "NXdata", "signal": payload["signal"], "axes": payload["axes"], "source_file": relative_path})
+
+            # Index row. It is appended last, so that a file is only considered converted once all of its data were written
+            stat = os.stat(file_path)
+            frame = payload["groups"].get("frame", {})
+            [center, domain] = [frame.get(key, [np.nan, np.nan]) for key in ["center (nm)", "domain (nm)"]]
+            signal_shape = payload["datasets"][payload["signal"]].shape
+            x_nm = payload["attrs"].get("x (nm)", center[0])
+            y_nm = payload["attrs"].get("y (nm)", center[1])
+            row = np.array([(relative_path, group_name, payload["kind"], payload["attrs"].get("date_time", ""), stat.st_size, stat.st_mtime, x_nm, y_nm, domain[0], domain[1],
+                             frame.get("angle (deg)", np.nan), frame.get("pixels", 0), frame.get("lines", 0), signal_shape[1] if payload["kind"] == "scan" else signal_shape[-1])], dtype = self.index_dtype)
+
+            index_ds = container["index"]
+            position = self.index_positions.get(relative_path)
+            if position is None:
+                position = index_ds.shape[0]
+                index_ds.resize((position + 1,))
+                self.index_positions.update({relative_path: position})
+            index_ds[position] = row[0]
+            container.flush()
+            summary["converted"] += 1
+        except Exception as e:
+            summary["failed"].update({relative_path: f"{type(e).__name__}: {e}"})
+            if self.verbose: print(f"Could not store {relative_path}: {e}")
+        return
+
+
+
+    def read(self, container_path: str, file_name: str) -> dict:
+        """
+        Reads a converted file from the container into the same kind of dictionary as FileFunctions.read_sxm and read_hdf5 return
+        """
+        output = {}
+        try:
+            with h5py.File(container_path, "r") as container:
+                group_name = file_name if file_name.startswith("files/") else f"files/{file_name}"
+                group = container[group_name]
+                signal_name = group.attrs.get("signal")
+                axes = [axis.decode("utf-8") if isinstance(axis, bytes) else str(axis) for axis in group.attrs.get("axes", [])]
+                axes_data = {}
+                for axis_index, axis_name in enumerate(axes):
+                    if axis_name.endswith("indices") and axis_name[:-len(" indices")] in group.keys(): # Swap index axes for their labels
+                        axes[axis_index] = axis_name[:-len(" indices")]
+                        axes_data.update({axes[axis_index]: group[axes[axis_index]].asstr()[:]})
+                    elif axis_name in group.keys(): axes_data.update({axis_name: group[axis_name][:]})
+
+                output = {key: value for key, value in group.attrs.items() if not key in ["NX_class", "signal", "axes"]}
+                output.update({"file_path": f"{container_path}::{group_name}", "dataset": group[signal_name][()], "signal": signal_name, "axes": axes, "axes_data": axes_data})
+                if "frame" in group.keys(): output.update({"frame": dict(group["frame"].attrs)})
+        except Exception as e:
+            print(f"Problem reading {file_name} from the container: {e}")
+        return output
+
+
+
+if __name__ == "__main__":
+    # Usage: python -m lib.nexus_converter <session folder> <container.hdf5> [processes]
+    if len(sys.argv) < 3:
+        print("Usage: python -m lib.nexus_converter <folder> <container.hdf5> [processes]")
+        sys.exit(1)
+    converter = NexusConverter(max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    (summary, error) = converter.convert(sys.argv[1], sys.argv[2], progress_callback = lambda done, total: print(f"\r{done}/{total}", end = "", flush = True))
+    print()
+    if error: print(f"Conversion stopped: {error}")
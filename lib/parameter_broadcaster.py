@@ -0,0 +1,101 @@
+import time, threading
+import numpy as np
+from PyQt6 import QtCore
+
+
+
+def values_equal(a, b) -> bool:
+    """
+    Equality test for parameter values, which can be numbers, strings, lists, dicts or numpy arrays
+    """
+    if a is b: return True
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if not (isinstance(a, np.ndarray) and isinstance(b, np.ndarray)): return False
+        return a.shape == b.shape and a.dtype == b.dtype and np.array_equal(a, b, equal_nan = a.dtype.kind in "fc")
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(values_equal(a[key], b[key]) for key in a.keys())
+    if isinstance(a, list | tuple) and isinstance(b, list | tuple):
+        return type(a) == type(b) and len(a) == len(b) and all(values_equal(value_a, value_b) for value_a, value_b in zip(a, b))
+    try: return bool(a == b)
+    except Exception: return False
+
+
+
+class ParameterBroadcaster(QtCore.QObject):
+    """
+    Sits between the parameters signals of the APIs and experiments and the ParameterManager
+    Every parameter dict is compared with the last one forwarded under the same dict_name. Dicts without changes are dropped, and bursts are coalesced so that each dict_name is forwarded at most max_rate times per second
+    The forwarded dict is a new dict holding the latest value of every key, so the receiving handlers keep seeing complete dicts. Values are not copied: arrays travel as references
+    Event-like dicts (view requests, GUI setup, status changes, etc.) and dicts without a dict_name are forwarded immediately
+    """
+    parameters = QtCore.pyqtSignal(dict) # Forwarded parameter dicts, to be connected to ParameterManager.receive
+    flush_requested = QtCore.pyqtSignal(str) # Internal: emitted from the sending thread and delivered to the thread the broadcaster lives in
+
+    def __init__(self, max_rate: float = 20, rates: dict = {"tip_status": 10, "pixels": 20}, events: list = ["gui_setup", "view_request", "array_item", "channels", "path", "session_path", "nanonis_status", "mla_status", "keithley_status", "camera_status"]):
+        super().__init__()
+        self.max_rate = max_rate
+        self.rates = dict(rates) # dict_name -> maximum number of forwarded dicts per second, overriding max_rate
+        self.events = set(events)
+
+        self.lock = threading.Lock() # receive() runs in the sending thread
+        self.sent = {} # dict_name -> dict with the latest forwarded value of every key
+        self.pending = {} # dict_name -> changed keys and values waiting to be forwarded
+        self.last_flush = {} # dict_name -> time.monotonic() of the last forward
+        self.scheduled = set() # dict_names for which a flush is scheduled
+        self.forced = set() # dict_names of which the next dict is forwarded in full
+        self.flush_requested.connect(self.schedule, QtCore.Qt.ConnectionType.QueuedConnection)
+
+
+
+    @QtCore.pyqtSlot(dict)
+    def receive(self, parameters: dict) -> None:
+        """
+        Connect the parameters signals to this slot with a DirectConnection, so that the change detection runs in the sending thread and only a single event per dict_name and flush period reaches the GUI thread
+        """
+        dict_name = parameters.get("dict_name") if isinstance(parameters, dict) else None
+        if not isinstance(dict_name, str) or dict_name in self.events:
+            self.parameters.emit(parameters)
+            return
+
+        with self.lock:
+            state = self.sent.get(dict_name, {}) | self.pending.get(dict_name, {})
+            if dict_name in self.forced: changes = dict(parameters)
+            else: changes = {key: value for key, value in parameters.items() if not key in state or not values_equal(state[key], value)}
+            self.forced.discard(dict_name)
+            if not changes: return
+            self.pending.setdefault(dict_name, {}).update(changes)
+            if dict_name in self.scheduled: return
+            self.scheduled.add(dict_name)
+
+        if QtCore.QThread.currentThread() == self.thread(): self.schedule(dict_name) # Sent from the GUI thread: an isolated update is handled synchronously, as without the broadcaster
+        else: self.flush_requested.emit(dict_name)
+        return
+
+    def schedule(self, dict_name: str) -> None:
+        interval = 1 / self.rates.get(dict_name, self.max_rate)
+        wait = self.last_flush.get(dict_name, -np.inf) + interval - time.monotonic()
+        if wait <= 0: self.flush(dict_name)
+        else: QtCore.QTimer.singleShot(int(np.ceil(1000 * wait)), lambda dict_name = dict_name: self.flush(dict_name))
+        return
+
+    def flush(self, dict_name: str) -> None:
+        with self.lock:
+            self.scheduled.discard(dict_name)
+            changes = self.pending.pop(dict_name, None)
+            if not changes: return
+            state = self.sent.setdefault(dict_name, {"dict_name": dict_name})
+            state.update(changes)
+            forwarded = dict(state)
+            self.last_flush[dict_name] = time.monotonic()
+
+        self.parameters.emit(forwarded)
+        return
+
+    def force(self, dict_name: str = None) -> None:
+        """
+        Makes the next dict (of every dict_name if dict_name is None) be forwarded, even if nothing changed. Used when the GUI explicitly requests parameters, since the user may have edited the fields in the meantime
+        """
+        with self.lock:
+            if dict_name is None: self.forced = set(self.sent.keys()) | set(self.pending.keys())
+            else: self.forced.add(dict_name)
+        return
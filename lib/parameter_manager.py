@@ -20,6 +20,7 @@ class ParameterManager(QtCore.QObject):
         if parameter_type in ["feedback", "frame", "grid", "speeds", "gain", "tip_shaper"] and not hasattr(sct, "nanonis"):
             sct.logprint("Cannot get parameters without a Nanonis connection", message_type = "error")
             return
+        if hasattr(sct, "broadcaster"): sct.broadcaster.force() # Refresh the fields, even if the values did not change
 
         match parameter_type:
             case "bias":
@@ -57,6 +58,7 @@ class ParameterManager(QtCore.QObject):
         if parameter_type in ["feedback", "frame", "grid", "speeds", "gain"] and not hasattr(sct, "nanonis"):
             sct.logprint("Cannot set parameters without a Nanonis connection", message_type = "error")
             return
+        if hasattr(sct, "broadcaster"): sct.broadcaster.force() # Show the values as accepted by the hardware, even if they did not change
 
         match parameter_type:
             case "bias":
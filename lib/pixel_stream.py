@@ -0,0 +1,161 @@
+import time, threading
+import numpy as np
+
+
+
+class PixelStream:
+    """
+    Continuous acquisition of MLA lock-in pixels on a background thread, into a preallocated ring buffer of complex pixels with timestamps
+    Every pixel is written twice, at i and i + capacity of a buffer of length 2 * capacity, so that any window of up to capacity consecutive pixels is a contiguous slice of the buffer. Reads return views, without copying; a view stays valid until capacity newer pixels have been acquired
+    Pixels are numbered from the start of the stream. The timestamps are time.perf_counter() values of the end of every pixel, interpolated over the blocks read from the lock-in, so that the pixels can be correlated with other measurements (like the tip position) after the fact
+    Subscribers receive decimated views: callback(pix, timestamp) is called from the acquisition thread with every decimation new pixels, averaged if average is True. Callbacks should return quickly, since they delay the acquisition
+    """
+    def __init__(self, lockin, n_tones: int = 32, capacity: int = 65536, block: int = 4, error_callback: object = None):
+        self.lockin = lockin # mla.lockin
+        self.block = max(int(block), 1) # Pixels per read from the lock-in
+        self.capacity = max(int(capacity), self.block)
+        self.error_callback = error_callback
+
+        self.buffer = np.zeros((n_tones, 2 * self.capacity), dtype = complex)
+        self.timestamps = np.zeros(2 * self.capacity, dtype = float)
+        self.count = 0 # Number of pixels acquired since start()
+        self.t_stream_start = 0
+        self.t_last = 0 # End of the last pixel, or the start of the stream
+        self.condition = threading.Condition()
+        self.subscribers = []
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def start(self) -> None:
+        if self.running: return
+        (self.count, self.error, self.running) = (0, None, True)
+        self.t_stream_start = self.t_last = time.perf_counter()
+        self.thread = threading.Thread(target = self.acquire, name = "mla_pixel_stream", daemon = True)
+        self.thread.start()
+        return
+
+    def stop(self, timeout_s: float = 2) -> None:
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread(): self.thread.join(timeout_s)
+        self.thread = None
+        with self.condition: self.condition.notify_all()
+        return
+
+
+
+    # Acquisition
+    def acquire(self) -> None:
+        while self.running:
+            try:
+                self.lockin.wait_for_new_pixels(self.block)
+                (pix, _) = self.lockin.get_pixels(self.block)
+                t_end = time.perf_counter()
+                self.write(np.asarray(pix), t_end)
+                self.publish()
+            except Exception as e:
+                if not self.running: break # The lock-in was stopped while reading
+                self.error = e
+                self.running = False
+                with self.condition: self.condition.notify_all()
+                if self.error_callback: self.error_callback(f"The MLA pixel stream stopped: {e}")
+        return
+
+    def write(self, pix: np.ndarray, t_end: float) -> None:
+        n = pix.shape[1]
+        positions = (self.count + np.arange(n)) % self.capacity
+        timestamps = np.linspace(self.t_last, t_end, n + 1)[1:]
+        for offset in [0, self.capacity]: # Both copies are complete before the pixels are counted, so readers never see half-written pixels
+            self.buffer[:, positions + offset] = pix
+            self.timestamps[positions + offset] = timestamps
+        with self.condition:
+            self.count += n
+            self.t_last = t_end
+            self.condition.notify_all()
+        return
+
+
+
+    # Reading
+    def wait_for(self, count: int, timeout_s: float = None) -> None:
+        """
+        Waits until count pixels have been acquired
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count >= count or not self.running, timeout = timeout_s): raise Exception("Timed out while waiting for MLA pixels")
+            if self.count < count: raise Exception(f"The MLA pixel stream is not running{f': {self.error}' if self.error else ''}")
+        return
+
+    def window(self, start: int, number: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Views of the pixels start to start + number and their timestamps
+        """
+        if start < self.count - self.capacity: raise Exception(f"MLA pixels {start} to {start + number} have already been overwritten")
+        if start < 0 or number > self.capacity or start + number > self.count: raise Exception(f"MLA pixels {start} to {start + number} are not available")
+        offset = start % self.capacity
+        return (self.buffer[:, offset : offset + number], self.timestamps[offset : offset + number])
+
+    def latest(self, number: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        count = self.count
+        number = min(int(number), count, self.capacity)
+        return self.window(count - number, number)
+
+    def get_pixels(self, number: int = 1, wait_for_new: bool = True, timeout_s: float = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The next number pixels that were acquired completely after the request, or the last number pixels if wait_for_new is False. Returns views of the pixels and their timestamps
+        """
+        number = min(max(int(number), 1), self.capacity)
+        if not wait_for_new:
+            self.wait_for(number, timeout_s)
+            return self.latest(number)
+
+        t_request = time.perf_counter()
+        start = self.count
+        self.wait_for(start + 1, timeout_s)
+        # Skip the pixels of the block that was being read at the time of the request
+        available = self.count
+        t_pixel_start = np.concatenate(([self.t_start_of(start)], self.window(start, available - start)[1][:-1]))
+        start += int(np.searchsorted(t_pixel_start, t_request))
+        self.wait_for(start + number, timeout_s)
+        return self.window(start, number)
+
+    def t_start_of(self, index: int) -> float:
+        """
+        Start time of pixel index, which is the end of the pixel before it
+        """
+        if index == 0: return self.t_stream_start
+        return self.timestamps[(index - 1) % self.capacity]
+
+    def between(self, t_start: float, t_end: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Views of the pixels that ended between t_start and t_end (time.perf_counter() values) and their timestamps, limited to the pixels still in the buffer
+        """
+        (pix, timestamps) = self.latest(self.capacity)
+        (first, last) = (np.searchsorted(timestamps, t_start, side = "left"), np.searchsorted(timestamps, t_end, side = "right"))
+        return (pix[:, first : last], timestamps[first : last])
+
+
+
+    # Decimated views
+    def subscribe(self, callback: object, decimation: int = 1, average: bool = True) -> object:
+        with self.condition: self.subscribers.append({"callback": callback, "decimation": max(int(decimation), 1), "average": average, "next": self.count})
+        return callback
+
+    def unsubscribe(self, callback: object) -> None:
+        with self.condition: self.subscribers = [subscriber for subscriber in self.subscribers if subscriber["callback"] is not callback]
+        return
+
+    def publish(self) -> None:
+        count = self.count
+        for subscriber in list(self.subscribers):
+            decimation = subscriber["decimation"]
+            subscriber["next"] = max(subscriber["next"], count - self.capacity)
+            while subscriber["next"] + decimation <= count:
+                (pix, timestamps) = self.window(subscriber["next"], decimation)
+                subscriber["next"] += decimation
+                try: subscriber["callback"](np.average(pix, axis = 1) if subscriber["average"] else pix, timestamps[-1])
+                except Exception as e:
+                    self.unsubscribe(subscriber["callback"])
+                    if self.error_callback: self.error_callback(f"Removed a subscriber of the MLA pixel stream after an error: {e}")
+                    break
+        return
@@ -0,0 +1,115 @@
+import os, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PyQt6 import QtCore
+
+
+
+class ProcessingService(QtCore.QObject):
+    """
+    Runs processing jobs (image processing, file reading) off the GUI thread
+    Every job has a key, for example 'image' or 'open_file'. Per key, at most one job runs and one waits: submitting a job replaces the waiting one, so a burst of requests only processes the newest. Results older than one already delivered are discarded
+    Numpy-heavy work that releases the GIL goes to the thread pool (kind = 'thread'). Pure Python work can go to the process pool (kind = 'process'), which requires a picklable module-level function and arguments
+    """
+    result = QtCore.pyqtSignal(str, int, object) # key, version, result
+    failed = QtCore.pyqtSignal(str, int, str) # key, version, error message
+    message = QtCore.pyqtSignal(str, str) # First argument is the message string, second argument is the message type, like 'warning', 'code', 'result', 'message', or 'error'
+    done = QtCore.pyqtSignal(str, int, object, object) # Internal: emitted from the worker threads and delivered to the thread the service lives in
+
+    def __init__(self, max_threads: int = None, max_processes: int = None):
+        super().__init__()
+        self.max_threads = max_threads or min(4, os.cpu_count() or 1)
+        self.max_processes = max_processes or max((os.cpu_count() or 2) - 1, 1)
+        self.thread_pool = ThreadPoolExecutor(max_workers = self.max_threads, thread_name_prefix = "processing")
+        self.process_pool = None # Created on first use; starting processes is expensive
+
+        self.lock = threading.RLock() # Reentrant: a job that is already done runs its done callback inside start()
+        self.versions = {} # key -> newest submitted version
+        self.delivered = {} # key -> newest delivered (or cancelled) version. Anything at or below it is stale
+        self.running = {} # key -> (version, future) of the job that is executing
+        self.waiting = {} # key -> job tuple that starts when the running job of that key is done
+        self.callbacks = {} # (key, version) -> callable receiving the result in the GUI thread
+        self.done.connect(self.deliver, QtCore.Qt.ConnectionType.QueuedConnection)
+
+
+
+    def submit(self, key: str, function, *args, kind: str = "thread", callback = None, **kwargs) -> int:
+        """
+        Schedules function(*args, **kwargs) and returns the version number of the job. The optional callback is called in the GUI thread with the result, unless a newer result was delivered first
+        """
+        with self.lock:
+            version = self.versions.get(key, 0) + 1
+            self.versions[key] = version
+            if callable(callback): self.callbacks[(key, version)] = callback
+            replaced = self.waiting.pop(key, None)
+            if replaced is not None: self.callbacks.pop((key, replaced[0]), None) # The replaced job never runs
+            job = (version, function, args, kwargs, kind)
+            if key in self.running: self.waiting[key] = job
+            else: self.start(key, job)
+        return version
+
+    def start(self, key: str, job: tuple) -> None: # Called with the lock held
+        (version, function, args, kwargs, kind) = job
+        match kind:
+            case "process":
+                if self.process_pool is None: self.process_pool = ProcessPoolExecutor(max_workers = self.max_processes)
+                future = self.process_pool.submit(function, *args, **kwargs)
+            case _:
+                future = self.thread_pool.submit(function, *args, **kwargs)
+        self.running[key] = (version, future)
+        future.add_done_callback(lambda future, key = key, version = version: self.job_done(key, version, future))
+        return
+
+    def cancel(self, key: str = None) -> None:
+        """
+        Cancels the jobs under key (all keys if key is None). A job that is already executing finishes, but its result is discarded
+        """
+        with self.lock:
+            keys = list(self.versions.keys()) if key is None else [key]
+            for k in keys:
+                self.delivered[k] = self.versions.get(k, 0)
+                self.waiting.pop(k, None)
+                (version, future) = self.running.get(k, (None, None))
+                if future is not None: future.cancel()
+            self.callbacks = {(k, v): c for (k, v), c in self.callbacks.items() if k not in keys}
+        return
+
+    def is_current(self, key: str, version: int) -> bool:
+        with self.lock: return version > self.delivered.get(key, 0)
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.thread_pool.shutdown(wait = False, cancel_futures = True)
+        if self.process_pool is not None: self.process_pool.shutdown(wait = False, cancel_futures = True)
+        return
+
+
+
+    # Result delivery
+    def job_done(self, key: str, version: int, future) -> None: # Runs in a worker thread (or in the submitting thread if the job was already done)
+        with self.lock:
+            if self.running.get(key, (None,))[0] == version: del self.running[key]
+            job = self.waiting.pop(key, None)
+            if job is not None: self.start(key, job)
+
+        if future.cancelled() or not self.is_current(key, version): return
+        error = future.exception()
+        self.done.emit(key, version, None if error else future.result(), error)
+        return
+
+    def deliver(self, key: str, version: int, result: object, error: object) -> None: # Runs in the GUI thread
+        with self.lock:
+            if version <= self.delivered.get(key, 0): return # A newer result arrived first, or the key was cancelled
+            self.delivered[key] = version
+            callback = self.callbacks.pop((key, version), None)
+            self.callbacks = {(k, v): c for (k, v), c in self.callbacks.items() if k != key or v > version}
+
+        if error:
+            self.message.emit(f"Processing job {key} failed: {error}", "error")
+            self.failed.emit(key, version, str(error))
+            return
+
+        if callable(callback):
+            try: callback(result)
+            except Exception as e: self.message.emit(f"Error handling the result of processing job {key}: {e}", "error")
+        self.result.emit(key, version, result)
+        return
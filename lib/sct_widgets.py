@@ -1,4 +1,6 @@
 import re, types, os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PyQt6 import QtGui, QtWidgets, QtCore
 import pyqtgraph as pg
 import numpy as np
@@ -73,10 +75,20 @@ class SCTWidgets:
                 super().mouseClickEvent(event)
 
     class ArrayItem(pg.ImageItem):
+        tile_ready = QtCore.pyqtSignal(object, object, object, int) # pyramid, tile key, tile data, generation. Emitted from the pyramid worker thread
+
         def __init__(self, name: str = "", array: np.ndarray = None, frame: dict = {}, x_axis: int = 0, y_axis: int = 1, color_image: bool = False,
                      axes: list | np.ndarray = None, axis_0_labels: list | np.ndarray = None, axis_1_labels: list | np.ndarray = None, axis_2_labels: list | np.ndarray = None, axis_3_labels: list | np.ndarray = None):
             super().__init__()
             self.setOpts(axisOrder = "row-major")
+            self.version = 0 # Incremented whenever the displayed image changes; the histogram is cached per version
+            self.histogram_cache = (None, None)
+            self.row_buffer = None # ARGB copy of the displayed image, used to re-render only the rows that changed
+            self.row_buffer_key = None
+            self.lod = "auto" # Level-of-detail rendering: True, False, or 'auto' (for images of at least lod_threshold pixels)
+            self.lod_threshold = 1024 * 1024
+            self.pyramid = None
+            self.tile_ready.connect(self.receiveTile)
 
             # Instantiate text labels
             self.x_label = pg.TextItem(text = "local x axis", color = "#2090ff", anchor = (0.5, .1), rotateAxis = (1, 0))
@@ -164,8 +176,141 @@ class SCTWidgets:
                 print(f"Uknown image data type: {image.dtype.kind = }")
             
             super().setImage(real_image, autoLevels, levelSamples, **kwargs)
+            self.version += 1
+            self.row_buffer_key = None # The full image was re-rendered by pyqtgraph, so the row buffer is stale
+            self.pyramid = ImagePyramid(self.image) if self.useLOD() else None
             self.updateLabelPositions()
             return
+
+        def updateRows(self, image: np.ndarray = None, rows: list | np.ndarray = None, max_fraction: float = .5) -> None:
+            """
+            Updates the displayed image, re-rendering only the rows that changed (for example the newly acquired lines of a live scan)
+            If rows is not given, the changed rows are detected by comparison. Falls back to a full setImage when the shape, levels or lookup table changed, or when more than max_fraction of the rows changed
+            """
+            if not isinstance(image, np.ndarray): return
+            if self.image is None or image.ndim != 2 or image.shape != self.image.shape or image.dtype.kind not in ["f", "u", "i"] or self.autoDownsample:
+                self.setImage(image)
+                return
+            
+            if rows is None:
+                unchanged = (image == self.image) | (np.isnan(image) & np.isnan(self.image)) if image.dtype.kind == "f" else image == self.image
+                rows = np.flatnonzero(~unchanged.all(axis = 1))
+            rows = np.unique(np.asarray(rows, dtype = int))
+            if len(rows) < 1: return
+            if len(rows) > max_fraction * image.shape[0]:
+                self.setImage(image)
+                return
+            
+            if self.pyramid is not None: # Tiled rendering: only the tiles overlapping the changed rows are recomputed when they are drawn
+                self.image[rows] = image[rows]
+                self.pyramid.invalidate_rows(rows)
+                self.version += 1
+                self.update()
+                self.sigImageChanged.emit()
+                return
+            
+            (lut, levels, key) = self.renderKey()
+            key = (image.shape,) + key
+            self.image[rows] = image[rows]
+            
+            if self.row_buffer_key != key: # First partial update after a full render or a change of levels/colors: build the row buffer once
+                (self.row_buffer, _) = pg.functions.makeARGB(self.image, lut = lut, levels = levels)
+                self.row_buffer_key = key
+            else:
+                (argb, _) = pg.functions.makeARGB(self.image[rows], lut = lut, levels = levels)
+                self.row_buffer[rows] = argb
+            
+            self.qimage = pg.functions.ndarray_to_qimage(self.row_buffer, QtGui.QImage.Format.Format_ARGB32)
+            self._renderRequired = False
+            self._imageHasNans = None # Let a later full render re-evaluate the NaN mask
+            self._imageNanLocations = None
+            self.version += 1
+            self.update()
+            self.sigImageChanged.emit()
+            return
+
+        def renderKey(self) -> tuple:
+            """
+            The lookup table and levels currently in use, plus a key that changes whenever either of them does
+            """
+            lut = self.lut(self.image, 256) if callable(self.lut) else self.lut
+            levels = self.levels
+            return (lut, levels, (None if levels is None else tuple(np.ravel(levels).tolist()), None if lut is None else lut.tobytes()))
+
+        def setLOD(self, lod: bool | str = "auto", threshold: int = None) -> None:
+            self.lod = lod
+            if isinstance(threshold, int): self.lod_threshold = threshold
+            self.pyramid = ImagePyramid(self.image) if self.useLOD() else None
+            self.update()
+            return
+
+        def useLOD(self) -> bool:
+            if self.image is None or self.image.ndim < 2 or self.autoDownsample: return False
+            if self.lod == "auto": return self.image.shape[0] * self.image.shape[1] >= self.lod_threshold
+            return bool(self.lod)
+
+        def receiveTile(self, pyramid, key: tuple, tile: np.ndarray, generation: int) -> None:
+            if pyramid is self.pyramid and pyramid.store_tile(key, tile, generation): self.update()
+            return
+
+        def tileImage(self, key: tuple, lut: np.ndarray, levels, render_key: tuple, compute: bool = True) -> QtGui.QImage | None:
+            qimage = self.pyramid.get_rendered(key, render_key)
+            if qimage is not None: return qimage
+            
+            tile = self.pyramid.get_tile(key)
+            if tile is None:
+                if compute: self.pyramid.submit(key, lambda key, tile, generation, pyramid = self.pyramid: self.tile_ready.emit(pyramid, key, tile, generation))
+                return None
+            
+            (argb, _) = pg.functions.makeARGB(tile, lut = lut, levels = levels)
+            qimage = pg.functions.ndarray_to_qimage(argb, QtGui.QImage.Format.Format_ARGB32)
+            self.pyramid.store_rendered(key, render_key, argb, qimage)
+            return qimage
+
+        def paint(self, painter, *args) -> None:
+            """
+            With level-of-detail rendering, only the tiles in view are drawn, from the pyramid level that matches the zoom. Tiles that are still being computed are drawn from a coarser level in the meantime
+            """
+            if self.pyramid is None or self.image is None: return super().paint(painter, *args)
+            view_rect = self.viewRect()
+            (pixel_x, pixel_y) = self.pixelVectors()
+            if view_rect is None or pixel_x is None: return super().paint(painter, *args)
+            
+            image_pixels_per_screen_pixel = max(np.hypot(pixel_x.x(), pixel_x.y()), np.hypot(pixel_y.x(), pixel_y.y()))
+            level = int(np.clip(np.floor(np.log2(max(image_pixels_per_screen_pixel, 1))), 0, self.pyramid.n_levels - 1))
+            (lut, levels, render_key) = self.renderKey()
+            (height, width) = self.image.shape[:2]
+            if self.paintMode is not None: painter.setCompositionMode(self.paintMode)
+            
+            span = self.pyramid.tile_size * 2 ** level
+            (rows, columns) = self.pyramid.tile_range(level, (view_rect.left(), view_rect.top(), view_rect.right(), view_rect.bottom()))
+            for row in rows:
+                for column in columns:
+                    (x_0, y_0) = (column * span, row * span)
+                    target = QtCore.QRectF(x_0, y_0, min(span, width - x_0), min(span, height - y_0))
+                    qimage = self.tileImage((level, row, column), lut, levels, render_key)
+                    if qimage is not None:
+                        painter.drawImage(target, qimage)
+                        continue
+                    
+                    for coarser_level in range(level + 1, self.pyramid.n_levels): # Placeholder from the finest coarser tile that is ready
+                        coarser_span = self.pyramid.tile_size * 2 ** coarser_level
+                        (coarser_row, coarser_column) = (y_0 // coarser_span, x_0 // coarser_span)
+                        coarser_image = self.tileImage((coarser_level, coarser_row, coarser_column), lut, levels, render_key, compute = coarser_level == self.pyramid.n_levels - 1)
+                        if coarser_image is None: continue
+                        factor = 2 ** coarser_level
+                        source = QtCore.QRectF((x_0 - coarser_column * coarser_span) / factor, (y_0 - coarser_row * coarser_span) / factor, target.width() / factor, target.height() / factor)
+                        painter.drawImage(target, coarser_image, source)
+                        break
+            return
+
+        def getHistogram(self, *args, **kwargs) -> tuple:
+            """
+            pyqtgraph's histogram, cached per image version so repeated requests (level changes, histogram range updates) do not rescan the image
+            """
+            key = (self.version, args, tuple(sorted(kwargs.items())))
+            if self.histogram_cache[0] != key: self.histogram_cache = (key, super().getHistogram(*args, **kwargs))
+            return self.histogram_cache[1]
         
         def setImageLevels(self, levels: tuple | list | np.ndarray) -> None:
             self.min = levels[0]
@@ -2057,13 +2202,20 @@ class SCTWidgets:
             super().__init__()
 
     class PlotWidget(pg.PlotWidget):
-        def __init__(self, buffer_size: int = 2000, n_channels: int = 35, colors: list = []):
+        def __init__(self, buffer_size: int = 2000, n_channels: int = 35, colors: list = [], frame_rate: float = 30, tier_factors: list = [1, 16, 256]):
             super().__init__()
             
             self.buffer_size = buffer_size
             self.n_channels = n_channels
             self.channel_names = np.array([f"channel_{index}" for index in range(n_channels)], dtype = str)
             self.x_channel = -1
+            self.tier_factors = tier_factors # History is kept at these decimation factors, each holding buffer_size bins, so zooming out reaches tier_factors[-1] * buffer_size samples back
+            
+            # Rendering is decoupled from data arrival: new data only mark the widget dirty, and a timer repaints at most frame_rate times per second
+            self.dirty = False
+            self.render_timer = QtCore.QTimer(self)
+            self.render_timer.timeout.connect(self.renderData)
+            self.setFrameRate(frame_rate)
 
             # Make PlotDataItems
             if len(colors) > 0: self.pdis = [self.plot(np.array([]), np.array([]), pen = pg.mkPen(colors[i % len(colors)], width = 1)) for i in range(self.n_channels)]
@@ -2081,6 +2233,11 @@ class SCTWidgets:
             
             return
 
+        def setFrameRate(self, frame_rate: float = 30) -> None:
+            self.frame_rate = max(float(frame_rate), 1)
+            self.render_timer.start(int(1000 / self.frame_rate))
+            return
+
         def setVLines(self, x_coords: list | int | float) -> None:
             if isinstance(x_coords, int | float): x_coords = [x_coords]
             if not isinstance(x_coords, list): return
@@ -2114,41 +2271,35 @@ class SCTWidgets:
             return
         
         def addData(self, data: np.ndarray) -> None:
-            (n_channels, n_datapoints) = data.shape # Read how many channels and data points are given
-            if n_channels > self.n_channels: data = data[:n_channels]
-            new_buffer_index = self.buffer_index + n_datapoints # Calculate where the buffer fills up to
-            
-            if new_buffer_index > self.buffer_size: # If the buffer is full: roll over
-                overflow = new_buffer_index - self.buffer_size
-                
-                self.buffer[:n_channels, self.buffer_index : self.buffer_size] = data[:, : n_datapoints - overflow] # Fill up the remainder
-                self.buffer_full = True
-                self.buffer[:n_channels, : overflow] = data[:, n_datapoints - overflow :] # Roll over and overwrite
-                self.buffer_index = overflow
-            else:
-                self.buffer[:n_channels, self.buffer_index : new_buffer_index] = data
-                self.buffer_index = new_buffer_index
-            self.plotData()
+            self.store.append(np.atleast_2d(data)) # The store updates its raw ring buffer and every decimation tier incrementally
+            self.dirty = True
             return
         
         def clearBuffer(self) -> None:
-            self.buffer_full = False
-            self.buffer_index = 0
-            self.buffer = np.zeros((self.n_channels, self.buffer_size), dtype = np.float32)
+            self.store = TimeSeriesStore(n_channels = self.n_channels, capacity = self.buffer_size, factors = self.tier_factors)
             self.plotData()
             return
         
+        @property
+        def buffer(self) -> np.ndarray:
+            return self.store.raw
+        
+        @property
+        def buffer_index(self) -> int:
+            return self.store.tiers[0]["index"]
+        
+        @property
+        def buffer_full(self) -> bool:
+            return self.store.tiers[0]["count"] >= self.buffer_size > 0
+        
         def setData(self, data: np.ndarray) -> None:
             self.clearBuffer()
             self.addData(data)
             return
         
         def setBufferSize(self, value: int = 6000) -> None:
-            self.buffer_size = value
-            self.buffer = np.zeros((self.n_channels, self.buffer_size), dtype = np.float32)
-            self.buffer_full = False
-            self.buffer_index = 0
-            self.plotData()
+            self.buffer_size = int(value)
+            self.clearBuffer()
             return
         
         def setChannelNames(self, channel_names: list | np.ndarray) -> None:
@@ -2165,26 +2316,33 @@ class SCTWidgets:
             self.plotData()
             return
 
-        def plotData(self) -> None:           
-            x_data = None
-            if self.buffer_full: # Buffer full: roll around to capture all data points for the pdis
-                if self.x_channel > -1 and self.x_channel < self.n_channels:
-                    x_data = np.concatenate((self.buffer[self.x_channel, self.buffer_index :], self.buffer[self.x_channel, : self.buffer_index]))
+        def plotData(self) -> None:
+            """
+            Requests a repaint. The actual drawing happens in renderData on the next tick of the render timer, so calling this often is cheap
+            """
+            self.dirty = True
+            return
 
-                for channel_index in range(self.n_channels):
-                    y_data = np.concatenate((self.buffer[channel_index, self.buffer_index :], self.buffer[channel_index, : self.buffer_index]))
-                    
-                    if isinstance(x_data, np.ndarray): self.pdis[channel_index].setData(x_data, y_data)
-                    else: self.pdis[channel_index].setData(y_data)
-            else:
-                if self.x_channel > -1 and self.x_channel < self.n_channels:
-                    x_data = self.buffer[self.x_channel, : self.buffer_index]
-                
-                for channel_index in range(self.n_channels):
-                    y_data = self.buffer[channel_index, : self.buffer_index]
-                    
-                    if isinstance(x_data, np.ndarray): self.pdis[channel_index].setData(x_data, y_data)
-                    else: self.pdis[channel_index].setData(y_data)
+        def renderData(self, force: bool = False) -> None:
+            if not (self.dirty or force) or not self.isVisible(): return
+            self.dirty = False
+            
+            # Only visible channels are pushed to their pdis. Hidden channels are refreshed as soon as they become visible, because visibility changes call plotData
+            visible = [channel_index for channel_index in range(self.n_channels) if self.pdis[channel_index].isVisible()]
+            use_x_channel = self.x_channel > -1 and self.x_channel < self.n_channels
+            rows = visible + [self.x_channel] if use_x_channel else visible
+            if len(rows) < 1: return
+            
+            # While the x axis follows the data (auto range), the newest buffer_size raw samples are shown. Once the user pans or zooms out, the tier whose bins best match the pixel width of the visible range is used
+            # In x channel mode the samples are not ordered along the x axis, so min/max envelopes are meaningless and the raw tier is always used
+            view_box = self.getViewBox()
+            live = use_x_channel or view_box.autoRangeEnabled()[0]
+            x_range = None if live else view_box.viewRange()[0]
+            max_points = max(int(view_box.width()), 100)
+            (sample_numbers, ordered) = self.store.view(rows, x_range = x_range, max_points = max_points)
+            
+            x_data = ordered[-1] if use_x_channel else sample_numbers
+            for row, channel_index in enumerate(visible): self.pdis[channel_index].setData(x_data, ordered[row])
             return
 
     class FrameWidget(pg.ROI):
@@ -2968,6 +3126,266 @@ class WaveFormWidget(QtWidgets.QWidget):
 
 
 
+class ImagePyramid:
+    """
+    Lazily computed level-of-detail pyramid of a 2D (or colour) image, cut into square tiles. Level n holds the image downsampled by 2 ** n with a NaN-aware mean
+    Tiles are computed on demand in a worker thread (compute_tile) and kept in an LRU cache bounded by budget_mb, so the memory of tiles that are no longer viewed is reclaimed. Level 0 tiles are views of the image and cost no memory
+    """
+    executor = None # Shared by all pyramids
+
+    def __init__(self, image: np.ndarray, tile_size: int = 256, budget_mb: float = 64):
+        self.image = image
+        self.tile_size = int(tile_size)
+        self.budget_bytes = int(budget_mb * 1024 ** 2)
+        self.n_levels = max(int(np.ceil(np.log2(max(max(image.shape[:2]) / self.tile_size, 1)))), 0) + 1
+        self.cache = OrderedDict() # ('data' or 'argb', level, tile_row, tile_column) -> (nbytes, value), least recently used first. 'argb' values are (render key, ARGB array, QImage)
+        self.nbytes = 0
+        self.pending = set()
+        self.generation = 0 # Incremented on invalidation, so results of computations started before are dropped
+
+
+
+    def level_shape(self, level: int) -> tuple:
+        factor = 2 ** level
+        return tuple(int(np.ceil(length / factor)) for length in self.image.shape[:2])
+
+    def tile_range(self, level: int, rect: tuple) -> tuple[range, range]:
+        """
+        Tile rows and columns of a level that intersect rect = (x_min, y_min, x_max, y_max), given in full-resolution pixels
+        """
+        span = self.tile_size * 2 ** level
+        (height, width) = self.image.shape[:2]
+        (x_min, y_min, x_max, y_max) = (max(rect[0], 0), max(rect[1], 0), min(rect[2], width), min(rect[3], height))
+        if x_max <= x_min or y_max <= y_min: return (range(0), range(0))
+        return (range(int(y_min // span), int(np.ceil(y_max / span))), range(int(x_min // span), int(np.ceil(x_max / span))))
+
+    def get_tile(self, key: tuple) -> np.ndarray | None:
+        (level, row, column) = key
+        if level == 0:
+            size = self.tile_size
+            return self.image[row * size : (row + 1) * size, column * size : (column + 1) * size]
+        entry = self.cache.get(("data",) + key)
+        if entry is None: return None
+        self.cache.move_to_end(("data",) + key)
+        return entry[1]
+
+    def compute_tile(self, key: tuple) -> np.ndarray:
+        """
+        Block mean of the full-resolution region of a tile. Safe to run in a worker thread: the image is only read
+        """
+        (level, row, column) = key
+        factor = 2 ** level
+        span = self.tile_size * factor
+        region = self.image[row * span : (row + 1) * span, column * span : (column + 1) * span]
+        (height, width) = region.shape[:2]
+        (padded_height, padded_width) = (int(np.ceil(height / factor)) * factor, int(np.ceil(width / factor)) * factor)
+        if (padded_height, padded_width) != (height, width): # Pad partial edge blocks with NaN so they average over the valid pixels only
+            padding = [(0, padded_height - height), (0, padded_width - width)] + [(0, 0)] * (region.ndim - 2)
+            region = np.pad(region.astype(np.float32), padding, constant_values = np.nan)
+        blocks = region.reshape((padded_height // factor, factor, padded_width // factor, factor) + region.shape[2:])
+        valid = ~np.isnan(blocks)
+        with np.errstate(invalid = "ignore", divide = "ignore"): # All-NaN blocks (not yet scanned) stay NaN. np.errstate is thread-local, unlike the warnings filters
+            return (np.where(valid, blocks, 0).sum(axis = (1, 3)) / valid.sum(axis = (1, 3))).astype(np.float32)
+
+    def store_tile(self, key: tuple, tile: np.ndarray, generation: int) -> bool:
+        self.pending.discard((key, generation))
+        if generation != self.generation: return False # The image changed while the tile was being computed
+        self.put(("data",) + key, tile, tile.nbytes)
+        return True
+
+    def get_rendered(self, key: tuple, render_key: tuple) -> QtGui.QImage | None:
+        entry = self.cache.get(("argb",) + key)
+        if entry is None or entry[1][0] != render_key: return None
+        self.cache.move_to_end(("argb",) + key)
+        return entry[1][2]
+
+    def store_rendered(self, key: tuple, render_key: tuple, argb: np.ndarray, qimage: QtGui.QImage) -> None:
+        self.put(("argb",) + key, (render_key, argb, qimage), argb.nbytes) # The QImage shares the memory of the ARGB array
+        return
+
+    def put(self, cache_key: tuple, value: object, nbytes: int) -> None:
+        previous = self.cache.pop(cache_key, None)
+        if previous is not None: self.nbytes -= previous[0]
+        self.cache[cache_key] = (nbytes, value)
+        self.nbytes += nbytes
+        while self.nbytes > self.budget_bytes and len(self.cache) > 1: # Reclaim the least recently used tiles
+            (_, (freed, _)) = self.cache.popitem(last = False)
+            self.nbytes -= freed
+        return
+
+    def invalidate_rows(self, rows: np.ndarray) -> None:
+        """
+        Drops every tile that overlaps the given full-resolution rows (after a partial image update)
+        """
+        if len(rows) < 1: return
+        (row_min, row_max) = (int(np.min(rows)), int(np.max(rows)))
+        for cache_key in list(self.cache.keys()):
+            (kind, level, row, column) = cache_key
+            span = self.tile_size * 2 ** level
+            if row * span <= row_max and (row + 1) * span > row_min: self.nbytes -= self.cache.pop(cache_key)[0]
+        self.generation += 1
+        self.pending.clear()
+        return
+
+    def submit(self, key: tuple, callback) -> None:
+        """
+        Computes a tile in the shared worker pool; callback(key, tile, generation) is called from the worker thread
+        """
+        if (key, self.generation) in self.pending: return
+        self.pending.add((key, self.generation))
+        if ImagePyramid.executor is None: ImagePyramid.executor = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "pyramid")
+        generation = self.generation
+
+        def work() -> None:
+            delivered = False
+            try:
+                tile = self.compute_tile(key)
+                callback(key, tile, generation)
+                delivered = True
+            except Exception as e:
+                print(f"Error computing tile {key} of the image pyramid: {e}")
+            finally:
+                if not delivered: self.pending.discard((key, generation)) # Retried when the tile is drawn again; delivered tiles are discarded from pending by store_tile
+            return
+
+        ImagePyramid.executor.submit(work)
+        return
+
+
+
+class TimeSeriesStore:
+    """
+    Multi-resolution history for the grapher. Tier 0 is the raw ring buffer; every coarser tier keeps one min/max/mean bin per factor raw samples in a ring of the same capacity
+    Bins are built incrementally as data arrive (each tier is fed by the completed bins of the tier below), so memory is bounded by len(factors) * 3 * capacity samples per channel and the render cost only depends on the number of bins shown
+    """
+    def __init__(self, n_channels: int = 35, capacity: int = 2000, factors: list = [1, 16, 256]):
+        self.n_channels = max(int(n_channels), 0)
+        self.capacity = max(int(capacity), 0)
+        self.factors = [int(factor) for factor in factors]
+        if self.factors[0] != 1 or any(f1 % f0 for f0, f1 in zip(self.factors[:-1], self.factors[1:])): raise ValueError("Tier factors must start at 1 and divide each other")
+        self.clear()
+
+
+
+    def clear(self) -> None:
+        self.total = 0 # Number of raw samples ever appended. Sample numbers are global, so the x axis in index mode keeps its meaning when old data roll out of a tier
+        self.tiers = []
+        for factor in self.factors:
+            shape = (self.n_channels, self.capacity)
+            if factor == 1: tier = {"factor": 1, "min": np.zeros(shape, dtype = np.float32), "count": 0, "index": 0} # Raw samples: min, max and mean coincide, so only one array is kept
+            else: tier = {"factor": factor, "min": np.zeros(shape, dtype = np.float32), "max": np.zeros(shape, dtype = np.float32), "mean": np.zeros(shape, dtype = np.float32), "count": 0, "index": 0}
+            tier["pending"] = [np.zeros((self.n_channels, 0), dtype = np.float32) for _ in range(3)] # Lower-tier bins that do not yet fill a bin of this tier
+            self.tiers.append(tier)
+        return
+
+    @property
+    def raw(self) -> np.ndarray:
+        return self.tiers[0]["min"]
+
+    def append(self, data: np.ndarray) -> None:
+        data = np.asarray(data, dtype = np.float32)
+        if data.ndim != 2 or data.shape[1] < 1 or self.capacity < 1: return
+        if data.shape[0] < self.n_channels: data = np.concatenate((data, np.zeros((self.n_channels - data.shape[0], data.shape[1]), dtype = np.float32)), axis = 0)
+        data = data[: self.n_channels]
+
+        self.write_ring(self.tiers[0], [data])
+        self.total += data.shape[1]
+
+        # Cascade: each tier reduces the completed bins of the tier below by the ratio of their factors
+        (lows, highs, means) = (data, data, data)
+        for previous, tier in zip(self.tiers[:-1], self.tiers[1:]):
+            ratio = tier["factor"] // previous["factor"]
+            [lows, highs, means] = [np.concatenate((pending, new), axis = 1) for pending, new in zip(tier["pending"], [lows, highs, means])]
+            n_bins = lows.shape[1] // ratio
+            tier["pending"] = [array[:, n_bins * ratio :] for array in [lows, highs, means]]
+            if n_bins < 1: break
+
+            cut = n_bins * ratio
+            lows = lows[:, : cut].reshape(self.n_channels, n_bins, ratio).min(axis = 2)
+            highs = highs[:, : cut].reshape(self.n_channels, n_bins, ratio).max(axis = 2)
+            means = means[:, : cut].reshape(self.n_channels, n_bins, ratio).mean(axis = 2)
+            self.write_ring(tier, [lows, highs, means])
+        return
+
+    def write_ring(self, tier: dict, arrays: list) -> None:
+        keys = ["min", "max", "mean"][: len(arrays)]
+        n_new = arrays[0].shape[1]
+        if n_new >= self.capacity: # Only the newest capacity bins survive
+            arrays = [array[:, n_new - self.capacity :] for array in arrays]
+            n_new = self.capacity
+
+        start = tier["index"]
+        first = min(n_new, self.capacity - start)
+        for key, array in zip(keys, arrays):
+            tier[key][:, start : start + first] = array[:, : first]
+            tier[key][:, : n_new - first] = array[:, first :] # Roll over
+        tier["index"] = (start + n_new) % self.capacity
+        tier["count"] = min(tier["count"] + n_new, self.capacity)
+        return
+
+    def ordered(self, tier: dict, key: str, rows: list, last: int | None = None) -> np.ndarray:
+        """
+        The stored bins of the requested rows in chronological order, optionally only the newest last bins
+        """
+        count = tier["count"] if last is None else min(last, tier["count"])
+        start = (tier["index"] - count) % self.capacity if self.capacity > 0 else 0
+        if start + count <= self.capacity: return tier[key][rows, start : start + count]
+        return np.concatenate((tier[key][rows, start :], tier[key][rows, : tier["index"]]), axis = 1)
+
+    def first_sample(self, tier_index: int) -> int:
+        """
+        Global sample number of the oldest sample still covered by a tier
+        """
+        tier = self.tiers[tier_index]
+        covered = (self.total // tier["factor"]) * tier["factor"]
+        return covered - tier["count"] * tier["factor"]
+
+    def select_tier(self, x_range: list | None, max_points: int) -> int:
+        """
+        The finest tier that still holds the start of the visible range and shows it with at most max_points bins
+        """
+        if x_range is None: return 0
+        [x_min, x_max] = [max(x_range[0], 0), min(x_range[1], self.total)]
+        span = max(x_max - x_min, 1)
+        for tier_index, factor in enumerate(self.factors):
+            if span / factor <= max_points and self.first_sample(tier_index) <= x_min: return tier_index
+        for tier_index in range(len(self.factors)): # The range is not fully stored at the preferred resolution: fall back to the finest tier that has it
+            if self.first_sample(tier_index) <= x_min: return tier_index
+        return len(self.factors) - 1
+
+    def view(self, rows: list, x_range: list | None = None, max_points: int = 2000) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (sample numbers, data) for the requested rows. Without an x_range the newest capacity raw samples are returned (the live view)
+        Coarse tiers return an envelope that alternates between the bin minimum and maximum, so spikes remain visible at any zoom level. The incomplete newest bin is filled in with raw samples
+        """
+        if self.total < 1 or len(rows) < 1: return (np.zeros(0), np.zeros((len(rows), 0), dtype = np.float32))
+
+        tier_index = self.select_tier(x_range, max_points)
+        tier = self.tiers[tier_index]
+        factor = tier["factor"]
+        if factor == 1:
+            data = self.ordered(tier, "min", rows)
+            return (np.arange(self.total - data.shape[1], self.total), data)
+
+        covered = (self.total // factor) * factor
+        n_bins = tier["count"]
+        if x_range is not None: n_bins = min(n_bins, int(np.ceil((covered - max(x_range[0], 0)) / factor)) + 1) # Skip bins left of the visible range
+        n_bins = max(n_bins, 0)
+        lows = self.ordered(tier, "min", rows, n_bins)
+        highs = self.ordered(tier, "max", rows, n_bins)
+        bin_x = covered - factor * np.arange(lows.shape[1], 0, -1) + .5 * factor
+        envelope = np.stack((lows, highs), axis = 2).reshape(len(rows), 2 * lows.shape[1])
+        x_values = np.repeat(bin_x, 2)
+
+        # Raw samples that do not yet complete a bin of this tier
+        n_tail = min(self.total - covered, self.tiers[0]["count"])
+        if n_tail > 0:
+            envelope = np.concatenate((envelope, self.ordered(self.tiers[0], "min", rows, n_tail)), axis = 1)
+            x_values = np.concatenate((x_values, np.arange(self.total - n_tail, self.total)))
+        return (x_values, envelope)
+
+
+
 def rotate_icon(icon: QtGui.QIcon, angle) -> QtGui.QIcon:
     try:
         pixmap = icon.pixmap(QtCore.QSize(92, 92))
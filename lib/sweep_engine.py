@@ -0,0 +1,122 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+
+class RunningStatistics:
+    """
+    Running mean and standard error per tone of blocks of complex lock-in pixels of shape (tones, n). Blocks are merged with the pairwise update of Chan et al., so earlier pixels are never summed again
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0
+        self.m2 = 0 # Sum of the squared deviations |x - mean|^2 per tone
+
+    def update(self, pix: np.ndarray) -> None:
+        (n_block, mean_block) = (pix.shape[1], np.average(pix, axis = 1))
+        m2_block = np.sum(np.abs(pix - mean_block[:, None]) ** 2, axis = 1)
+        n = self.count + n_block
+        delta = mean_block - self.mean
+        self.m2 = self.m2 + m2_block + np.abs(delta) ** 2 * self.count * n_block / n
+        self.mean = self.mean + delta * n_block / n
+        self.count = n
+        return
+
+    def standard_error(self) -> np.ndarray:
+        if self.count < 2: return np.full(np.shape(self.mean), np.inf)
+        return np.sqrt(self.m2 / (self.count - 1) / self.count)
+
+    def relative_error(self) -> np.ndarray:
+        with np.errstate(divide = "ignore", invalid = "ignore"): return self.standard_error() / np.abs(self.mean)
+
+
+
+class SweepEngine:
+    """
+    Pipelined execution of MLA parameter sweeps
+    The setpoint table is computed before the sweep starts. The configuration of the next setpoint is sent as soon as the integration window of the current one closes, and the pixels of the current setpoint are processed on a worker thread while the next one settles and integrates
+    apply(setpoint) writes a setpoint to the instrument and may return the number of settle pixels for that setpoint (settle_pixels if it returns None); process(index, setpoint, pix, pix_std_dev) turns the averaged pixels into a (data_chunk, error_chunk) pair. Processing happens in order on a single worker, so point_callback(index, data_chunk, error_chunk) and data_callback receive the points in sweep order
+    With integration = {"relative error": target, "max pixels": n, "time (s)": t, "tones": [1]}, every point integrates in blocks of pixels_per_datapoint until the standard error of the mean of each of the tones, relative to its magnitude, is below the target, or until the pixel or time limit is reached. The number of pixels of every point is then appended to the data as the channel 'pixels'
+    """
+    count_channel = "pixels"
+
+    def __init__(self, mla_api, settle_pixels: int = 1, pixels_per_datapoint: int = 4, abort_callback: object = None, data_callback: object = None, integration: dict = None, point_callback: object = None):
+        self.mla_api = mla_api # MLAAPI
+        self.settle_pixels = max(int(settle_pixels), 0)
+        self.pixels_per_datapoint = max(int(pixels_per_datapoint), 1)
+        self.abort_callback = abort_callback
+        self.data_callback = data_callback
+        self.point_callback = point_callback
+        self.integration = integration if integration and integration.get("relative error", 0) > 0 else None
+        self.pixel_counts = np.empty(0, dtype = int) # Number of integrated pixels of every point of the last run
+        self.timing = {}
+
+    def acquire(self, settle_pixels: int = None) -> np.ndarray:
+        """
+        Settling and integration in a single acquisition: the settle pixels are requested together with the integration pixels and discarded
+        """
+        settle_pixels = self.settle_pixels if settle_pixels is None else max(int(settle_pixels), 0)
+        (pix, _) = self.mla_api.get_pixels(settle_pixels + self.pixels_per_datapoint)
+        pix = np.asarray(pix)
+        if pix.ndim == 1: return pix[:, None]
+        pix = pix[:, settle_pixels:]
+        if self.integration: pix = self.integrate(pix)
+        return pix
+
+    def integrate(self, pix: np.ndarray) -> np.ndarray:
+        """
+        Keeps acquiring blocks of pixels until the relative error target of the integration settings is met
+        """
+        target = self.integration.get("relative error")
+        max_pixels = self.integration.get("max pixels", 10 * self.pixels_per_datapoint)
+        max_time_s = self.integration.get("time (s)", None)
+        tones = self.integration.get("tones", [1])
+
+        t_start = time.perf_counter()
+        blocks = [pix]
+        statistics = RunningStatistics()
+        statistics.update(pix)
+        while statistics.count < max_pixels and np.nanmax(statistics.relative_error()[tones]) > target:
+            if max_time_s is not None and time.perf_counter() - t_start > max_time_s: break
+            (block, _) = self.mla_api.get_pixels(min(self.pixels_per_datapoint, max_pixels - statistics.count))
+            block = np.asarray(block)
+            statistics.update(block)
+            blocks.append(block)
+        return np.concatenate(blocks, axis = 1)
+
+    def run(self, setpoints: list, apply: object, process: object, n_channels: int) -> tuple[np.ndarray, np.ndarray]:
+        n_total = len(setpoints)
+        if self.integration: n_channels += 1
+        self.pixel_counts = np.zeros(n_total, dtype = int)
+        measurement_array = np.empty((n_total, n_channels), dtype = np.float32)
+        error_array = np.empty_like(measurement_array, dtype = np.float32)
+        if n_total == 0: return (measurement_array, error_array)
+
+        def process_point(index: int, pix: np.ndarray) -> None:
+            pix_V = np.average(pix, axis = 1)
+            pix_V_std_dev = np.std(pix, axis = 1, ddof = 1) if pix.shape[1] > 1 else np.zeros(len(pix_V))
+            self.pixel_counts[index] = pix.shape[1]
+            (data_chunk, error_chunk) = process(index, setpoints[index], pix_V, pix_V_std_dev)
+            if self.integration: (data_chunk, error_chunk) = (np.append(data_chunk, pix.shape[1]).astype(np.float32), np.append(error_chunk, 0).astype(np.float32))
+            measurement_array[index] = data_chunk
+            error_array[index] = error_chunk
+            if self.point_callback: self.point_callback(index, data_chunk, error_chunk)
+            if self.data_callback: self.data_callback(data_chunk)
+            return
+
+        t_start = time.perf_counter()
+        settle_pixels = apply(setpoints[0])
+        futures = []
+        with ThreadPoolExecutor(max_workers = 1) as worker: # Leaving the block waits for the points that are still being processed, also after an abort
+            for index in range(n_total):
+                if self.abort_callback: self.abort_callback()
+                self.mla_api.task_progress.emit(int(100 * index / n_total))
+                pix = self.acquire(settle_pixels)
+                if index + 1 < n_total: settle_pixels = apply(setpoints[index + 1]) # The integration window has closed: configure the next setpoint right away
+                futures.append(worker.submit(process_point, index, pix))
+                while futures and futures[0].done(): futures.pop(0).result() # Raise processing errors as early as possible
+        for future in futures: future.result()
+
+        self.timing = {"points": n_total, "pixels": int(np.sum(self.pixel_counts)), "time (s)": time.perf_counter() - t_start}
+        return (measurement_array, error_array)
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from math import factorial
+import numpy as np
+
+
+
+class TaylorReconstruction:
+    """
+    Reconstruction of the Taylor coefficients (the derivatives dI/dV ... d^nI/dV^n) of the I(V) curve from the harmonics of the current under a sinusoidal modulation of amplitude Vac
+    Harmonic m contains the derivatives n = m, m + 2, m + 4, ...; the coupling matrix A[n, m] = n! / (4^k k! (n + k)!), with m = n + 2k, describes this mixing. The matrix that maps the harmonics onto the derivatives is computed and inverted once per (max order, Vac, measured harmonics) and cached, so that whole maps are converted with a single matrix product
+    Missing harmonics are taken as zero. Their contribution to the lower derivatives is of order Vac^2 relative to the harmonics that were measured, so the highest orders should be measured when Vac is large
+    """
+    def __init__(self, cache_size: int = 64):
+        self.cache_size = cache_size
+        self.matrices = OrderedDict() # (max order, Vac (mV), harmonic numbers) -> (orders, harmonics) reconstruction matrix
+
+    def coupling_matrix(self, max_order: int) -> np.ndarray:
+        """
+        Upper triangular (max_order, max_order) matrix A[n - 1, m - 1] of the contribution of derivative m to harmonic n
+        """
+        A = np.zeros((max_order, max_order))
+        for n in range(1, max_order + 1):
+            for m in range(n, max_order + 1, 2):
+                k = (m - n) // 2
+                A[n - 1, m - 1] = factorial(n) / (4 ** k * factorial(k) * factorial(n + k))
+        return A
+
+    def matrix(self, Vac_mV: float, numbers: np.ndarray, max_order: int = None) -> np.ndarray:
+        """
+        (max_order, len(numbers)) matrix that maps the harmonics with the given numbers onto the derivatives of order 1 to max_order
+        """
+        numbers = np.asarray(numbers, dtype = int)
+        if max_order is None: max_order = int(np.max(numbers))
+        key = (int(max_order), float(Vac_mV), numbers.tobytes())
+        matrix = self.matrices.get(key)
+        if matrix is not None:
+            self.matrices.move_to_end(key)
+            return matrix
+
+        Vac_V = .001 * Vac_mV
+        orders = np.arange(1, max_order + 1)
+        B = np.linalg.inv(self.coupling_matrix(max_order))
+        # Harmonic m of the raw coefficient: D_raw[m] = harmonic[m] * 2^(m - 1) m! / Vac^(m - 1); derivative n = sum over m of B[n, m] D_raw[m] / Vac^(m - n)
+        prefactors = np.array([2.0 ** (m - 1) * factorial(m) for m in orders]) / Vac_V ** (orders - 1)
+        full = B * prefactors[None, :] / Vac_V ** (orders[None, :] - orders[:, None])
+        full = np.triu(full) # B is upper triangular; this removes the inf * 0 of the empty lower half for small Vac
+
+        matrix = np.zeros((max_order, len(numbers)))
+        valid = (numbers >= 1) & (numbers <= max_order) # Harmonics above max_order do not contribute
+        matrix[:, valid] = full[:, numbers[valid] - 1]
+        matrix.setflags(write = False)
+
+        self.matrices[key] = matrix
+        while len(self.matrices) > self.cache_size: self.matrices.popitem(last = False)
+        return matrix
+
+    def reconstruct(self, harmonics: np.ndarray | dict, Vac_mV: float, errors: np.ndarray | dict = None, numbers: list | np.ndarray = None, max_order: int = None, axis: int = 0) -> tuple[np.ndarray, np.ndarray | None]:
+        """
+        Derivatives of order 1 to max_order from harmonics, which is an array with the harmonics along axis (harmonic numbers 1, 2, 3, ... unless numbers is given) or a dict {number: array}
+        Returns the derivatives with the orders along axis, and their standard errors if the standard errors of the harmonics are given (same shape as harmonics). The errors of the harmonics are taken as independent
+        """
+        if isinstance(harmonics, dict):
+            numbers = sorted(number for number in harmonics.keys() if isinstance(number, int | np.integer))
+            errors = None if errors is None else np.stack([np.asarray(errors[number]) for number in numbers])
+            harmonics = np.stack([np.asarray(harmonics[number]) for number in numbers])
+            axis = 0
+        else:
+            harmonics = np.moveaxis(np.asarray(harmonics), axis, 0)
+            if errors is not None: errors = np.moveaxis(np.asarray(errors), axis, 0)
+            if numbers is None: numbers = np.arange(1, harmonics.shape[0] + 1)
+
+        matrix = self.matrix(Vac_mV, numbers, max_order)
+        shape = harmonics.shape[1:]
+        derivatives = (matrix @ harmonics.reshape(harmonics.shape[0], -1)).reshape((matrix.shape[0],) + shape)
+        uncertainties = None
+        if errors is not None: uncertainties = np.sqrt(matrix ** 2 @ (np.abs(errors.reshape(errors.shape[0], -1)) ** 2)).reshape((matrix.shape[0],) + shape)
+
+        derivatives = np.moveaxis(derivatives, 0, axis)
+        if uncertainties is not None: uncertainties = np.moveaxis(uncertainties, 0, axis)
+        return (derivatives, uncertainties)
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+import numpy as np
+
+
+
+class TIACorrection:
+    """
+    Complex gain and phase correction for the frequency response of the transimpedance amplifier
+    The table is either a 1D array of corrections indexed by the frequency in Hz, or a (2, n) array with the frequencies (Hz) in the first row and the corrections in the second. Corrections are interpolated linearly; tones outside the table are not corrected
+    The correction vector for a set of tone frequencies is computed once and cached, until the frequencies or the table (the TIA setting) change
+    """
+    def __init__(self, table: np.ndarray = None, cache_size: int = 256):
+        self.cache_size = cache_size
+        self.vectors = OrderedDict() # Frequencies (bytes) -> complex correction vector
+        self.table = None
+        self.set_table(table)
+
+    def set_table(self, table: np.ndarray = None) -> None:
+        if table is self.table: return
+        self.table = table
+        self.vectors.clear()
+        self.table_frequencies = None
+        self.table_corrections = None
+        if table is None: return
+
+        table = np.asarray(table)
+        if table.ndim == 2 and table.shape[0] == 2:
+            (frequencies, corrections) = (np.real(table[0]).astype(float), table[1].astype(complex))
+            order = np.argsort(frequencies)
+            (self.table_frequencies, self.table_corrections) = (frequencies[order], corrections[order])
+        else:
+            self.table_corrections = table.ravel().astype(complex)
+            self.table_frequencies = np.arange(len(self.table_corrections), dtype = float)
+        return
+
+    def vector(self, frequencies: np.ndarray) -> np.ndarray:
+        """
+        Correction factor of every tone
+        """
+        frequencies = np.ascontiguousarray(frequencies, dtype = float)
+        key = frequencies.tobytes()
+        vector = self.vectors.get(key)
+        if vector is not None:
+            self.vectors.move_to_end(key)
+            return vector
+
+        if self.table_frequencies is None or len(self.table_frequencies) == 0: vector = np.ones(len(frequencies), dtype = complex)
+        else:
+            (table_frequencies, corrections) = (self.table_frequencies, self.table_corrections)
+            vector = np.interp(frequencies, table_frequencies, corrections.real) + 1j * np.interp(frequencies, table_frequencies, corrections.imag)
+            outside = (frequencies < table_frequencies[0]) | (frequencies > table_frequencies[-1])
+            vector[outside] = 1
+        vector.setflags(write = False)
+
+        self.vectors[key] = vector
+        while len(self.vectors) > self.cache_size: self.vectors.popitem(last = False)
+        return vector
+
+    def apply(self, pixels: np.ndarray, std_dev: np.ndarray = None, frequencies: np.ndarray = None) -> tuple[np.ndarray, np.ndarray | None]:
+        """
+        Corrects pixels of shape (tones,) or (tones, n) in a single broadcast multiply, and scales their standard deviations (same shape, or None) by the magnitude of the correction
+        """
+        vector = self.vector(frequencies)
+        n_tones = min(len(vector), len(pixels))
+        if pixels.ndim > 1: vector = vector[:, None]
+
+        pixels = np.array(pixels, dtype = complex, copy = True)
+        pixels[:n_tones] *= vector[:n_tones]
+        if std_dev is not None:
+            std_dev = np.array(std_dev, dtype = float, copy = True)
+            std_dev[:n_tones] *= np.abs(vector[:n_tones])
+        return (pixels, std_dev)